@@ -0,0 +1,18 @@
+import mnfspeedcalc.trafficreader as tr
+import argparse
+from os import path
+
+program_description = "Packs a year of .traffic files into a single year archive that NexusFSCalc.py can read in place of the .traffic directory"
+
+parser = argparse.ArgumentParser(prog="NexusArchive.py", version="0.1.0", description=program_description)
+parser.add_argument('-d', metavar='DIRECTORY', required=True, help='Directory holding .traffic files')
+parser.add_argument('-y', metavar='YEAR', type=int, required=True, help='Year to pack')
+parser.add_argument('-o', metavar='OUTPUT_FILE', help='Archive file to write (default DIRECTORY/YEAR' + tr.ARCHIVE_EXTENSION + ')')
+parser.add_argument('--verbose', action='store_true', help='Print progress')
+args = parser.parse_args()
+
+output_file = args.o
+if output_file == None:
+	output_file = path.join(args.d, tr.archive_filename_for_year(args.y))
+
+tr.build_year_archive(args.d, args.y, output_file, verbose=args.verbose)
@@ -1,9 +1,11 @@
 import mnfspeedcalc as mnfsc
 import argparse
 from datetime import time
+from os import path
 from pprint import pprint
 import re
 import csv
+import sys
 import math
 
 
@@ -14,14 +16,156 @@ def s_num(station_id):
 program_description = "Calculates average weekday speeds over specified time intervals from loop detector data stored in .traffic files"
 
 parser = argparse.ArgumentParser(prog="NexusFSCalc.py", version="0.1.0", description=program_description)
-parser.add_argument('-d', metavar='DIRECTORY', required=True, help='Directory holding .traffic files') # base directory of .traffic data
-parser.add_argument('-y', metavar='YEAR', type=int, required=True, help='Year to analyze') # year
-parser.add_argument('-m', metavar='METRO_CONFIG', required=True, help='Path to metro_config.xml') # metro_config file
-parser.add_argument('-s', metavar='START_TIME', type=int, required=True, help='Start time (hour, e.g. 7 or 16)') # start time (hour)
-parser.add_argument('-e', metavar='END_TIME', type=int, required=True, help='Start time (hour, e.g. 9 or 18') # end time (hour)
-parser.add_argument('-o', metavar='OUTPUT_FILE', type=argparse.FileType('wb'), required=True, help='Output file')
+parser.add_argument('-d', metavar='DIRECTORY', help='Directory holding .traffic files, or an http(s):// URL or .tar bundle of them (with --run-shard, overrides the directory recorded in the shard)') # base directory of .traffic data
+parser.add_argument('--cache-dir', metavar='CACHE_DIR', help='Keep a local copy of every .traffic file read from -d in this directory and read it from there afterwards')
+parser.add_argument('--fetch-workers', metavar='N', type=int, help='Number of .traffic files read from -d at once (default 8 for URLs, 1 otherwise)')
+parser.add_argument('-y', metavar='YEAR', type=int, help='Year to analyze') # year
+parser.add_argument('--end-year', metavar='END_YEAR', type=int, help='Analyze every year from YEAR to END_YEAR')
+parser.add_argument('-m', metavar='METRO_CONFIG', help='Path to metro_config.xml') # metro_config file
+parser.add_argument('-s', metavar='START_TIME', type=int, help='Start time (hour, e.g. 7 or 16)') # start time (hour)
+parser.add_argument('-e', metavar='END_TIME', type=int, help='Start time (hour, e.g. 9 or 18') # end time (hour)
+parser.add_argument('-o', metavar='OUTPUT_FILE', type=argparse.FileType('wb'), help='Output file')
+parser.add_argument('-c', metavar='CHECKPOINT_DIR', help='Directory for checkpoints; an interrupted run resumes from here')
+parser.add_argument('--restart-from', choices=mnfsc.STAGES, help='Run this stage and all later stages again')
+parser.add_argument('--batch-days', type=int, default=30, help='Number of days loaded between checkpoints (default 30)')
+parser.add_argument('-j', metavar='WORKERS', type=int, default=1, help='Number of processes used for imputation (default 1)')
+parser.add_argument('--cube-dir', metavar='CUBE_DIR', help='Keep the speed arrays in memory-mapped files in this directory instead of in RAM')
+parser.add_argument('--memory-budget', metavar='MB', type=int, default=1024, help='Memory used for the speed arrays with --cube-dir, in megabytes (default 1024)')
+parser.add_argument('--spatial', nargs=2, type=int, metavar=('IMPUTE_LENGTH', 'INPUT_LENGTH'), help='Spatial imputation settings (default 4 1)')
+parser.add_argument('--weekly', nargs=2, type=int, metavar=('IMPUTE_LENGTH', 'INPUT_LENGTH'), help='Weekly imputation settings (default 3 2)')
+parser.add_argument('--temporal', nargs=2, type=int, metavar=('IMPUTE_LENGTH', 'INPUT_LENGTH'), help='Long temporal imputation settings (default 6 6)')
+parser.add_argument('--bbox', nargs=4, type=float, metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'), help='Only process stations inside this bounding box')
+parser.add_argument('--near', nargs=3, type=float, metavar=('LAT', 'LON', 'MILES'), help='Only process stations within MILES of a point')
+parser.add_argument('--route', action='append', metavar='ROUTE[/DIR]', help='Only process stations on this corridor, e.g. I-94 or I-94/EB (may be repeated)')
+parser.add_argument('--stations', metavar='STATION_IDS', help='Only process these stations (comma separated, e.g. S1359,S1360)')
+parser.add_argument('-g', metavar='DAY_GROUP', action='append', help='Report the average speed over this group of days, e.g. weekday, weekend, holiday, weekday-holiday, jun+jul+aug or @DATE_FILE (may be repeated; default weekday)')
+parser.add_argument('--holidays', metavar='DATE_FILE', help='File of holiday dates (YYYY-MM-DD, one per line) used by the holiday day group (default US federal holidays)')
+parser.add_argument('--congestion', metavar='SPEED', type=float, help='Also find congestion events, runs of speeds below SPEED, during the time interval')
+parser.add_argument('--congestion-output', metavar='CONGESTION_FILE', type=argparse.FileType('wb'), help='Output file for the congestion events (required with --congestion)')
+parser.add_argument('--min-duration', metavar='MINUTES', type=int, default=5, help='Shortest run counted as a congestion event, in minutes (default 5)')
+parser.add_argument('--flows', metavar='FLOW_FILE', type=argparse.FileType('wb'), help='Also write the average flow (vehicles per hour) and vehicle-miles travelled per day of each station during the time interval to FLOW_FILE')
+parser.add_argument('--sample', metavar='MPH', type=float, help='Estimate the averages from a sample of days, adding days until every confidence interval is within MPH; writes the half width of each interval after each speed')
+parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the intervals with --sample (default 0.95)')
+parser.add_argument('--seed', type=int, help='Seed for choosing the sampled days with --sample')
+shard_modes = parser.add_mutually_exclusive_group()
+shard_modes.add_argument('--plan', metavar='PLAN_DIR', help='Instead of running, split the run into shard files written to PLAN_DIR')
+shard_modes.add_argument('--run-shard', metavar='SHARD_FILE', help='Run one shard of a plan, writing its partial result next to SHARD_FILE; run the stations_*.json shards of a plan after all the others')
+shard_modes.add_argument('--merge', metavar='PLAN_DIR', help='Combine the partial results of the shards in PLAN_DIR into OUTPUT_FILE')
+parser.add_argument('--shard-days', type=int, help='With --plan, number of days in each shard (default the whole date span)')
+parser.add_argument('--station-shards', type=int, help='With --plan and --shard-days, number of shards that weekly and long temporal imputation of each corridor are split into by stations (default the number of date blocks)')
 args = parser.parse_args()
 
+if args.run_shard != None:
+	required = []
+elif args.merge != None:
+	required = ['o']
+elif args.plan != None:
+	required = ['d', 'y', 'm', 's', 'e']
+else:
+	required = ['d', 'y', 'm', 's', 'e', 'o']
+for flag in required:
+	if getattr(args, flag) == None:
+		parser.error("argument -" + flag + " is required")
+if args.sample != None:
+	if args.run_shard != None or args.merge != None or args.plan != None or args.c != None:
+		parser.error("--sample cannot be used with -c, --plan, --run-shard or --merge")
+	if args.g != None and len(args.g) > 1:
+		parser.error("--sample estimates a single day group")
+	if args.congestion != None or args.flows != None:
+		parser.error("--sample cannot be used with --congestion or --flows")
+if args.congestion != None:
+	if args.run_shard != None or args.merge != None or args.plan != None:
+		parser.error("--congestion cannot be used with --plan, --run-shard or --merge")
+	if args.congestion_output == None:
+		parser.error("argument --congestion-output is required with --congestion")
+if args.flows != None:
+	if args.run_shard != None or args.merge != None or args.plan != None:
+		parser.error("--flows cannot be used with --plan, --run-shard or --merge")
+
+def write_speeds(output_file, results, day_groups):
+	# Write speeds to output file
+	w = csv.writer(output_file)
+	if day_groups == None:
+		w.writerow(['sid', 'detspeed'])
+	else:
+		w.writerow(['sid'] + day_groups)
+	for p in results.items():
+		id = s_num(p[0])
+		speeds = p[1]
+		if all(math.isnan(speed) for speed in speeds):
+			continue
+		w.writerow([id] + ['' if math.isnan(speed) else speed for speed in speeds])
+	output_file.close()
+
+def write_congestion(output_file, events, day_groups, start_time):
+	# One row per station and day group, followed by the number of events
+	# starting and ending in each 5-minute timeslot of the interval
+	w = csv.writer(output_file)
+	n_slots = 0
+	for stats in events.values():
+		n_slots = len(stats['starts'][0])
+		break
+	first_slot = mnfsc.timeslot_from_time(start_time)
+	slot_names = ['%02d%02d' % divmod(5 * (first_slot + i), 60) for i in range(n_slots)]
+	w.writerow(['sid', 'group', 'events', 'events_per_day', 'congested_minutes', 'delay_minutes']
+	           + ['start_' + name for name in slot_names]
+	           + ['end_' + name for name in slot_names])
+	for id in sorted(events.keys(), key=s_num):
+		stats = events[id]
+		# stations left out of the speed arrays have no events to report
+		if all(math.isnan(count) for count in stats['events']):
+			continue
+		for group, day_group in enumerate(day_groups):
+			# per day with valid speeds, so that days without data do not
+			# count as days without congestion
+			valid_days = stats['valid_days'][group]
+			events_per_day = stats['events'][group] / valid_days if valid_days > 0 else ''
+			w.writerow([s_num(id), day_group, int(stats['events'][group]), events_per_day,
+			            stats['congested_minutes'][group], stats['delay_minutes'][group]]
+			           + [int(count) for count in stats['starts'][group]]
+			           + [int(count) for count in stats['ends'][group]])
+	output_file.close()
+
+def write_flows(output_file, flows, vmt, day_groups):
+	# One row per station and day group
+	w = csv.writer(output_file)
+	w.writerow(['sid', 'group', 'flow', 'vmt'])
+	for id in sorted(flows.keys(), key=s_num):
+		if all(math.isnan(flow) for flow in flows[id]):
+			continue
+		for group, day_group in enumerate(day_groups):
+			w.writerow([s_num(id), day_group]
+			           + ['' if math.isnan(value) else value
+			              for value in (flows[id][group], vmt[id][group])])
+	output_file.close()
+
+if args.d != None and (args.cache_dir != None or args.fetch_workers != None):
+	# every later use of the -d location goes through this backend
+	mnfsc.open_storage(args.d, cache_dir=args.cache_dir, max_in_flight=args.fetch_workers)
+
+cube_store = None
+if args.cube_dir != None:
+	cube_store = mnfsc.CubeStore(args.cube_dir, memory_budget=args.memory_budget * 1024 * 1024)
+
+if args.run_shard != None:
+	try:
+		print "Wrote " + mnfsc.run_shard(args.run_shard, directory=args.d, workers=args.j, cube_store=cube_store)
+	except IOError as e:
+		parser.error(str(e))
+	if cube_store != None:
+		cube_store.remove()
+	sys.exit(0)
+
+if args.merge != None:
+	try:
+		day_groups, results = mnfsc.merge_shards(args.merge)
+	except (IOError, ValueError) as e:
+		parser.error(str(e))
+	write_speeds(args.o, results, day_groups)
+	if cube_store != None:
+		cube_store.remove()
+	sys.exit(0)
+
 metro_config_file = args.m
 year = args.y
 data_dir = args.d
@@ -29,21 +173,132 @@ start_time = time(hour = args.s)
 end_time = time(hour = args.e)
 output_file = args.o
 
+impute_settings = {}
+for stage in ('spatial', 'weekly', 'temporal'):
+	if getattr(args, stage) != None:
+		impute_settings[stage] = dict(zip(('impute_length', 'input_length'), getattr(args, stage)))
+
 # Calculate average speeds
 calculator = mnfsc.TMS_Config(metro_config_file)
-calculator.load_speeds_for_year(year, data_dir)
-calculator.spatial_impute()
-calculator.weekly_impute()
-calculator.long_temporal_impute()
-results = (calculator.average_weekday_speeds(start_time, end_time))
-
-# Write speeds to output file
-w = csv.writer(output_file)
-w.writerow(['sid', 'detspeed'])
-for p in results.items():
-	id = s_num(p[0])
-	speed = p[1]
-	if math.isnan(speed):
-		continue
-	w.writerow([id, speed])
-output_file.close()
+
+# Restrict the run to the selected stations. Each selection flag narrows the
+# stations chosen by the others.
+index = calculator.station_index()
+selections = []
+if args.bbox != None:
+	selections.append(('--bbox ' + ' '.join(str(value) for value in args.bbox),
+	                   index.in_bbox(*args.bbox)))
+if args.near != None:
+	selections.append(('--near ' + ' '.join(str(value) for value in args.near),
+	                   index.near(*args.near)))
+if args.route != None:
+	selections.append(('--route ' + ' --route '.join(args.route),
+	                   index.on_routes(args.route)))
+if args.stations != None:
+	selections.append(('--stations ' + args.stations,
+	                   index.with_ids(args.stations.split(','))))
+if len(selections) > 0:
+	# an empty selection would only write an empty output file
+	for selection, station_ids in selections:
+		if len(station_ids) == 0:
+			parser.error(selection + " matches no station in " + metro_config_file)
+	selected = set.intersection(*[station_ids for selection, station_ids in selections])
+	if len(selected) == 0:
+		parser.error(" and ".join(selection for selection, station_ids in selections)
+		             + " match no station together")
+	spatial = mnfsc.DEFAULT_SETTINGS['spatial'].copy()
+	spatial.update(impute_settings.get('spatial', {}))
+	calculator.select_stations(selected,
+	                           neighbours=spatial['impute_length'] + spatial['input_length'],
+	                           input_length=spatial['input_length'])
+
+day_groups = args.g
+if day_groups == None:
+	day_groups = ['weekday']
+holidays = None
+if args.holidays != None:
+	holidays = mnfsc.daymask.read_dates(args.holidays)
+# check the day groups before the long run
+try:
+	mnfsc.daymask.day_group_masks(day_groups, [], holidays)
+except ValueError as e:
+	parser.error(str(e))
+# and that a year archive given as -d holds the years of the run
+if data_dir != None:
+	try:
+		for data_year in range(year, (args.end_year or year) + 1):
+			mnfsc.open_storage(data_dir).year_archive(data_year)
+	except ValueError as e:
+		parser.error(str(e))
+
+if args.plan != None:
+	shard_files = mnfsc.plan_shards(calculator, year, data_dir, args.plan,
+	                                end_year=args.end_year,
+	                                shard_days=args.shard_days,
+	                                settings=impute_settings,
+	                                start_time=start_time,
+	                                end_time=end_time,
+	                                day_groups=args.g,
+	                                holidays=holidays,
+	                                station_shards=args.station_shards)
+	station_shard_files = [shard_file for shard_file in shard_files
+	                       if path.basename(shard_file).startswith(mnfsc.shards.STATIONS_PREFIX)]
+	print "Wrote " + str(len(shard_files)) + " shards to " + args.plan
+	print "Run each with: NexusFSCalc.py --run-shard SHARD_FILE [-d LOCAL_DIRECTORY]"
+	if len(station_shard_files) > 0:
+		print "The " + str(len(station_shard_files)) + " " + mnfsc.shards.STATIONS_PREFIX + "*.json shards read the partial results of the others from " + args.plan + ", so run them once the others have finished"
+	print "Then combine them with: NexusFSCalc.py --merge " + args.plan + " -o OUTPUT_FILE"
+	sys.exit(0)
+
+if args.sample != None:
+	estimates, n_days = calculator.sample_average_speeds(data_dir, year, day_groups[0],
+	                                                     start_time, end_time,
+	                                                     target=args.sample,
+	                                                     confidence=args.confidence,
+	                                                     end_year=args.end_year,
+	                                                     holidays=holidays,
+	                                                     settings=impute_settings,
+	                                                     seed=args.seed,
+	                                                     workers=args.j,
+	                                                     cube_store=cube_store)
+	print "Sampled " + str(n_days) + " days"
+	w = csv.writer(output_file)
+	w.writerow(['sid', 'detspeed' if args.g == None else day_groups[0], 'ci'])
+	for id, (speed, half_width) in estimates.items():
+		if math.isnan(speed):
+			continue
+		w.writerow([s_num(id), speed, '' if math.isnan(half_width) else half_width])
+	output_file.close()
+	sys.exit(0)
+
+pipeline = mnfsc.Pipeline(calculator, year, data_dir,
+                          checkpoint_dir=args.c,
+                          batch_days=args.batch_days,
+                          settings=impute_settings,
+                          workers=args.j,
+                          end_year=args.end_year,
+                          cube_store=cube_store,
+                          volumes=args.flows != None)
+try:
+	pipeline.run(restart_from=args.restart_from)
+except ValueError as e:
+	# a checkpoint written for another run
+	parser.error(str(e))
+# Average over every day group in one pass over the speeds
+day_masks = mnfsc.daymask.day_group_masks(day_groups, calculator.dates(), holidays)
+results = calculator.average_speeds_for_day_groups(day_masks, start_time, end_time)
+
+write_speeds(output_file, results, args.g)
+
+if args.congestion != None:
+	events = calculator.congestion_events(args.congestion, day_masks, start_time, end_time,
+	                                      min_minutes=args.min_duration)
+	write_congestion(args.congestion_output, events, day_groups, start_time)
+
+if args.flows != None:
+	flows = calculator.average_flows_for_day_groups(day_masks, start_time, end_time)
+	vmt = calculator.vmt_for_day_groups(day_masks, start_time, end_time)
+	write_flows(args.flows, flows, vmt, day_groups)
+
+if cube_store != None:
+	cube_store.remove()
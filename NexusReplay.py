@@ -0,0 +1,105 @@
+import mnfspeedcalc as mnfsc
+from mnfspeedcalc.stream import SAMPLES_PER_DAY, DEFAULT_WINDOWS
+from numpy import array, isnan
+import argparse
+from datetime import datetime, timedelta
+from os import path
+import time
+
+def parse_date(text):
+	return datetime.strptime(text, '%Y-%m-%d').date()
+
+program_description = "Replays historic .traffic files through the streaming speed engine at accelerated speed and reports rolling station speeds"
+
+parser = argparse.ArgumentParser(prog="NexusReplay.py", version="0.1.0", description=program_description)
+parser.add_argument('-d', metavar='DIRECTORY', required=True, help='Directory holding .traffic files or year archives')
+parser.add_argument('-m', metavar='METRO_CONFIG', required=True, help='Path to metro_config.xml')
+parser.add_argument('-b', metavar='FIRST_DAY', type=parse_date, required=True, help='First day to replay (YYYY-MM-DD)')
+parser.add_argument('-e', metavar='LAST_DAY', type=parse_date, help='Last day to replay (YYYY-MM-DD, default FIRST_DAY)')
+parser.add_argument('--speedup', type=float, default=0, help='Replay this many times faster than real time (default 0: as fast as possible)')
+parser.add_argument('-r', metavar='MINUTES', type=int, default=60, help='Report every MINUTES minutes of replayed time (default 60)')
+parser.add_argument('-w', metavar='WINDOW', type=int, action='append', help='Rolling window length in minutes (may be repeated, default 15 and 60)')
+parser.add_argument('-c', metavar='CHECKPOINT_FILE', help='Save the engine state here at every report; an interrupted replay resumes from it')
+parser.add_argument('--stations', metavar='STATION_IDS', help='Report these stations (comma separated) instead of a summary')
+args = parser.parse_args()
+
+last_day = args.e
+if last_day == None:
+	last_day = args.b
+windows = args.w
+if windows == None:
+	windows = DEFAULT_WINDOWS
+
+calculator = mnfsc.TMS_Config(args.m)
+if args.c != None and path.isfile(args.c):
+	try:
+		engine = mnfsc.load_stream_engine(args.c, calculator)
+	except ValueError as e:
+		parser.error(str(e))
+	print "Resuming after " + str(engine.day) + " sample " + str(engine.next_sample)
+else:
+	engine = mnfsc.StreamEngine(calculator, windows=windows)
+
+report_stations = None
+if args.stations != None:
+	report_stations = []
+	for station_id in args.stations.split(','):
+		if station_id not in engine.station_ids:
+			parser.error("Unknown station: " + station_id)
+		report_stations.append(engine.station_row(station_id))
+
+def report(day, sample_index):
+	clock = datetime.combine(day, datetime.min.time()) + timedelta(seconds=30 * (sample_index + 1))
+	averages = engine.rolling_averages()
+	if report_stations == None:
+		fields = ["%d stations" % (~isnan(engine.fivemin_speeds)).sum()]
+		for window in engine.windows:
+			fields.append("%d min mean %.1f" % (window, nanmean(averages[window])))
+	else:
+		fields = []
+		for row in report_stations:
+			fields.append(engine.station_ids[row] + " " + " / ".join(
+				"%.1f" % averages[window][row] for window in engine.windows))
+	print clock.strftime('%Y-%m-%d %H:%M') + "  " + ", ".join(fields)
+
+def nanmean(values):
+	valid = values[~isnan(values)]
+	if len(valid) == 0:
+		return float('nan')
+	return valid.mean()
+
+day = args.b
+if engine.day != None and engine.day > day:
+	day = engine.day
+started = time.time()
+replayed = 0
+while day <= last_day:
+	try:
+		tr = mnfsc.open_traffic_day(args.d, day)
+	except IOError as e:
+		if not mnfsc.trafficreader.is_missing(e):
+			raise
+		print "No data for " + str(day)
+		day += timedelta(days=1)
+		continue
+
+	# decode each detector once for the day; the engine is then fed one tick
+	# of every detector at a time, as a live feed would deliver them
+	volumes = array([tr.volumes_for_detector(detector_id) for detector_id in engine.detector_ids]).reshape(-1, SAMPLES_PER_DAY)
+	occupancies = array([tr.occupancies_for_detector(detector_id) for detector_id in engine.detector_ids]).reshape(-1, SAMPLES_PER_DAY)
+
+	first_sample = 0
+	if engine.day == day:
+		first_sample = engine.next_sample
+	for sample_index in range(first_sample, SAMPLES_PER_DAY):
+		engine.ingest_tick(day, sample_index, volumes[:, sample_index], occupancies[:, sample_index])
+		replayed += 1
+		if args.speedup > 0:
+			delay = started + (replayed * 30 / args.speedup) - time.time()
+			if delay > 0:
+				time.sleep(delay)
+		if (sample_index + 1) % (2 * args.r) == 0:
+			report(day, sample_index)
+			if args.c != None:
+				engine.save(args.c)
+	day += timedelta(days=1)
@@ -1,6 +1,6 @@
 from __future__ import division
 from datetime import date, timedelta, time
-from trafficreader import TrafficReader
+from trafficreader import TrafficReader, open_traffic_day, open_storage, is_missing
 from os import path
 from collections import deque
 from numpy import *
@@ -8,6 +8,18 @@ from pprint import pprint
 import cProfile
 import pstats
 import impute
+import parallel
+import daymask
+import cubestore
+import congestion
+import sampling
+import loader
+from loader import reduce_minute_speeds
+from pipeline import Pipeline, STAGES, DEFAULT_SETTINGS
+from selection import StationIndex, distance_miles
+from cubestore import CubeStore
+from shards import plan_shards, run_shard, merge_shards
+from stream import StreamEngine, load_stream_engine
 import xml.etree.cElementTree as ET
 
 def avg_list(inputlist):
@@ -36,6 +48,98 @@ def index_of_first_monday_in_year(year):
         if (test_date + (one_day * index)).weekday() == 0:
             return index
 
+def spatial_impute_block(speeds, impute_length, input_length):
+    '''
+    Imputes values along the station axis of a (station, day, timeslot) speed
+    array
+    '''
+    # days without any valid speed, such as days whose .traffic file is
+    # missing, have nothing to impute from; leave them out of the pass
+    days = nonzero(~isnan(speeds).all(axis=(0, 2)))[0]
+    if len(days) == 0:
+        return speeds
+    if len(days) < speeds.shape[1]:
+        speeds[:, days] = spatial_impute_block(speeds[:, days], impute_length, input_length)
+        return speeds
+
+    # every (day, timeslot) pair is one series along the spatial axis
+    # (dimension 0); impute them all at once
+    series = speeds.transpose(1, 2, 0).reshape(-1, speeds.shape[0])
+    impute.impute_range_array(series,
+                              impute_length=impute_length,
+                              input_length=input_length)
+    speeds[:] = series.reshape(speeds.shape[1], speeds.shape[2], speeds.shape[0]).transpose(2, 0, 1)
+    return speeds
+
+def weekly_impute_block(week_speeds, impute_length, input_length):
+    '''
+    Imputes values along the same day of the week of a (station, week, day of
+    week, timeslot) speed array
+    '''
+    # stations without any valid speed in the block, such as stations whose
+    # detectors sent no data all year, have nothing to impute from; leave
+    # them out of the pass
+    stations = nonzero(~isnan(week_speeds).all(axis=(1, 2, 3)))[0]
+    if len(stations) == 0:
+        return week_speeds
+    if len(stations) < week_speeds.shape[0]:
+        week_speeds[stations] = weekly_impute_block(week_speeds[stations], impute_length,
+                                                    input_length)
+        return week_speeds
+
+    # every (station, day of week, timeslot) is one series along the weeks
+    # (dimension 1). impute one day of the week at a time, which keeps the
+    # working arrays small.
+    n_stations, n_weeks, n_weekdays, n_slots = week_speeds.shape
+    for weekday in range(n_weekdays):
+        series = week_speeds[:, :, weekday, :].transpose(0, 2, 1).reshape(-1, n_weeks)
+        impute.impute_range_array(series,
+                                  impute_length=impute_length,
+                                  input_length=input_length)
+        week_speeds[:, :, weekday, :] = series.reshape(n_stations, n_slots, n_weeks).transpose(0, 2, 1)
+    return week_speeds
+
+def long_temporal_impute_block(speeds, impute_length, input_length):
+    '''
+    Imputes values along the timeslot axis of a (station, day, timeslot) speed
+    array
+    '''
+    # speed array dimensions: station, day, time
+    # every (station, day) pair is one series. the days of a station without
+    # any valid speed, left by missing .traffic files that weekly imputation
+    # could not fill, have nothing to impute from; leave them out of the pass
+    series = speeds.reshape(-1, speeds.shape[2])
+    present = nonzero(~isnan(series).all(axis=1))[0]
+    if len(present) < len(series):
+        series[present] = impute.impute_range_array(series[present],
+                                                    impute_length=impute_length,
+                                                    input_length=input_length)
+    else:
+        impute.impute_range_array(series,
+                                  impute_length=impute_length,
+                                  input_length=input_length)
+    speeds[:] = series.reshape(speeds.shape)
+    return speeds
+
+def window_timeslots(start_time=None, end_time=None):
+    '''
+    Returns the (first, last) timeslot indices, last exclusive, of the time
+    interval from start_time to end_time. Without times, the interval is the
+    whole day.
+    '''
+    # if no times were passed, average for the whole day
+    if start_time == None:
+        start_time = time(0, 0, 0)
+    if end_time == None:
+        end_time = time(23, 59, 59)
+
+    # make sure times are valid
+    if start_time > end_time:
+        raise ValueError("Start time must be before end time")
+
+    # convert times to timeslot indices
+    return timeslot_from_time(start_time), timeslot_from_time(end_time)
+
 class TMS_Config:
 
     def __init__(self, metro_config_file=None, verbose=False):
@@ -43,6 +147,9 @@ class TMS_Config:
         if self._verbose:
             print "Creating tms_config node " + str(self)
 
+        self._station_index = None
+        self.cube_store = None
+
         if metro_config_file != None:
             self.init_from_metro_config_file(metro_config_file)
         else:
@@ -71,6 +178,33 @@ class TMS_Config:
     def corridors(self):
         return self.corridor_list
 
+    def station_index(self):
+        '''
+        Returns a StationIndex over the stations of all corridors
+        '''
+        if self._station_index == None:
+            self._station_index = StationIndex(self.corridor_list)
+        return self._station_index
+
+    def select_stations(self, station_ids, neighbours=5, input_length=1):
+        '''
+        Restricts loading, imputation and averaging to the stations with the
+        given IDs. The stations spatial_impute reads to fill the selected
+        stations are kept as well (see Corridor.select_stations); the
+        defaults match the default spatial imputation settings, with
+        neighbours = impute_length + input_length. Corridors are split where
+        the kept stations are not contiguous.
+        '''
+        selected = set(station_ids)
+        corridor_list = []
+        for corridor in self.corridor_list:
+            corridor_list.extend(corridor.select_stations(selected, neighbours, input_length))
+
+        if self._verbose:
+            print str(self) + " selected " + str(len(selected)) + " stations in " + str(len(corridor_list)) + " corridors"
+        self.corridor_list = corridor_list
+        self._station_index = None
+
     def load_speeds(self, traffic_file):
         traffic_reader = TrafficReader(traffic_file)
         for corridor in self.corridor_list:
@@ -84,17 +218,89 @@ class TMS_Config:
         for corridor in self.corridor_list:
             corridor.print_speeds()
 
-    def spatial_impute(self):
+    def allocate_speeds_for_year(self, year, cube_store=None):
+        self.allocate_speeds_for_years(year, year, cube_store)
+
+    def allocate_speeds_for_years(self, first_year, last_year, cube_store=None):
+        '''
+        Creates empty speed arrays covering first_year to last_year. If
+        cube_store (a cubestore.CubeStore) is given, the arrays are memory
+        mapped from disk and the passes over them are limited to its memory
+        budget.
+        '''
+        self.cube_store = cube_store
+        for corridor in self.corridor_list:
+            corridor.allocate_speeds_for_years(first_year, last_year, cube_store)
+
+    def allocate_speeds_for_dates(self, first_date, n_days, cube_store=None):
+        '''
+        Creates empty speed arrays covering n_days days from first_date (see
+        allocate_speeds_for_years)
+        '''
+        self.cube_store = cube_store
+        for corridor in self.corridor_list:
+            corridor.allocate_speeds_for_dates(first_date, n_days, cube_store)
+
+    def _max_block_bytes(self, workers=1):
+        if self.cube_store == None:
+            return None
+        return self.cube_store.block_bytes(workers)
+
+    def track_volumes(self, track=True):
+        '''
+        Carries the 5-minute station volumes through loading and imputation
+        alongside the speeds, for the flow and VMT averages. Call before
+        allocating.
+        '''
+        for corridor in self.corridor_list:
+            corridor.track_volumes = track
+
+    def drop_dead_stations(self, reach):
+        '''
+        Leaves the stations that can never get a valid speed out of the speed
+        arrays (see Corridor.drop_dead_stations). Call before allocating.
+        '''
+        for corridor in self.corridor_list:
+            corridor.drop_dead_stations(reach)
+
+    def load_speeds_for_days(self, directory, first_day, last_day):
+        '''
+        Loads speeds for days first_day (inclusive) to last_day (exclusive)
+        into the speed arrays of every corridor, reading each .traffic file
+        and calculating the speeds of each detector once (see loader)
+        '''
+        loader.load_speeds_for_days(self.corridor_list, directory, first_day, last_day,
+                                    self._max_block_bytes())
+
+    def load_speeds_for_dates(self, directory, dates):
+        '''
+        Loads the speeds of each of dates, which need not be consecutive, into
+        consecutive days of the speed arrays of every corridor from the first
+        (see loader.load_speeds_for_dates)
+        '''
+        loader.load_speeds_for_dates(self.corridor_list, directory, dates, 0,
+                                     self._max_block_bytes())
+
+    def spatial_impute(self, workers=1, **settings):
+        jobs = []
         for corridor in self.corridor_list:
-            corridor.spatial_impute()
+            if len(corridor.station_rows) > 0:
+                jobs.extend(corridor.spatial_impute_jobs(**settings))
+        parallel.run_blocks(jobs, workers, self._max_block_bytes(workers))
 
-    def weekly_impute(self):
+    def weekly_impute(self, workers=1, **settings):
+        jobs = []
         for corridor in self.corridor_list:
-            corridor.weekly_impute()
+            if len(corridor.station_rows) > 0:
+                jobs.extend(corridor.weekly_impute_jobs(**settings))
+        parallel.run_blocks(jobs, workers, self._max_block_bytes(workers))
 
-    def long_temporal_impute(self):
+    def long_temporal_impute(self, workers=1, **settings):
+        jobs = []
         for corridor in self.corridor_list:
-            corridor.long_temporal_impute()
+            if len(corridor.station_rows) > 0:
+                jobs.extend(corridor.long_temporal_impute_jobs(**settings))
+        parallel.run_blocks(jobs, workers, self._max_block_bytes(workers))
 
     def average_weekday_speeds(self, start_time=None, end_time=None):
         '''
@@ -106,6 +312,115 @@ class TMS_Config:
 
         return average_speeds
 
+    def sample_average_speeds(self, directory, year, day_group='weekday',
+                              start_time=None, end_time=None, target=1.0,
+                              confidence=0.95, end_year=None, holidays=None,
+                              settings=None, max_days=None, seed=None, workers=1,
+                              cube_store=None):
+        '''
+        Estimates the average speed of every station over the days of
+        day_group (see daymask) from year to end_year (default year) during
+        the specified time interval from a stratified sample of those days,
+        adding days until every confidence interval at the given level is
+        within target mph of its estimate (see sampling.DaySampler). Returns a
+        tuple (estimates, n_days) where estimates maps station ids to an array
+        holding the estimate and the half width of its interval and n_days is
+        the number of days sampled. The speed arrays of the sampled days are
+        memory mapped from cube_store if it is given.
+        '''
+        if end_year == None:
+            end_year = year
+        first_date = date(year, 1, 1)
+        n_days = (date(end_year, 12, 31) - first_date).days + 1
+        day_mask = daymask.day_group_mask(day_group,
+                                          daymask.dates_from_start(first_date, n_days),
+                                          holidays)
+        sampler = sampling.DaySampler(self, directory, first_date, n_days, day_mask,
+                                      start_time, end_time, settings, seed, workers,
+                                      self._verbose, cube_store)
+        estimates = sampler.run(target, confidence, max_days=max_days)
+        return estimates, sampler.n_sampled()
+
+    def dates(self):
+        '''
+        Returns the list of dates along the day axis of the speed arrays
+        '''
+        for corridor in self.corridor_list:
+            return corridor.dates()
+        return []
+
+    def average_speeds_for_day_groups(self, day_masks, start_time=None, end_time=None):
+        '''
+        Returns a dictionary mapping station ids to an array holding the
+        average speed of that station during the specified time interval for
+        each day group. day_masks is a (groups x days) boolean array over
+        dates() (see daymask.day_group_masks).
+        '''
+        average_speeds = {}
+        for corridor in self.corridor_list:
+            average_speeds.update(corridor.average_speeds_for_day_groups(day_masks, start_time, end_time))
+
+        return average_speeds
+
+    def average_weekday_flows(self, start_time=None, end_time=None):
+        '''
+        Returns a dictionary mapping station ids to the average weekday flow for that station during the specified time interval
+        '''
+        average_flows = {}
+        for corridor in self.corridor_list:
+            average_flows.update(corridor.average_weekday_flows(start_time, end_time))
+
+        return average_flows
+
+    def average_flows_for_day_groups(self, day_masks, start_time=None, end_time=None):
+        '''
+        Returns a dictionary mapping station ids to an array holding the
+        average flow of that station, in vehicles per hour, during the
+        specified time interval for each day group (see
+        Corridor.average_flows_for_day_groups)
+        '''
+        average_flows = {}
+        for corridor in self.corridor_list:
+            average_flows.update(corridor.average_flows_for_day_groups(day_masks, start_time, end_time))
+
+        return average_flows
+
+    def weekday_vmt(self, start_time=None, end_time=None):
+        '''
+        Returns a dictionary mapping station ids to the vehicle-miles travelled on an average weekday over the road that station stands for during the specified time interval
+        '''
+        vmt = {}
+        for corridor in self.corridor_list:
+            vmt.update(corridor.weekday_vmt(start_time, end_time))
+
+        return vmt
+
+    def vmt_for_day_groups(self, day_masks, start_time=None, end_time=None):
+        '''
+        Returns a dictionary mapping station ids to an array holding the
+        vehicle-miles travelled on an average day of each day group during
+        the specified time interval (see Corridor.vmt_for_day_groups)
+        '''
+        vmt = {}
+        for corridor in self.corridor_list:
+            vmt.update(corridor.vmt_for_day_groups(day_masks, start_time, end_time))
+
+        return vmt
+
+    def congestion_events(self, threshold, day_masks, start_time=None,
+                          end_time=None, min_minutes=5):
+        '''
+        Returns a dictionary mapping station ids to the statistics of their
+        congestion events for each day group (see Corridor.congestion_events)
+        '''
+        events = {}
+        for corridor in self.corridor_list:
+            if len(corridor.station_rows) > 0:
+                events.update(corridor.congestion_events(threshold, day_masks, start_time,
+                                                         end_time, min_minutes))
+
+        return events
+
 class Corridor:
 
     def __init__(self, corridor_node=None, verbose=False):
@@ -121,8 +436,19 @@ class Corridor:
             self._route = ""
             self._dir = ""
             self.station_list = []
+            self.station_indices = {}
+            self.station_rows = []
             self._node = None
 
+        # IDs of the stations to report averages for, or None for all stations
+        self.selected_ids = None
+        # largest block of the speed array a pass may hold in memory, or None
+        # for no limit
+        self.max_block_bytes = None
+        # whether a volume array is allocated, loaded and imputed alongside
+        # the speed array
+        self.track_volumes = False
+
     def init_from_corridor_node(self, corridor_node):
         if self._verbose:
             print str(self) + " loading from node: " + str(corridor_node)
@@ -141,10 +467,43 @@ class Corridor:
         for station_node in self._node.findall("r_node[@n_type='Station'][@station_id]"):
             self.add_station(Station(station_node, self._verbose))
 
+        self.index_stations()
+
+    def index_stations(self):
         # build dictionary for mapping station index > id
         self.station_indices = {}
         for i in range(len(self.station_list)):
             self.station_indices[i] = self.station_list[i].id
+        # indices of the stations with a row in the speed array, in order.
+        # every station has one until drop_dead_stations is called.
+        self.station_rows = range(len(self.station_list))
+
+    def drop_dead_stations(self, reach):
+        '''
+        Leaves the stations without detectors that are more than reach
+        stations away from every station with detectors out of the speed
+        array. Spatial imputation with impute_length + input_length <= reach
+        never fills these stations or reads them as input, so they would stay
+        invalid through every pass; they are reported as invalid without
+        taking up rows. Call before allocating the speed array.
+
+        Days a station has no data for, such as days whose .traffic file is
+        missing, keep their rows: weekly imputation fills them from the same
+        day in other weeks, so they are written to after all. The imputation
+        passes leave out the days and stations that have no valid speed to
+        impute from.
+        '''
+        n_stations = len(self.station_list)
+        kept = zeros(n_stations + 1, dtype=int)
+        for i in range(n_stations):
+            if len(self.station_list[i].detectors()) > 0:
+                kept[max(0, i - reach)] += 1
+                kept[min(n_stations, i + reach + 1)] -= 1
+        self.station_rows = list(nonzero(cumsum(kept[:n_stations]) > 0)[0])
+
+    def _row_of_station(self):
+        # maps station indices to their rows in the speed array
+        return dict((station_index, row) for row, station_index in enumerate(self.station_rows))
 
     def add_station(self, station):
         self.station_list.append(station)
@@ -152,120 +511,419 @@ class Corridor:
     def stations(self):
         return self.station_list
 
+    def select_stations(self, selected, neighbours=5, input_length=1):
+        '''
+        Returns a list of corridors holding the stations of this corridor whose
+        IDs are in selected, plus the stations spatial imputation with
+        impute_length + input_length = neighbours reads to fill them: up to
+        neighbours stations either side of each of them, and further out
+        wherever runs of stations without detectors lie in between (see
+        _spatial_extent). Each returned corridor is a contiguous run of
+        stations.
+
+        The selected stations get the same spatial fills as in a run over the
+        whole corridor wherever speeds are missing because stations have no
+        detectors. Where stations with detectors are missing data, a chain of
+        gaps, each read as input by the next, can still reach past the kept
+        stations and change the fills near them.
+        '''
+        n_stations = len(self.station_list)
+        extents = []
+        for i in range(n_stations):
+            if self.station_list[i].id not in selected:
+                continue
+            first, last = self._spatial_extent(i, input_length)
+            extents.append([min(first, max(0, i - neighbours)),
+                            max(last, min(n_stations, i + neighbours + 1))])
+
+        blocks = []
+        for first, last in sorted(extents):
+            # merge with the previous block if they touch
+            if len(blocks) > 0 and first <= blocks[-1][1]:
+                blocks[-1][1] = max(blocks[-1][1], last)
+            else:
+                blocks.append([first, last])
+
+        corridors = []
+        for first, last in blocks:
+            corridor = Corridor(verbose=self._verbose)
+            corridor._route = self._route
+            corridor._dir = self._dir
+            corridor._node = self._node
+            corridor.station_list = self.station_list[first:last]
+            corridor.index_stations()
+            corridor.track_volumes = self.track_volumes
+            corridor.selected_ids = set(station.id for station in corridor.station_list
+                                        if station.id in selected)
+            corridors.append(corridor)
+
+        return corridors
+
+    def _spatial_extent(self, i, input_length):
+        # the (first, last) stations, last exclusive, that spatial imputation
+        # reads to fill station i when the stations without detectors are the
+        # ones missing: the input_length stations past the far end of a run
+        # of such stations reaching i on the right, and on the left, the
+        # input_length stations before it. where those include another run,
+        # its fill is an input too, so the run before it is followed in turn.
+        live = [len(station.detectors()) > 0 for station in self.station_list]
+        n_stations = len(live)
+
+        end = i
+        while end < n_stations and not live[end]:
+            end += 1
+        last = min(n_stations, end + input_length)
+
+        start = i
+        while start > 0 and not live[start - 1]:
+            start -= 1
+        if start == i and live[i]:
+            return i, last
+        while start > 0:
+            first = max(0, start - input_length)
+            j = start - 1
+            while j >= first and live[j]:
+                j -= 1
+            if j < first:
+                return first, last
+            start = j
+            while start > 0 and not live[start - 1]:
+                start -= 1
+        return 0, last
+
     def load_speeds(self, traffic_reader):
         for station in self.station_list:
             station.load_speeds(traffic_reader)
 
     def load_speeds_for_year(self, year, directory):
-        self.year = year
-        current_day = date(year, 1,1)
-        last_day = date(year, 12, 31)
-        n_days = (last_day - current_day).days
+        self.allocate_speeds_for_year(year)
+        self.load_speeds_for_days(directory, 0, self.speeds.shape[1])
+
+    def allocate_speeds_for_year(self, year, cube_store=None):
+        '''
+        Creates an empty (all invalid) speed array covering the given year
+        '''
+        self.allocate_speeds_for_years(year, year, cube_store)
 
-        # create 3D array to hold speeds
+    def allocate_speeds_for_years(self, first_year, last_year, cube_store=None):
+        '''
+        Creates an empty (all invalid) speed array covering first_year to
+        last_year. If cube_store is given, the array is memory mapped from a
+        file it allocates.
+        '''
+        current_day = date(first_year, 1,1)
+        last_day = date(last_year, 12, 31)
+        n_days = (last_day - current_day).days + 1
+        self.allocate_speeds_for_dates(current_day, n_days, cube_store)
+
+    def allocate_speeds_for_dates(self, first_date, n_days, cube_store=None):
+        '''
+        Creates an empty (all invalid) speed array covering n_days days from
+        first_date
+        '''
+        self.year = first_date.year
+        self.first_date = first_date
+
+        # create 3D array to hold speeds, padded to whole weeks
         # dimensions: station (in spatial order), date, timeslot (288 5-min slots)
-        self.speeds = empty((len(self.station_list), n_days, 288), dtype=object)
+        n_weeks = -(-n_days // 7)
+        shape = (len(self.station_rows), n_weeks * 7, 288)
+        if cube_store != None:
+            padded_speeds = cube_store.allocate(shape, (self, 'speeds'))
+            self.max_block_bytes = cube_store.block_bytes()
+        else:
+            padded_speeds = empty(shape)
+            padded_speeds[:] = NAN
+            self.max_block_bytes = None
+
+        # the same array viewed by calendar day and by week. day i is
+        # first_date + i, and is day i % 7 of week i // 7. the padding days
+        # after the last date stay invalid: they end every weekly series, so
+        # weekly imputation never fills them or reads them as input.
+        self.speeds = padded_speeds[:, :n_days, :]
+        self.week_speeds = padded_speeds.reshape(shape[0], n_weeks, 7, 288)
+
+        # the 5-minute station volumes, laid out the same way
+        if self.track_volumes:
+            if cube_store != None:
+                padded_volumes = cube_store.allocate(shape, (self, 'volumes'))
+            else:
+                padded_volumes = empty(shape)
+                padded_volumes[:] = NAN
+            self.volumes = padded_volumes[:, :n_days, :]
+            self.week_volumes = padded_volumes.reshape(shape[0], n_weeks, 7, 288)
 
-        for i in range(len(self.station_list)):
-            self.speeds[i,:,:] = self.station_list[i].load_speeds_for_year(year, directory)
+    def cubes(self):
+        '''
+        Returns a list of (name, array) pairs of the (station, day, timeslot)
+        arrays of this corridor: the speeds and, if tracked, the volumes
+        '''
+        if self.track_volumes:
+            return [('speeds', self.speeds), ('volumes', self.volumes)]
+        return [('speeds', self.speeds)]
+
+    def load_speeds_for_days(self, directory, first_day, last_day):
+        '''
+        Loads speeds for days first_day (inclusive) to last_day (exclusive),
+        counted from the first allocated date, into the speed array
+        '''
+        loader.load_speeds_for_days([self], directory, first_day, last_day,
+                                    self.max_block_bytes)
 
     def print_speeds(self):
         print "Speeds for corridor ", self._route, self._dir
-        for station_index in range(self.speeds.shape[0]):
-            station_id = self.station_indices[station_index]
+        for row in range(self.speeds.shape[0]):
+            station_id = self.station_indices[self.station_rows[row]]
             print "  Speeds for station ", station_id
             for day_index in range(self.speeds.shape[1]):
                 print "    Speeds for day ", day_index
-                print self.speeds[station_index, day_index, :]
+                print self.speeds[row, day_index, :]
+
+    def _max_block_bytes(self, workers=1):
+        if self.max_block_bytes == None:
+            return None
+        return max(1, self.max_block_bytes // max(1, workers))
 
-    def spatial_impute(self):
+    def spatial_impute(self, impute_length=4, input_length=1, workers=1):
         # if there are no stations in this corridor, don't do anything
-        if len(self.station_list) == 0:
+        if len(self.station_rows) == 0:
             return
 
-        # dimension 1 of speeds array is day
-        speeds = self.speeds
-        for day in range(speeds.shape[1]):
-            # dimension 2 of speeds array is timeslot
-            for timeslot in range(speeds.shape[2]):
-                # impute values along the spatial axis (dimension 0)
-                speeds[:, day, timeslot] = impute.impute_range(list(speeds[:, day, timeslot]),
-                                                                    impute_length=4,
-                                                                    input_length=1)
-
-    def weekly_impute(self):
+        parallel.run_blocks(self.spatial_impute_jobs(impute_length, input_length), workers,
+                            self._max_block_bytes(workers))
+
+    def spatial_impute_job(self, impute_length=4, input_length=1, values=None):
+        # every (day, timeslot) is imputed independently, so the speeds (or
+        # values, an array laid out like them) can be split along the day
+        # axis (dimension 1)
+        if values is None:
+            values = self.speeds
+        return (spatial_impute_block, values, 1,
+                {'impute_length': impute_length, 'input_length': input_length})
+
+    def spatial_impute_jobs(self, impute_length=4, input_length=1):
+        # the volumes, if tracked, go through the same passes as the speeds
+        return [self.spatial_impute_job(impute_length, input_length, values)
+                for name, values in self.cubes()]
+
+    def weekly_impute(self, impute_length=3, input_length=2, workers=1):
         # if there are no station in this corridor, don't do anytihng
-        if len(self.station_list) == 0:
+        if len(self.station_rows) == 0:
             return
 
-        # dimension 1 is day
-        # using the first 7 days as starting points, impute over station and time slot for every seventh day
-        speeds = self.speeds
-        for start_day in range(7):
-            # dimension 0 is station
-            for station in range(speeds.shape[0]):
-                # dimension 2 is timeslot
-                for timeslot in range(speeds.shape[2]):
-                    speeds[station, start_day::7, timeslot] = impute.impute_range(list(speeds[station, start_day::7, timeslot]),
-                                                                                       impute_length=3,
-                                                                                       input_length=2)
-
-    def long_temporal_impute(self):
+        parallel.run_blocks(self.weekly_impute_jobs(impute_length, input_length), workers,
+                            self._max_block_bytes(workers))
+
+    def weekly_impute_job(self, impute_length=3, input_length=2, week_values=None):
+        # every (station, day of week, timeslot) is imputed independently, so
+        # the week-aligned speeds (or week_values) can be split along the
+        # station axis (dimension 0), each block holding whole weeks of its
+        # stations
+        if week_values is None:
+            week_values = self.week_speeds
+        return (weekly_impute_block, week_values, 0,
+                {'impute_length': impute_length, 'input_length': input_length})
+
+    def weekly_impute_jobs(self, impute_length=3, input_length=2):
+        jobs = [self.weekly_impute_job(impute_length, input_length)]
+        if self.track_volumes:
+            jobs.append(self.weekly_impute_job(impute_length, input_length, self.week_volumes))
+        return jobs
+
+    def long_temporal_impute(self, impute_length=6, input_length=6, workers=1):
         # if there are no staions in this corridor don't do anything
-        if len(self.station_list) == 0:
+        if len(self.station_rows) == 0:
             return
 
-        # speed array dimensions: station, day, time
-        speeds = self.speeds
-        for station in range(speeds.shape[0]):
-            for day in range(speeds.shape[1]):
-                speeds[station, day, :] = impute.impute_range(list(speeds[station, day, :]),
-                                                                   impute_length=6,
-                                                                   input_length=6)
+        parallel.run_blocks(self.long_temporal_impute_jobs(impute_length, input_length), workers,
+                            self._max_block_bytes(workers))
+
+    def long_temporal_impute_job(self, impute_length=6, input_length=6, values=None):
+        # every (station, day) is imputed independently, so the speeds (or
+        # values) can be split along the station axis (dimension 0)
+        if values is None:
+            values = self.speeds
+        return (long_temporal_impute_block, values, 0,
+                {'impute_length': impute_length, 'input_length': input_length})
+
+    def long_temporal_impute_jobs(self, impute_length=6, input_length=6):
+        return [self.long_temporal_impute_job(impute_length, input_length, values)
+                for name, values in self.cubes()]
+
+    def dates(self):
+        '''
+        Returns the list of dates along the day axis of the speed array
+        '''
+        return daymask.dates_from_start(self.first_date, self.speeds.shape[1])
 
     def average_weekday_speeds(self, start_time=None, end_time=None):
         '''
         Returns a dictionary mapping station ids to the average weekday speed for that station during the specified time interval
         '''
-        # if no times were passed, average for the whole day
-        if start_time == None:
-            start_time = time(0, 0, 0)
-        if end_time == None:
-            end_time = time(23, 59, 59)
-
-        # make sure times are valid
-        if start_time > end_time:
-            raise ValueError("Start time must be before end time")
+        weekdays = daymask.weekday_mask(self.dates()).reshape(1, -1)
+        group_speeds = self.average_speeds_for_day_groups(weekdays, start_time, end_time)
+        return dict((id, speeds[0]) for id, speeds in group_speeds.items())
 
+    def average_weekday_speed_for_station(self, station_index, start_time=None, end_time=None):
+        '''
+        For the specified station in this corridor, returns a single speed that represents the average of all valid speeds on weekdays between start_time and end_time.
+        '''
+        row = self._row_of_station().get(station_index)
+        if row == None:
+            return NAN
+        weekdays = daymask.weekday_mask(self.dates()).reshape(1, -1)
+        return self._group_speeds(self.speeds[row:row+1],
+                                  weekdays, start_time, end_time)[0, 0]
+
+    def average_speeds_for_day_groups(self, day_masks, start_time=None, end_time=None):
+        '''
+        Returns a dictionary mapping station ids to an array holding the
+        average speed of that station during the specified time interval for
+        each day group. day_masks is a (groups x days) boolean array selecting
+        the days of each group (see daymask.day_group_masks).
+        '''
+        return self._selected_station_dict(self._group_speeds(self.speeds, day_masks,
+                                                              start_time, end_time))
+
+    def _selected_station_dict(self, station_values):
+        # maps the ids of the selected stations to their rows of station_values,
+        # which has one row per row of the speed array. stations left out of
+        # the speed array get a row of NAN.
+        rows = self._row_of_station()
+        dead_values = empty(station_values.shape[1:])
+        dead_values[:] = NAN
         speed_dict = {}
-        for station_index in range(self.speeds.shape[0]):
+        for station_index in range(len(self.station_list)):
             id = self.station_indices[station_index]
-            speed_dict[id] = self.average_weekday_speed_for_station(station_index, start_time, end_time)
+            if self.selected_ids != None and id not in self.selected_ids:
+                continue
+            if station_index in rows:
+                speed_dict[id] = station_values[rows[station_index]]
+            else:
+                speed_dict[id] = dead_values.copy()
 
         return speed_dict
 
-    def average_weekday_speed_for_station(self, station_index, start_time=None, end_time=None):
+    def station_lengths(self):
         '''
-        For the specified station in this corridor, returns a single speed that represents the average of all valid speeds on weekdays between start_time and end_time.
+        Returns an array of the length of road, in miles, that each row of the
+        speed array stands for: half the distance to the station before it
+        plus half the distance to the station after it. A corridor of a
+        single station has no length to measure, so it gets NAN.
+        '''
+        lats = array([station._latlon[0] for station in self.station_list], dtype=float)
+        lons = array([station._latlon[1] for station in self.station_list], dtype=float)
+        gaps = distance_miles(lats[:-1], lons[:-1], lats[1:], lons[1:])
+        lengths = zeros(len(self.station_list))
+        lengths[:-1] += gaps / 2
+        lengths[1:] += gaps / 2
+        if len(self.station_list) < 2:
+            lengths[:] = NAN
+        return lengths[self.station_rows]
+
+    def average_weekday_flows(self, start_time=None, end_time=None):
+        '''
+        Returns a dictionary mapping station ids to the average weekday flow for that station during the specified time interval
         '''
-        # convert times to timeslot indices
-        start_time_index = timeslot_from_time(start_time)
-        end_time_index = timeslot_from_time(end_time)
+        weekdays = daymask.weekday_mask(self.dates()).reshape(1, -1)
+        group_flows = self.average_flows_for_day_groups(weekdays, start_time, end_time)
+        return dict((id, flows[0]) for id, flows in group_flows.items())
 
-        # get the index of the first monday in the current year
-        first_monday = index_of_first_monday_in_year(self.year)
+    def average_flows_for_day_groups(self, day_masks, start_time=None, end_time=None):
+        '''
+        Returns a dictionary mapping station ids to an array holding the
+        average flow of that station, in vehicles per hour over all its lanes,
+        during the specified time interval for each day group. The volumes
+        must be tracked (see TMS_Config.track_volumes).
+        '''
+        return self._selected_station_dict(self._group_flows(day_masks, start_time, end_time))
 
-        # build a list of all weekday speeds during the specified time interval
-        selected_speeds = deque()
-        speeds = self.speeds
-        for offset in range(5):
-            day_index = first_monday + offset
-            # slice out the speeds for all stations, current day of week, specified time period
-            s = speeds[station_index, day_index::7, start_time_index:end_time_index].flatten()
-            selected_speeds.extend(list(s))
+    def weekday_vmt(self, start_time=None, end_time=None):
+        '''
+        Returns a dictionary mapping station ids to the vehicle-miles travelled on an average weekday over the road that station stands for during the specified time interval
+        '''
+        weekdays = daymask.weekday_mask(self.dates()).reshape(1, -1)
+        group_vmt = self.vmt_for_day_groups(weekdays, start_time, end_time)
+        return dict((id, vmt[0]) for id, vmt in group_vmt.items())
 
-        selected_speeds = impute.remove_values(selected_speeds, None)
-        return avg_list(list(selected_speeds))
+    def vmt_for_day_groups(self, day_masks, start_time=None, end_time=None):
+        '''
+        Returns a dictionary mapping station ids to an array holding the
+        vehicle-miles travelled on an average day of each day group during
+        the specified time interval over the road the station stands for (see
+        station_lengths): its average flow times the length of the interval
+        times the length of road.
+        '''
+        start_time_index, end_time_index = window_timeslots(start_time, end_time)
+        hours = (end_time_index - start_time_index) / 12
+        vmt = (self._group_flows(day_masks, start_time, end_time) * hours
+               * self.station_lengths().reshape(-1, 1))
+        return self._selected_station_dict(vmt)
+
+    def _group_flows(self, day_masks, start_time=None, end_time=None):
+        # the average 5-minute volumes of each group, as hourly flows
+        if not self.track_volumes:
+            raise ValueError("Volumes are not tracked for corridor "
+                             + self._route + " " + self._dir)
+        return self._group_speeds(self.volumes, day_masks, start_time, end_time) * 12
+
+    def _group_speeds(self, speeds, day_masks, start_time=None, end_time=None):
+        day_sums, day_counts = self._window_sums(speeds, start_time, end_time)
+        return daymask.group_averages(day_sums, day_counts, day_masks)
+
+    def window_sums(self, start_time=None, end_time=None):
+        '''
+        Returns a tuple (day_sums, day_counts) of (station x day) arrays holding
+        the sum and the number of the valid speeds of each station on each day
+        during the specified time interval. Averages over groups of days follow
+        from these (see daymask.group_averages).
+        '''
+        return self._window_sums(self.speeds, start_time, end_time)
+
+    def _window_sums(self, speeds, start_time=None, end_time=None):
+        start_time_index, end_time_index = window_timeslots(start_time, end_time)
+
+        # one pass over the cube gives the sum and count of the valid speeds
+        # of every (station, day) in the interval
+        day_sums = empty(speeds.shape[:2])
+        day_counts = empty(speeds.shape[:2])
+        for first, last in cubestore.blocks(speeds, 0, self.max_block_bytes):
+            window = speeds[first:last, :, start_time_index:end_time_index]
+            valid = ~isnan(window)
+            day_sums[first:last] = where(valid, window, 0).sum(axis=2)
+            day_counts[first:last] = valid.sum(axis=2)
+            cubestore.release(speeds)
+
+        return day_sums, day_counts
+
+    def congestion_events(self, threshold, day_masks, start_time=None,
+                          end_time=None, min_minutes=5):
+        '''
+        Finds the runs of speeds below threshold lasting at least min_minutes
+        during the specified time interval of every day, and returns a
+        dictionary mapping station ids to a dictionary of the statistics of
+        their events for each day group (see congestion.congestion_block).
+        The start and end distributions cover the timeslots of the interval.
+        Run this after imputation, as missing speeds end an event.
+        '''
+        start_time_index, end_time_index = window_timeslots(start_time, end_time)
+        min_slots = max(1, int(-(-min_minutes // congestion.SLOT_MINUTES)))
+
+        blocks = []
+        for first, last in cubestore.blocks(self.speeds, 0, self.max_block_bytes):
+            blocks.append(congestion.congestion_block(
+                self.speeds[first:last, :, start_time_index:end_time_index],
+                threshold, day_masks, min_slots))
+            cubestore.release(self.speeds)
+        if len(blocks) == 0:
+            return {}
+
+        events = {}
+        for name in congestion.STATISTICS:
+            station_values = concatenate([block[name] for block in blocks])
+            for id, values in self._selected_station_dict(station_values).items():
+                events.setdefault(id, {})[name] = values
+        return events
 
 class Station:
 
@@ -331,71 +989,77 @@ class Station:
         return self._speed_limit
 
     def load_speeds_for_year(self, year, directory, recalc_field_lengths=False):
-        if self._verbose:
-            print "Loading speeds for station ", self.id
         current_day = date(year, 1, 1)
         last_day = date(year, 12, 31)
+        n_days = (last_day - current_day).days + 1
+
+        self.speeds = self.load_speeds_for_days(current_day, n_days, directory,
+                                                recalc_field_lengths)
+        return self.speeds
+
+    def load_speeds_for_days(self, start_date, n_days, directory,
+                             recalc_field_lengths=False):
+        '''
+        Returns a 2D array of 5-minute speeds for the n_days days beginning at
+        start_date
+        '''
+        if self._verbose:
+            print "Loading speeds for station ", self.id
+        current_day = start_date
         one_day = timedelta(days=1)
-        n_days = (last_day - current_day).days
 
-        # initialize empty 2D array to hold speeds
-        # dimensions: date (n_days), timeslot (288 5-min slots)
-        self.speeds = empty((n_days, 288), dtype=object)
+        # initialize 2D array to hold 1-minute speeds averaged across detectors
+        # dimensions: date (n_days), timeslot (1440 1-min slots)
+        minute_speeds = empty((n_days, 1440))
+        minute_speeds[:] = NAN
+
+        # If there are no detectors, there are no valid speeds
+        if self.detector_list == []:
+            return reduce_minute_speeds(minute_speeds)
 
+        # Otherwise, load speeds from each detector
         for day in range(n_days):
             if self._verbose:
                 print "    Loading speeds for ", current_day
 
-            # If there are no detectors, there are no valid speeds
-            if self.detector_list == []:
-                day_speeds = [None] * 288
-            # Otherwise, load speeds from each detector
-            else:
-                try:
-                    traffic_file = self.traffic_filename_from_date(current_day)
-                    tr = TrafficReader(path.join(directory, traffic_file))
-
-                    # average 1min speeds across detectors
-                    day_speeds = impute.average_multilist(
-                        [detector.load_speeds(tr, recalc_field_lengths)
-                         for detector in self.detector_list])
-                    # "short duration temporal linear regression" = impute gaps
-                    # up to 3 slots long use adjacent values
-                    day_speeds = impute.impute_range(day_speeds,
-                                                     impute_length=3,
-                                                     input_length=3)
-                    # average 1min speeds to 5min speeds
-                    day_speeds = impute.average_list(day_speeds, 5)
-                    # "short duration temporal linear regression" again
-                    day_speeds = impute.impute_range(day_speeds,
-                                                     impute_length=3,
-                                                     input_length=3)
-                    # remove any single missing values by averaging adjacent
-                    # values
-                    day_speeds = impute.impute1(day_speeds)
-                except IOError:
-                    # If there is no file for the given day, add a list of
-                    # invalid speeds
-                    day_speeds = [None] * 288
-
-            self.speeds[day,:] = day_speeds
+            try:
+                tr = self.traffic_reader_for_date(directory, current_day)
+
+                # average 1min speeds across detectors
+                minute_speeds[day, :] = impute.average_multilist_array(
+                    self.detector_speeds(tr, recalc_field_lengths))
+            except IOError as e:
+                # If there is no file for the given day, leave the day's
+                # speeds invalid
+                if not is_missing(e):
+                    raise
+
             current_day = current_day + one_day
 
-        return self.speeds
+        return reduce_minute_speeds(minute_speeds)
 
     def load_speeds(self, traffic_reader, recalc_field_lengths=False):
         # if there are no detectors for this station, give it a speed list of all invalid speeds
         if self.detector_list == []:
-            self.speeds = [None] * 288
+            minute_speeds = empty((1, 1440))
+            minute_speeds[:] = NAN
         # otherwise, load the speeds from the detectors
         else:
-            for detector in self.detectors():
-                detector.load_speeds(traffic_reader, recalc_field_lengths)
+            minute_speeds = impute.average_multilist_array(
+                self.detector_speeds(traffic_reader, recalc_field_lengths))[newaxis, :]
+
+        self.speed_list = reduce_minute_speeds(minute_speeds)[0]
 
-            speeds = impute.average_multilist([detector.load_speeds(traffic_reader) for detector in self.detector_list])
-            speeds = impute.impute_range(speeds, impute_length=3, input_length=3)
-            speeds = impute.average_list(speeds, 5)
-            self.speed_list = impute.impute1(speeds)
+    def detector_speeds(self, traffic_reader, recalc_field_lengths=False):
+        '''
+        Returns a (detectors x 1440) array of the 1-minute speeds of all the
+        detectors in this station, calculated together
+        '''
+        return traffic_reader.onemin_speeds_for_detectors(
+            [detector.id for detector in self.detector_list],
+            [detector.speed_limit() for detector in self.detector_list],
+            [detector.field_length(recalc_field_lengths)
+             for detector in self.detector_list])
 
     def print_speeds(self):
         print "Speeds for station " + self.id
@@ -408,6 +1072,15 @@ class Station:
     def traffic_filename_from_date(self, date):
         return date.strftime("%Y%m%d") + ".traffic"
 
+    def traffic_reader_for_date(self, directory, date):
+        '''
+        Returns a TrafficReader for the given date. directory is either a
+        directory of .traffic files, which may also hold year archives, or the
+        path of a year archive. Raises IOError if there is no data for the date.
+        '''
+        return open_traffic_day(directory, date,
+                                self.traffic_filename_from_date(date))
+
 class Detector:
 
     def __init__(self, detector_node=None, speed_limit=0, verbose=False):
@@ -440,19 +1113,27 @@ class Detector:
         if self._verbose:
             print str(self) + " set field length = " + str(self._field_length)
 
-    def load_speeds(self, traffic_reader, recalc_field_length=False):
-        if self._verbose:
-            print str(self) + " loading speeds for detector " + str(self.id)
+    def speed_limit(self):
+        return self._speed_limit
 
+    def field_length(self, recalc_field_length=False):
+        '''
+        Returns the field length to calculate speeds with, or None if it should
+        be calculated from the detector data
+        '''
         if recalc_field_length:
-            field_length = self._field_length
+            return self._field_length
         else:
-            field_length = None
+            return None
+
+    def load_speeds(self, traffic_reader, recalc_field_length=False):
+        if self._verbose:
+            print str(self) + " loading speeds for detector " + str(self.id)
 
         speeds = traffic_reader.onemin_speeds_for_detector(
                                                 detectorID=self.id,
                                                 speed_limit=self._speed_limit,
-                                                field_length=field_length )
+                                                field_length=self.field_length(recalc_field_length) )
 
         if self._verbose:
             print "loaded speeds: ", str(speeds)
@@ -460,6 +1141,9 @@ class Detector:
 
 
 if __name__ == "__main__":
+    import shutil
+    import tempfile
+
     testfile = "test/metro_config_short.xml"
     test_traffic_dir = "trafficreader/test"
 
@@ -472,8 +1156,147 @@ if __name__ == "__main__":
         #pprint(test_config.average_weekday_speeds(start_time=time(hour=10), end_time=time(hour=12)), width=1)
         #test_config.print_speeds()
 
+    def testing_selected(impute_length=3, input_length=3):
+        # test/metro_config_gaps.xml is a corridor with runs of stations
+        # without detectors between stations with complete data for
+        # test/20100104.traffic. a run over each station alone, with the
+        # stations select_stations keeps, should give it the same speed as a
+        # run over the whole corridor.
+        def run(station_ids=None):
+            config = TMS_Config("test/metro_config_gaps.xml", verbose=False)
+            if station_ids != None:
+                config.select_stations(station_ids, neighbours=impute_length + input_length,
+                                       input_length=input_length)
+            config.allocate_speeds_for_dates(date(2010, 1, 4), 1)
+            config.load_speeds_for_days("test", 0, 1)
+            config.spatial_impute(impute_length=impute_length, input_length=input_length)
+            return config.average_weekday_speeds()
+
+        full_speeds = run()
+        n_filled = 0
+        for corridor in TMS_Config("test/metro_config_gaps.xml").corridors():
+            for station in corridor.stations():
+                full = full_speeds[station.id]
+                selected = run([station.id])[station.id]
+                if isnan(full):
+                    assert isnan(selected), station.id
+                    continue
+                assert full == selected, (station.id, full, selected)
+                if len(station.detectors()) == 0:
+                    n_filled += 1
+        # the check is only worth anything if stations without detectors
+        # were filled
+        assert n_filled > 0
+
+    def testing_dead_stations(impute_length=2, input_length=1, n_days=15):
+        # a run that leaves the stations of test/metro_config_gaps.xml out of
+        # the speed array when they are further than impute_length +
+        # input_length from every station with detectors should report the
+        # same speeds as a run with a row for every station
+        def run(drop):
+            config = TMS_Config("test/metro_config_gaps.xml", verbose=False)
+            if drop:
+                config.drop_dead_stations(impute_length + input_length)
+            config.allocate_speeds_for_dates(date(2010, 1, 4), n_days)
+            config.load_speeds_for_days("test", 0, n_days)
+            config.spatial_impute(impute_length=impute_length, input_length=input_length)
+            config.weekly_impute()
+            config.long_temporal_impute()
+            rows = sum(corridor.speeds.shape[0] for corridor in config.corridors())
+            return rows, config.average_weekday_speeds()
+
+        all_rows, all_speeds = run(False)
+        kept_rows, kept_speeds = run(True)
+        assert kept_rows < all_rows
+        assert sorted(kept_speeds) == sorted(all_speeds)
+        for station_id, speed in all_speeds.items():
+            if isnan(speed):
+                assert isnan(kept_speeds[station_id]), station_id
+            else:
+                assert kept_speeds[station_id] == speed, (station_id, speed)
+
+    def same_values(a, b):
+        return array_equal(isnan(a), isnan(b)) and array_equal(a[~isnan(a)], b[~isnan(b)])
+
+    def testing_week_layout(n_days=10):
+        # the week view is the calendar view of one array padded to whole
+        # weeks, with or without a cube store, and the padding days stay
+        # invalid through every pass
+        work_dir = tempfile.mkdtemp()
+        try:
+            for cube_store in [None, CubeStore(work_dir)]:
+                config = TMS_Config("test/metro_config_gaps.xml", verbose=False)
+                config.track_volumes()
+                config.allocate_speeds_for_dates(date(2010, 1, 4), n_days, cube_store)
+                config.load_speeds_for_days("test", 0, n_days)
+                config.spatial_impute()
+                config.weekly_impute()
+                config.long_temporal_impute()
+                for corridor in config.corridors():
+                    for values, week_values in [(corridor.speeds, corridor.week_speeds),
+                                                (corridor.volumes, corridor.week_volumes)]:
+                        n_stations = values.shape[0]
+                        assert values.shape == (n_stations, n_days, 288)
+                        assert week_values.shape == (n_stations, 2, 7, 288)
+                        assert may_share_memory(values, week_values)
+                        flat = week_values.reshape(n_stations, 14, 288)
+                        assert same_values(flat[:, :n_days], values)
+                        assert isnan(flat[:, n_days:]).all()
+                        assert not isnan(values[:, 0]).all()
+                    corridor.speeds[0, 8, 0] = -1
+                    assert corridor.week_speeds[0, 1, 1, 0] == -1
+        finally:
+            shutil.rmtree(work_dir)
+
+    def testing_sampler(n_days=28):
+        # four weeks of copies of test/20100104.traffic, and a second corridor
+        # whose only station has a detector that never reports. every day is
+        # the same, so the intervals close once the strata, all in one
+        # season, have two days each to estimate a variance from, as long as
+        # the silent station stops holding up the sampling.
+        work_dir = tempfile.mkdtemp()
+        try:
+            first_date = date(2010, 1, 4)
+            for day in range(n_days):
+                shutil.copy("test/20100104.traffic", path.join(work_dir, (
+                    first_date + timedelta(days=day)).strftime("%Y%m%d") + ".traffic"))
+            tree = ET.parse("test/metro_config_gaps.xml")
+            silent = ET.SubElement(tree.getroot(), 'corridor', route='T-2', dir='SB')
+            r_node = ET.SubElement(silent, 'r_node', name='rnd_s', station_id='S0',
+                                   n_type='Station', s_limit='60', lat='46.00', lon='-93.00')
+            ET.SubElement(r_node, 'detector', name='9999', lane='1', field='22.0')
+            config_file = path.join(work_dir, "metro_config.xml")
+            tree.write(config_file)
+
+            config = TMS_Config(config_file, verbose=False)
+            sampler = sampling.DaySampler(config, work_dir, first_date, n_days,
+                                          ones(n_days, dtype=bool), seed=0)
+            estimates = sampler.run(target=0.5)
+            assert sampler.n_sampled() == 2 * len(sampler.strata) < sampler.n_days()
+            assert isnan(estimates['S0']).all()
+
+            # the sampled days are imputed as one day on its own would be
+            config = TMS_Config("test/metro_config_gaps.xml", verbose=False)
+            config.allocate_speeds_for_dates(first_date, 1)
+            config.load_speeds_for_days("test", 0, 1)
+            config.spatial_impute(**DEFAULT_SETTINGS['spatial'])
+            config.long_temporal_impute(**DEFAULT_SETTINGS['temporal'])
+            full_speeds = config.average_weekday_speeds()
+            for station_id, speed in full_speeds.items():
+                if isnan(speed):
+                    assert isnan(estimates[station_id][0]), station_id
+                else:
+                    assert allclose(estimates[station_id], [speed, 0]), station_id
+        finally:
+            shutil.rmtree(work_dir)
+
     #prof = cProfile.run('testing()', 'test_profile')
     #p = pstats.Stats('test_profile')
     #p.sort_stats('cumulative').print_stats(10)
 
     testing()
+    testing_selected()
+    testing_dead_stations()
+    testing_week_layout()
+    testing_sampler()
+    print "mnfspeedcalc tests passed"
@@ -0,0 +1,174 @@
+'''
+Congestion events: runs of consecutive 5-minute speeds below a threshold.
+
+The runs of every station and day in a block of the (station, day, timeslot)
+speed array are found at once by differencing the below-threshold mask along
+the timeslot axis, so a whole corridor is analysed in a few array passes
+instead of a loop over rows. An event starts where the mask turns on and ends
+where it turns off; invalid (NAN) speeds are not below the threshold, so they
+end an event. Events are found within the time window analysed, so an event
+running across its start or end (or across midnight) counts from the part
+inside.
+
+The delay of an event is the time lost against travelling at the threshold
+speed: a 5-minute slot at speed v loses 5 * (1 - v / threshold) minutes.
+'''
+from __future__ import division
+from numpy import (zeros, concatenate, diff, flatnonzero, cumsum, bincount, dot,
+                   asarray, where, errstate, isnan, int8)
+
+# minutes in each timeslot of the speed arrays
+SLOT_MINUTES = 5
+
+STATISTICS = ('events', 'congested_minutes', 'delay_minutes', 'valid_days', 'starts',
+              'ends')
+
+def find_runs(below):
+    '''
+    Returns a tuple (stations, days, starts, ends) of arrays describing every
+    run of True along the last axis of a (station x day x timeslot) boolean
+    array, one entry per run; ends are exclusive
+    '''
+    n_stations, n_days, n_slots = below.shape
+    edge = zeros((n_stations, n_days, 1), dtype=int8)
+    steps = diff(concatenate([edge, below.view(int8), edge], axis=2), axis=2)
+    # flat indices come in order, so the nth start and the nth end belong to
+    # the same run
+    row_length = n_slots + 1
+    start_indices = flatnonzero(steps == 1)
+    rows, starts = divmod(start_indices, row_length)
+    ends = flatnonzero(steps == -1) % row_length
+    stations, days = divmod(rows, n_days)
+    return stations, days, starts, ends
+
+def congestion_block(speeds, threshold, day_masks, min_slots=1):
+    '''
+    Finds the congestion events of a (station x day x timeslot) block of
+    speeds, ignoring runs shorter than min_slots, and returns a dictionary
+    of their statistics for each day group of day_masks, a (groups x days)
+    boolean array:
+
+    events              (station x group) number of events
+    congested_minutes   (station x group) total duration of the events
+    delay_minutes       (station x group) total delay of the events
+    valid_days          (station x group) number of days with a valid speed
+                        in the block, the days events could be found on
+    starts              (station x group x timeslot) number of events starting
+                        in each timeslot of the block
+    ends                (station x group x timeslot) number of events whose
+                        last congested timeslot is each timeslot of the block
+    '''
+    n_stations, n_days, n_slots = speeds.shape
+    with errstate(invalid='ignore'):
+        below = speeds < threshold
+    stations, days, starts, ends = find_runs(below)
+
+    keep = (ends - starts) >= min_slots
+    stations, days, starts, ends = stations[keep], days[keep], starts[keep], ends[keep]
+
+    # mark the timeslots of the events kept. runs are separated by at least
+    # one timeslot, so no run starts where another ends.
+    marks = zeros((n_stations, n_days, n_slots + 1), dtype=int8)
+    marks[stations, days, starts] = 1
+    marks[stations, days, ends] = -1
+    in_event = cumsum(marks, axis=2, dtype=int8)[:, :, :n_slots] > 0
+
+    with errstate(invalid='ignore'):
+        day_delays = where(in_event, SLOT_MINUTES * (1 - speeds / threshold), 0).sum(axis=2)
+    day_minutes = SLOT_MINUTES * in_event.sum(axis=2)
+    day_events = bincount(stations * n_days + days,
+                          minlength=n_stations * n_days).reshape(n_stations, n_days)
+    day_valid = ~isnan(speeds).all(axis=2)
+
+    day_masks = asarray(day_masks, dtype=bool)
+    group_days = day_masks.astype(float).T
+    start_counts = zeros((n_stations, len(day_masks), n_slots))
+    end_counts = zeros((n_stations, len(day_masks), n_slots))
+    for group, mask in enumerate(day_masks):
+        in_group = mask[days]
+        start_counts[:, group] = bincount(stations[in_group] * n_slots + starts[in_group],
+                                          minlength=n_stations * n_slots).reshape(n_stations, n_slots)
+        end_counts[:, group] = bincount(stations[in_group] * n_slots + ends[in_group] - 1,
+                                        minlength=n_stations * n_slots).reshape(n_stations, n_slots)
+
+    return {
+        'events': dot(day_events, group_days),
+        'congested_minutes': dot(day_minutes, group_days),
+        'delay_minutes': dot(day_delays, group_days),
+        'valid_days': dot(day_valid, group_days),
+        'starts': start_counts,
+        'ends': end_counts,
+    }
+
+if __name__ == '__main__':
+    from numpy import empty, allclose, NAN
+    import random
+
+    def reference_runs(below):
+        # the runs of every row, one timeslot at a time
+        runs = []
+        for station in range(below.shape[0]):
+            for day in range(below.shape[1]):
+                start = None
+                for slot, value in enumerate(list(below[station, day]) + [False]):
+                    if value and start is None:
+                        start = slot
+                    elif not value and start is not None:
+                        runs.append((station, day, start, slot))
+                        start = None
+        return runs
+
+    def random_speeds(rng, n_stations, n_days, n_slots):
+        speeds = empty((n_stations, n_days, n_slots))
+        for index in range(speeds.size):
+            speeds.flat[index] = rng.choice([NAN, rng.uniform(5, 45), rng.uniform(45, 70),
+                                             rng.uniform(45, 70)])
+        # a day congested from start to end, and a station without data
+        speeds[0, 1] = 20
+        speeds[-1] = NAN
+        return speeds
+
+    def testing_find_runs():
+        rng = random.Random(0)
+        speeds = random_speeds(rng, 3, 4, 12)
+        with errstate(invalid='ignore'):
+            below = speeds < 45
+        assert zip(*find_runs(below)) == reference_runs(below)
+        assert [len(a) for a in find_runs(zeros((2, 3, 5), dtype=bool))] == [0, 0, 0, 0]
+
+    def testing_congestion_block():
+        rng = random.Random(1)
+        threshold = 45
+        min_slots = 2
+        speeds = random_speeds(rng, 4, 6, 24)
+        day_masks = asarray([[True, False, True, False, True, False],
+                             [False, True, False, True, False, True],
+                             [True] * 6])
+        result = congestion_block(speeds, threshold, day_masks, min_slots)
+
+        with errstate(invalid='ignore'):
+            below = speeds < threshold
+        runs = [run for run in reference_runs(below) if run[3] - run[2] >= min_slots]
+        for group, mask in enumerate(day_masks):
+            for station in range(speeds.shape[0]):
+                kept = [run for run in runs if run[0] == station and mask[run[1]]]
+                assert result['events'][station, group] == len(kept)
+                assert result['congested_minutes'][station, group] == \
+                    SLOT_MINUTES * sum(end - start for _, _, start, end in kept)
+                delay = sum(SLOT_MINUTES * (1 - speeds[station, day, slot] / threshold)
+                            for _, day, start, end in kept for slot in range(start, end))
+                assert allclose(result['delay_minutes'][station, group], delay)
+                valid_days = sum(1 for day in range(speeds.shape[1])
+                                 if mask[day] and not isnan(speeds[station, day]).all())
+                assert result['valid_days'][station, group] == valid_days
+                for slot in range(speeds.shape[2]):
+                    assert result['starts'][station, group, slot] == \
+                        len([run for run in kept if run[2] == slot])
+                    assert result['ends'][station, group, slot] == \
+                        len([run for run in kept if run[3] - 1 == slot])
+        # the station without data has no events and no valid days
+        assert result['events'][-1].sum() == 0 and result['valid_days'][-1].sum() == 0
+
+    testing_find_runs()
+    testing_congestion_block()
+    print "congestion tests passed"
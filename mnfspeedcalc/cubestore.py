@@ -0,0 +1,297 @@
+'''
+Disk-resident speed cubes. A CubeStore allocates the (station, day, timeslot)
+speed arrays of the corridors as memory-mapped files, so that runs over many
+stations and years are not limited by RAM. Passes over a mapped cube work on
+blocks of it and release each block's pages once it is done, which keeps the
+resident memory of the process within the store's memory budget.
+'''
+from __future__ import division
+from os import path, makedirs, remove, rename
+from contextlib import contextmanager
+from numpy import memmap, ndarray, empty, fromfile, ascontiguousarray, float64, NAN
+from numpy.lib.format import open_memmap
+import mmap
+import ctypes
+
+# default memory budget, in bytes
+DEFAULT_MEMORY_BUDGET = 1024 ** 3
+
+# the imputation passes need several temporary arrays the size of the block
+# they work on (transposed copies, regression windows and fits), so blocks
+# are a fraction of the budget
+WORKING_COPIES = 12
+
+MADV_DONTNEED = 4
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _madvise = _libc.madvise
+    _madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+except (OSError, AttributeError):
+    # not available on this platform; pages are then left to the kernel
+    _madvise = None
+
+class CubeStore:
+    '''
+    Allocates speed cubes as memory-mapped files in directory and sizes the
+    blocks that passes over them work on so that they stay within
+    memory_budget bytes.
+    '''
+
+    def __init__(self, directory, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self._files = []
+        # the file of each cube allocated with a key
+        self._keyed_files = {}
+        if not path.isdir(directory):
+            makedirs(directory)
+
+    def allocate(self, shape, key=None):
+        '''
+        Returns a new memory-mapped float array of the given shape with every
+        value set to NAN. key identifies what the cube holds, such as the
+        speeds of a corridor: allocating again with the same key deletes the
+        file of the earlier cube, which must not be used afterwards, so that
+        reallocating does not take up more disk space.
+        '''
+        if key in self._keyed_files:
+            # deleted rather than overwritten: a mapping of the earlier cube
+            # still open somewhere keeps the old file until it is closed
+            filename = self._keyed_files[key]
+            if path.exists(filename):
+                remove(filename)
+        else:
+            filename = path.join(self.directory, 'cube_%03d.f8' % len(self._files))
+            self._files.append(filename)
+            if key != None:
+                self._keyed_files[key] = filename
+        cube = memmap(filename, dtype=float64, mode='w+', shape=shape)
+        for start, end in blocks(cube, 0, self.block_bytes()):
+            cube[start:end] = NAN
+            release(cube)
+        return cube
+
+    def block_bytes(self, workers=1):
+        '''
+        Returns the largest block size, in bytes, that a pass run by the given
+        number of processes should work on
+        '''
+        return max(1, self.memory_budget // (WORKING_COPIES * max(1, workers)))
+
+    def remove(self):
+        '''
+        Deletes the files of the cubes allocated by this store. The cubes must
+        not be used afterwards.
+        '''
+        for filename in self._files:
+            if path.exists(filename):
+                remove(filename)
+        self._files = []
+        self._keyed_files = {}
+
+@contextmanager
+def replacing(filename):
+    '''
+    Yields the name of a temporary file to write instead of filename, and
+    renames it to filename once the with block completes, so that an
+    interrupted write never leaves a truncated file under filename
+    '''
+    tmp_file = filename + '.tmp'
+    yield tmp_file
+    rename(tmp_file, filename)
+
+def save(filename, array, max_block_bytes=None):
+    '''
+    Writes array to the .npy file filename (see replacing), copying it in
+    blocks of at most max_block_bytes so that a memory-mapped cube is never
+    read into memory whole
+    '''
+    with replacing(filename) as tmp_file:
+        saved = open_memmap(tmp_file, mode='w+', dtype=array.dtype, shape=array.shape)
+        for first, last in blocks(array, 0, max_block_bytes):
+            saved[first:last] = read_block(array, (slice(first, last),))
+            release(saved)
+        del saved
+
+def blocks(array, axis, max_block_bytes):
+    '''
+    Splits range(array.shape[axis]) into contiguous (start, end) ranges such
+    that each block of array along axis holds at most max_block_bytes (but
+    always at least one index). With max_block_bytes None, the whole axis is
+    one block.
+    '''
+    n = array.shape[axis]
+    if n == 0:
+        return []
+    if max_block_bytes == None:
+        return [(0, n)]
+    index_bytes = max(1, array.nbytes // n)
+    step = max(1, int(max_block_bytes // index_bytes))
+    return [(start, min(n, start + step)) for start in range(0, n, step)]
+
+def is_mapped(array):
+    return isinstance(array, memmap)
+
+def _span(array):
+    # the number of bytes from the first element of an array to the end of
+    # its last, which is more than nbytes for a view with gaps between rows
+    if array.size == 0:
+        return 0
+    return sum((n - 1) * stride for n, stride in zip(array.shape, array.strides)) + array.itemsize
+
+def _file_offset(array):
+    # the byte offset in its file of the first element of a memory-mapped
+    # array or a view of one, or None if it is not mapped from a file
+    root = array
+    while isinstance(root, ndarray) and not isinstance(root.base, mmap.mmap):
+        root = root.base
+    if not isinstance(root, memmap):
+        return None
+    return root.offset + (array.ctypes.data - root.ctypes.data)
+
+def release(array):
+    '''
+    Drops the pages of a memory-mapped array from the resident memory of the
+    process. The cubes are shared mappings, so changed pages stay in the page
+    cache and are written to the file; the data is read back when next used.
+    Does nothing for arrays in memory.
+    '''
+    if not isinstance(array, memmap) or _madvise == None or array.size == 0:
+        return
+    address = array.ctypes.data
+    start = address - (address % mmap.PAGESIZE)
+    _madvise(start, address + _span(array) - start, MADV_DONTNEED)
+
+def _file_runs(array, index):
+    # the (byte offset, shape) of the contiguous runs of the file of a mapped
+    # array that hold array[index], in order. index may slice only its last
+    # axis. the axes after some axis must be laid out contiguously; those
+    # before it may have gaps between them, as in a view of the calendar days
+    # of a cube padded to whole weeks. returns None if the block cannot be
+    # read from the file directly.
+    if not isinstance(array, memmap) or len(index) == 0:
+        return None
+    offset = _file_offset(array)
+    if offset == None:
+        return None
+    for axis_index in index[:-1]:
+        if axis_index != slice(None):
+            return None
+    axis = len(index) - 1
+    start, end, step = index[-1].indices(array.shape[axis])
+    if step != 1 or end < start:
+        return None
+
+    # the axes from first_contiguous on are laid out contiguously
+    first_contiguous = array.ndim
+    contiguous_bytes = array.itemsize
+    for k in reversed(range(array.ndim)):
+        if array.shape[k] > 1 and array.strides[k] != contiguous_bytes:
+            break
+        contiguous_bytes *= array.shape[k]
+        first_contiguous = k
+
+    # one run per index of the axes before the sliced axis, or before the
+    # contiguous axes if the sliced axis is not one of them
+    first_contiguous = max(first_contiguous, axis)
+    ranges = [range(n) for n in array.shape[:first_contiguous]]
+    if first_contiguous > axis:
+        ranges[axis] = range(start, end)
+        run_shape = array.shape[first_contiguous:]
+        starts = [offset]
+    else:
+        run_shape = (end - start,) + array.shape[axis + 1:]
+        starts = [offset + start * array.strides[axis]]
+    for k in range(first_contiguous):
+        starts = [run_start + i * array.strides[k] for run_start in starts for i in ranges[k]]
+    return [(run_start, run_shape) for run_start in starts]
+
+def read_block(array, index):
+    '''
+    Returns array[index], where index is a tuple of slices. A block of a
+    memory-mapped cube is read from its file rather than through the mapping:
+    a block that is not contiguous in the file, such as a range of days of
+    every station, would otherwise map in much more of the file than the block
+    holds.
+    '''
+    block = array[index]
+    if not isinstance(array, memmap):
+        return block
+    runs = _file_runs(array, index)
+    if runs == None:
+        return block.copy()
+    values = empty(block.shape, dtype=array.dtype)
+    flat = values.reshape((len(runs),) + runs[0][1]) if len(runs) > 0 else values
+    with open(array.filename, 'rb') as f:
+        for i, (offset, shape) in enumerate(runs):
+            f.seek(offset)
+            flat[i] = fromfile(f, dtype=array.dtype, count=flat[i].size).reshape(shape)
+    return values
+
+def write_block(array, index, values):
+    '''
+    Sets array[index] = values, writing a block of a memory-mapped cube
+    through its file as read_block reads it
+    '''
+    runs = None
+    if isinstance(array, memmap):
+        runs = _file_runs(array, index)
+    if runs == None:
+        array[index] = values
+        release(array)
+        return
+    if len(runs) == 0:
+        return
+    flat = ascontiguousarray(values, dtype=array.dtype).reshape((len(runs),) + runs[0][1])
+    with open(array.filename, 'r+b') as f:
+        for i, (offset, shape) in enumerate(runs):
+            f.seek(offset)
+            flat[i].tofile(f)
+
+if __name__ == '__main__':
+    from os import listdir
+    from numpy import arange, isnan, load
+    import shutil
+    import tempfile
+
+    def testing_allocate(directory):
+        store = CubeStore(directory, memory_budget=12 * 1000)
+        speeds = store.allocate((3, 14, 288), ('corridor', 'speeds'))
+        volumes = store.allocate((3, 14, 288), ('corridor', 'volumes'))
+        assert isnan(speeds).all() and isnan(volumes).all()
+        speeds[:] = 1
+        # reallocating a cube replaces its file
+        for n_days in [7, 21, 7]:
+            speeds = store.allocate((3, n_days, 288), ('corridor', 'speeds'))
+            assert speeds.shape == (3, n_days, 288) and isnan(speeds).all()
+            assert len(listdir(directory)) == 2
+        store.allocate((2, 7, 288))
+        assert len(listdir(directory)) == 3
+        store.remove()
+        assert listdir(directory) == []
+
+    def testing_blocks(directory):
+        store = CubeStore(directory)
+        padded = store.allocate((4, 14, 6))
+        padded[:] = arange(padded.size).reshape(padded.shape)
+        # the calendar days of a cube padded to whole weeks
+        view = padded[:, :10, :]
+        expected = view.copy()
+        for index in [(slice(None), slice(2, 9)), (slice(1, 3),), (slice(None),)]:
+            assert (read_block(view, index) == expected[index]).all(), index
+            write_block(view, index, -read_block(view, index))
+            expected[index] = -expected[index]
+            assert (view == expected).all(), index
+        assert (padded[:, 10:, :] == arange(padded.size).reshape(padded.shape)[:, 10:, :]).all()
+        save(path.join(directory, 'view.npy'), view, 100)
+        assert (load(path.join(directory, 'view.npy')) == expected).all()
+        store.remove()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        testing_allocate(path.join(work_dir, 'allocate'))
+        testing_blocks(path.join(work_dir, 'blocks'))
+    finally:
+        shutil.rmtree(work_dir)
+    print "cubestore tests passed"
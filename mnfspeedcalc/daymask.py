@@ -0,0 +1,225 @@
+'''
+Boolean masks over the date axis of a speed array, used to average speeds over
+groups of days such as weekdays, weekends or holidays.
+
+Day groups can be given as strings of terms joined with + (add the days of a
+term) and - (remove the days of a term), read left to right:
+
+    weekday             Monday to Friday
+    weekend             Saturday and Sunday
+    holiday             holidays (see federal_holidays)
+    all                 every day
+    mon ... sun         one day of the week
+    jan ... dec         one month
+    @FILE               the dates listed in FILE, one YYYY-MM-DD per line
+                        (the file name may not contain + or -)
+
+so "weekday-holiday" is every weekday that is not a holiday and
+"jun+jul+aug-weekend" is every summer weekday.
+'''
+from datetime import date, datetime, timedelta
+from numpy import array, zeros, ones, asarray, dot, errstate
+import re
+
+DAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+MONTH_NAMES = ('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+               'jul', 'aug', 'sep', 'oct', 'nov', 'dec')
+
+def dates_from_start(first_day, n_days):
+    '''
+    Returns the list of n_days dates starting at first_day, one for each day
+    of a speed array's date axis
+    '''
+    return [first_day + timedelta(days=i) for i in range(n_days)]
+
+def weekday_mask(dates, weekdays=(0, 1, 2, 3, 4)):
+    '''
+    Returns a mask of the dates falling on the given days of the week, where
+    Monday is 0. By default, Monday to Friday.
+    '''
+    return array([day.weekday() in weekdays for day in dates], dtype=bool)
+
+def weekend_mask(dates):
+    return weekday_mask(dates, (5, 6))
+
+def month_mask(dates, months):
+    '''
+    Returns a mask of the dates falling in the given months (1 to 12)
+    '''
+    return array([day.month in months for day in dates], dtype=bool)
+
+def date_mask(dates, date_set):
+    '''
+    Returns a mask of the dates that are in date_set
+    '''
+    date_set = set(date_set)
+    return array([day in date_set for day in dates], dtype=bool)
+
+def holiday_mask(dates, holidays=None):
+    '''
+    Returns a mask of the dates that are holidays. holidays is a collection of
+    dates; if it is None, the federal holidays of the years spanned by dates
+    are used.
+    '''
+    if holidays == None:
+        holidays = set()
+        # a New Year's Day on a Saturday is observed on December 31 of the
+        # year before
+        for year in set(day.year for day in dates) | set(day.year + 1 for day in dates):
+            holidays.update(federal_holidays(year))
+    return date_mask(dates, holidays)
+
+def _nth_weekday(year, month, weekday, n):
+    # the nth given weekday of a month; n = -1 is the last one
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=((weekday - first.weekday()) % 7) + 7 * (n - 1))
+    if month == 12:
+        last = date(year, 12, 31)
+    else:
+        last = date(year, month + 1, 1) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+def _observed(day):
+    # holidays on a Saturday are observed on the Friday before and holidays
+    # on a Sunday on the Monday after
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+def federal_holidays(year):
+    '''
+    Returns the set of dates on which the US federal holidays of year are
+    observed, including Juneteenth from 2021. A New Year's Day on a Saturday
+    is observed on December 31 of the year before, so that date is in the set
+    of the following year.
+    '''
+    holidays = set([
+        _observed(date(year, 1, 1)),            # New Year's Day
+        _nth_weekday(year, 1, 0, 3),            # Martin Luther King Jr. Day
+        _nth_weekday(year, 2, 0, 3),            # Presidents' Day
+        _nth_weekday(year, 5, 0, -1),           # Memorial Day
+        _observed(date(year, 7, 4)),            # Independence Day
+        _nth_weekday(year, 9, 0, 1),            # Labor Day
+        _nth_weekday(year, 10, 0, 2),           # Columbus Day
+        _observed(date(year, 11, 11)),          # Veterans Day
+        _nth_weekday(year, 11, 3, 4),           # Thanksgiving
+        _observed(date(year, 12, 25)),          # Christmas Day
+    ])
+    if year >= 2021:
+        holidays.add(_observed(date(year, 6, 19)))  # Juneteenth
+    return holidays
+
+def read_dates(filename):
+    '''
+    Reads a set of dates from a file holding one YYYY-MM-DD date per line.
+    Blank lines and lines starting with # are skipped.
+    '''
+    dates = set()
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            dates.add(datetime.strptime(line, '%Y-%m-%d').date())
+    return dates
+
+def _term_mask(term, dates, holidays):
+    name = term.lower()
+    if name == 'weekday':
+        return weekday_mask(dates)
+    if name == 'weekend':
+        return weekend_mask(dates)
+    if name == 'holiday':
+        return holiday_mask(dates, holidays)
+    if name == 'all':
+        return ones(len(dates), dtype=bool)
+    if name in DAY_NAMES:
+        return weekday_mask(dates, (DAY_NAMES.index(name),))
+    if name in MONTH_NAMES:
+        return month_mask(dates, (MONTH_NAMES.index(name) + 1,))
+    if term.startswith('@'):
+        return date_mask(dates, read_dates(term[1:]))
+    raise ValueError("Unknown day group: " + term)
+
+def day_group_mask(group, dates, holidays=None):
+    '''
+    Returns the mask of the dates in the day group described by the string
+    group (see the module documentation). holidays is passed to holiday_mask.
+    '''
+    mask = zeros(len(dates), dtype=bool)
+    # split into terms, keeping the operator in front of each
+    for operator, term in re.findall(r'([+-]?)([^+-]+)', group.strip()):
+        term_mask = _term_mask(term.strip(), dates, holidays)
+        if operator == '-':
+            mask &= ~term_mask
+        else:
+            mask |= term_mask
+    return mask
+
+def day_group_masks(groups, dates, holidays=None):
+    '''
+    Returns a (groups x dates) boolean array holding the mask of each of the
+    given day groups
+    '''
+    masks = zeros((len(groups), len(dates)), dtype=bool)
+    for i, group in enumerate(groups):
+        masks[i] = day_group_mask(group, dates, holidays)
+    return masks
+
+def group_averages(day_sums, day_counts, day_masks):
+    '''
+    Returns a (station x group) array of average speeds, given the (station x
+    day) sums and counts of the valid speeds of each station on each day and a
+    (groups x days) array of day masks
+    '''
+    day_masks = asarray(day_masks, dtype=float)
+    with errstate(invalid='ignore', divide='ignore'):
+        return dot(day_sums, day_masks.T) / dot(day_counts, day_masks.T)
+
+if __name__ == '__main__':
+
+    def testing_holidays():
+        # observed dates: July 4, 2010 and Christmas 2010 fall on a weekend,
+        # and New Year's Day 2011 on a Saturday is observed on December 31,
+        # 2010
+        assert federal_holidays(2010) == set([
+            date(2010, 1, 1), date(2010, 1, 18), date(2010, 2, 15), date(2010, 5, 31),
+            date(2010, 7, 5), date(2010, 9, 6), date(2010, 10, 11), date(2010, 11, 11),
+            date(2010, 11, 25), date(2010, 12, 24)])
+        assert date(2010, 12, 31) in federal_holidays(2011)
+        # Juneteenth from 2021, on a Saturday that year
+        assert federal_holidays(2021) == set([
+            date(2021, 1, 1), date(2021, 1, 18), date(2021, 2, 15), date(2021, 5, 31),
+            date(2021, 6, 18), date(2021, 7, 5), date(2021, 9, 6), date(2021, 10, 11),
+            date(2021, 11, 11), date(2021, 11, 25), date(2021, 12, 24)])
+        assert date(2020, 6, 19) not in federal_holidays(2020)
+
+        # the mask of a year includes the next year's New Year observance
+        dates = dates_from_start(date(2010, 1, 1), 365)
+        holidays = [day for day, holiday in zip(dates, holiday_mask(dates)) if holiday]
+        assert holidays == sorted(federal_holidays(2010)) + [date(2010, 12, 31)]
+        # and given holidays replace the federal ones
+        assert not holiday_mask(dates, [date(2010, 1, 2)])[0]
+        assert holiday_mask(dates, [date(2010, 1, 2)])[1]
+
+    def testing_day_groups():
+        dates = dates_from_start(date(2010, 1, 1), 365)
+        masks = day_group_masks(['weekday-holiday', 'jun+jul+aug-weekend', 'all-sat-sun'],
+                                dates)
+        for day, (workday, summer_weekday, weekday) in zip(dates, masks.T):
+            assert weekday == (day.weekday() < 5)
+            assert workday == (day.weekday() < 5 and day not in federal_holidays(2010)
+                               and day != date(2010, 12, 31))
+            assert summer_weekday == (day.month in (6, 7, 8) and day.weekday() < 5)
+        try:
+            day_group_mask('weekdays', dates)
+            assert False, 'accepted an unknown day group'
+        except ValueError:
+            pass
+
+    testing_holidays()
+    testing_day_groups()
+    print "daymask tests passed"
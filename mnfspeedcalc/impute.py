@@ -1,6 +1,8 @@
 from __future__ import division
 from collections import deque
-from numpy import array
+from numpy import (NAN, array, arange, bincount, concatenate, cumsum, diff,
+                   empty, errstate, int8, isnan, maximum, minimum, newaxis,
+                   nonzero, repeat, unique, where, zeros)
 import itertools as IT
 
 def remove_values(inputlist, targetvalue):
@@ -59,116 +61,197 @@ def impute_range(inputlist, impute_length, input_length):
 	'''
 	outputlist = inputlist
 
-	for gap_start, gap_end in gap_list(inputlist):
-		gap_length = gap_end - gap_start
+	values = impute_range_array(list_to_array(inputlist), impute_length, input_length)
+	outputlist[:] = array_to_list(values)
 
-		if gap_length <= impute_length:
-			# case [... o o o x x x o o o ...]
-			# establish left and right bounds for regression, making sure not to run off the beginning or end of the input list
-			left = gap_start - input_length
-			if left < 0:
-				left = 0
-			right = gap_end + input_length
-			if right > len(inputlist):
-				right = len(inputlist)
-
-			try:
-				regression_function = linear_regression(inputlist[left:right], min_valid=2)
-			except ValueError:
-				# if there aren't enough valid values nearby for regression, skip this gap
-				continue
-
-			# fill in the gap values using the regression function. note that for the purposes of regression, left = 0
-			for i in range(gap_start, gap_end):
-				outputlist[i] = regression_function(i - left)
-
-		else:
-			# case [... o o o x x x x o o o ...] and
-			# case [... o o o x x x ... x x x o o o ...]
-
-			# first, do the left end
-			left = gap_start - input_length
-			if left < 0:
-				left = 0
-			right = gap_start + input_length
-
-			left_list = []
-
-			try:
-				regression_function = linear_regression(inputlist[left:right], min_valid=2)
-				for i in range(gap_start, right):
-					left_list.append(regression_function(i - left))
-			except ValueError:
-				# if there aren't enough valid values nearby for regression, leave invalid values for this side of the gap
-				left_list = [None] * impute_length
-
-			# now the right end
-			left = gap_end - input_length
-			right = gap_end + input_length
-			if right > len(inputlist):
-				right = len(inputlist)
+	return outputlist
 
-			right_list = []
+def impute_range_array(values, impute_length, input_length):
+	'''
+	Array version of impute_range. values is a 1-dimensional array or a 2-dimensional array with one series per row, where gaps are marked by NAN. Gaps in all series are filled in place and values is returned.
+	'''
+	series = values.reshape(-1, values.shape[-1])
+	n_series, length = series.shape
+
+	# find the [start, end) bounds of every gap, in row order
+	invalid = zeros((n_series, length + 2), dtype=int8)
+	invalid[:, 1:-1] = isnan(series)
+	edges = diff(invalid, axis=1)
+	rows, starts = nonzero(edges == 1)
+	ends = nonzero(edges == -1)[1]
+
+	# a gap running off the end of a series has no values on its right and is
+	# never imputed
+	keep = ends < length
+	rows, starts, ends = rows[keep], starts[keep], ends[keep]
+	if len(rows) == 0:
+		return values
+
+	# gaps are filled left to right, and the input values of a gap may include
+	# values imputed for the gap before it. put each gap in a later round than
+	# the gap it depends on; gaps within a round are independent.
+	window_starts = maximum(starts - input_length, 0)
+	depends = zeros(len(rows), dtype=bool)
+	depends[1:] = (rows[1:] == rows[:-1]) & (window_starts[1:] < ends[:-1])
+	index = arange(len(rows))
+	rounds = index - maximum.accumulate(where(depends, 0, index))
+
+	for r in range(rounds.max() + 1):
+		in_round = rounds == r
+		_impute_gaps(series, rows[in_round], starts[in_round], ends[in_round],
+		             impute_length, input_length)
+
+	return values
+
+def _impute_gaps(series, rows, starts, ends, impute_length, input_length):
+	'''
+	Fills in a set of independent gaps in the rows of series
+	'''
+	length = series.shape[1]
+	short = (ends - starts) <= impute_length
+
+	# case [... o o o x x x o o o ...]
+	# regression over the whole gap and input_length values either side of it
+	s_rows = rows[short]
+	s_left = maximum(starts[short] - input_length, 0)
+	s_right = minimum(ends[short] + input_length, length)
+
+	# case [... o o o x x x x o o o ...] and
+	# case [... o o o x x x ... x x x o o o ...]
+	# separate regressions over input_length values either side of each end
+	l_rows = rows[~short]
+	l_starts = starts[~short]
+	l_ends = ends[~short]
+	ll_left = maximum(l_starts - input_length, 0)
+	ll_right = minimum(l_starts + input_length, length)
+	lr_left = maximum(l_ends - input_length, 0)
+	lr_right = minimum(l_ends + input_length, length)
+
+	window_rows = concatenate((s_rows, l_rows, l_rows))
+	window_left = concatenate((s_left, ll_left, lr_left))
+	window_right = concatenate((s_right, ll_right, lr_right))
+	slope, intercept, fitted = batch_linear_regression(
+		*_gather_windows(series, window_rows, window_left, window_right), min_valid=2)
+
+	n_short = len(s_rows)
+	n_long = len(l_rows)
+
+	# short gaps: fill the whole gap from its regression
+	f_index, f_rows, f_pos = _expand_ranges(s_rows, starts[short], ends[short])
+	use = fitted[f_index]
+	f_index, f_rows, f_pos = f_index[use], f_rows[use], f_pos[use]
+	series[f_rows, f_pos] = (slope[f_index] * (f_pos - window_left[f_index])) + intercept[f_index]
+
+	if n_long == 0:
+		return
+
+	# long gaps: impute_length values from the left end and impute_length values
+	# from the right end. where they overlap, the two values are averaged.
+	left_index = n_short + arange(n_long)
+	right_index = n_short + n_long + arange(n_long)
+	a_index, a_rows, a_pos = _expand_ranges(l_rows, l_starts, l_starts + impute_length)
+	b_index, b_rows, b_pos = _expand_ranges(l_rows, l_ends - impute_length, l_ends)
+	a_index = left_index[a_index]
+	b_index = right_index[b_index]
+
+	f_index = concatenate((a_index, b_index))
+	f_rows = concatenate((a_rows, b_rows))
+	f_pos = concatenate((a_pos, b_pos))
+	use = fitted[f_index]
+	f_index, f_rows, f_pos = f_index[use], f_rows[use], f_pos[use]
+	fills = (slope[f_index] * (f_pos - window_left[f_index])) + intercept[f_index]
+
+	# left values come before right values, so each overlapping sum is
+	# left + right
+	cells, cell_index = unique(f_rows * length + f_pos, return_inverse=True)
+	totals = bincount(cell_index, weights=fills)
+	counts = bincount(cell_index)
+	series[cells // length, cells % length] = totals / counts
+
+def _expand_ranges(rows, starts, ends):
+	'''
+	Expands the ranges [starts[i], ends[i]) of the given rows into flat arrays
+	(range index, row, position), one element per position
+	'''
+	counts = ends - starts
+	index = repeat(arange(len(rows)), counts)
+	offsets = arange(counts.sum()) - repeat(cumsum(counts) - counts, counts)
+	return index, rows[index], starts[index] + offsets
 
-			try:
-				regression_function = linear_regression(inputlist[left:right], min_valid=2)
-				for i in range(left, gap_end):
-					right_list.append(regression_function(i - left))
-			except ValueError:
-				# if there aren't enough valid values nearby for regression, leave invalid values for this side of the gap
-				right_list = [None] * impute_length
-
-			# put the imputed values into the output
-			outputlist[gap_start:gap_start + impute_length] = left_list
-			outputlist[gap_end - impute_length:gap_end] = right_list
-
-			# do imputed ranges overlap?
-			if gap_start + impute_length >= gap_end - impute_length:
-				# find the indices where they overlap
-				overlaps = list(set(range(gap_start, gap_start + impute_length)) & set(range(gap_end - impute_length, gap_end)))
-				# average the overlaping parts of the lists and put them into the output
-				for i in overlaps:
-					left_value = left_list[i - gap_start]
-					right_value = right_list[impute_length - (gap_end - i)]
-					if left_value == None:
-						outputlist[i] = right_value
-					elif right_value == None:
-						outputlist[i] = left_value
-					else:
-						outputlist[i] = (left_value + right_value) / 2
+def _gather_windows(series, rows, left, right):
+	'''
+	Copies the windows [left[i], right[i]) of the given rows of series into a
+	2-dimensional array padded with NAN, and returns it with its valid mask
+	'''
+	width = (right - left).max() if len(rows) > 0 else 0
+	columns = left[:, newaxis] + arange(width)[newaxis, :]
+	inside = columns < right[:, newaxis]
+	windows = series[rows[:, newaxis], minimum(columns, series.shape[1] - 1)]
+	valid = inside & ~isnan(windows)
+	return windows, valid
+
+def batch_linear_regression(y, valid, min_valid=1):
+	'''
+	Fits a line to every row of the 2-dimensional array y, using the elements where valid is True and the column index as x. Returns arrays (slope, intercept, fitted); rows with fewer than min_valid valid values are not fitted.
 
-	return outputlist
+	The running sums of x, y, xy and x^2 and the valid count are accumulated one column at a time for all rows together, adding values in the same order as linear_regression so that both give exactly the same lines.
+	'''
+	n_rows = y.shape[0]
+	n = zeros(n_rows)
+	sum_x = zeros(n_rows)
+	sum_y = zeros(n_rows)
+	sum_xy = zeros(n_rows)
+	sum_xx = zeros(n_rows)
+
+	for x in range(y.shape[1]):
+		v = valid[:, x]
+		yx = where(v, y[:, x], 0)
+		n += v
+		sum_x += v * x
+		sum_y += yx
+		sum_xy += yx * x
+		sum_xx += v * (x ** 2)
+
+	numerator = (n * sum_xy) - (sum_x * sum_y)
+	denominator = (n * sum_xx) - (sum_x ** 2)
+
+	fitted = (n >= min_valid) & (denominator != 0)
+	safe_n = where(fitted, n, 1)
+	slope = numerator / where(fitted, denominator, 1)
+	intercept = (sum_y / safe_n) - (slope * (sum_x / safe_n))
+
+	return slope, intercept, fitted
 
 def linear_regression(y, min_valid=1):
 	'''
 	Returns a function that can generate new values based on parameters estimated using linear regression on the input values
 	'''
-	x = range(len(y))
-
-	# first, remove any invalid (None) data in y as well as the corresponding x values
-	while True:
-		try:
-			i = y.index(None)
-			del y[i]
-			del x[i]
-		except ValueError:
-			break
+	y = list_to_array(y)[newaxis, :]
+	slope, intercept, fitted = batch_linear_regression(y, ~isnan(y), min_valid)
 
-	n = len(y)
-	if n < min_valid:
+	if not fitted[0]:
 		raise ValueError("Not enough valid values for regression")
 
-	numerator = (n * sum(xi * yi for xi, yi in zip(x, y))) - (sum(x) * sum(y))
-	denominator = (n * sum(xi**2 for xi in x)) - (sum(x)**2)
-
-	slope = numerator / denominator
-	intercept = (sum(y) / len(y)) - (slope * (sum(x) / len(x)))
+	slope = slope[0]
+	intercept = intercept[0]
 
 	def f(input):
 		return (slope * input) + intercept
 
 	return f
 
+def list_to_array(inputlist):
+	'''
+	Returns a float array of the values in inputlist, with None replaced by NAN
+	'''
+	return array(inputlist, dtype=float).reshape(-1)
+
+def array_to_list(values):
+	'''
+	Returns a list of the values in a float array, with NAN replaced by None
+	'''
+	return [None if isnan(x) else x for x in values.tolist()]
+
 def average_list(inputlist, block_size, max_invalid=1):
 	'''
 	Averages the input list into blocks of block_size. If more than max_invalid of the input elements in each block are invalid (None), the resulting average block is invalid.
@@ -207,8 +290,206 @@ def average_multilist(inputlists, max_invalid=1):
 
 	return list(outputlist)
 
+def impute1_array(values):
+	'''
+	Array version of impute1. Fills in single missing (NAN) values along the last axis of values by averaging adjacent values. values is modified in place and returned.
+	'''
+	missing = isnan(values)
+	single = zeros(values.shape, dtype=bool)
+	single[..., 1:-1] = missing[..., 1:-1] & ~missing[..., :-2] & ~missing[..., 2:]
+	# every filled value is surrounded by valid values, so the fills do not
+	# depend on each other
+	middle = values[..., 1:-1]
+	middle[single[..., 1:-1]] = ((values[..., :-2] + values[..., 2:]) / 2)[single[..., 1:-1]]
+	return values
+
+def average_list_array(values, block_size, max_invalid=1):
+	'''
+	Array version of average_list. Averages the last axis of values into blocks of block_size, so that a (days x 1440) array of 1-minute values becomes a (days x 288) array of 5-minute values when block_size is 5. If more than max_invalid of the elements in a block are invalid (NAN), the block average is invalid.
+	'''
+	length = values.shape[-1]
+	n_blocks = -(-length // block_size)
+
+	# pad to a whole number of blocks; padding does not count as invalid
+	blocks = empty(values.shape[:-1] + (n_blocks * block_size,))
+	blocks[...] = NAN
+	blocks[..., :length] = values
+	blocks = blocks.reshape(values.shape[:-1] + (n_blocks, block_size))
+	block_lengths = minimum(block_size, length - (arange(n_blocks) * block_size))
+
+	return _average_valid(blocks, -1, block_lengths, max_invalid)
+
+def average_multilist_array(values, max_invalid=1):
+	'''
+	Array version of average_multilist. values is a (detectors x slots) array or a (days x detectors x slots) batch; corresponding elements are averaged across detectors. If more than max_invalid of the elements in a slot are invalid (NAN), or there are 2 or fewer detectors and any of them is invalid, the average is invalid.
+	'''
+	n_lists = values.shape[-2]
+	if n_lists <= 2:
+		max_invalid = 0
+
+	return _average_valid(values, -2, n_lists, max_invalid)
+
+def _average_valid(values, axis, n_values, max_invalid):
+	'''
+	Averages the valid (not NAN) elements of values along axis. n_values is the number of elements in each group, which may be less than the length of the axis when it is padded. Groups with more than max_invalid invalid elements are invalid.
+	'''
+	valid = ~isnan(values)
+	n_valid = valid.sum(axis=axis)
+	# elements are summed in order along the axis, as the list versions do
+	total = where(valid, values, 0).sum(axis=axis)
+
+	with errstate(invalid='ignore', divide='ignore'):
+		average = total / n_valid
+	average[(n_values - n_valid) > max_invalid] = NAN
+	average[n_valid == 0] = NAN
+	return average
+
 
 if __name__ == "__main__":
+	import random
+
+	def reference_linear_regression(y, min_valid=1):
+		# linear_regression as it was before batch_linear_regression
+		x = range(len(y))
+
+		while True:
+			try:
+				i = y.index(None)
+				del y[i]
+				del x[i]
+			except ValueError:
+				break
+
+		n = len(y)
+		if n < min_valid:
+			raise ValueError("Not enough valid values for regression")
+
+		numerator = (n * sum(xi * yi for xi, yi in zip(x, y))) - (sum(x) * sum(y))
+		denominator = (n * sum(xi**2 for xi in x)) - (sum(x)**2)
+
+		slope = numerator / denominator
+		intercept = (sum(y) / len(y)) - (slope * (sum(x) / len(x)))
+
+		def f(input):
+			return (slope * input) + intercept
+
+		return f
+
+	def reference_impute_range(inputlist, impute_length, input_length):
+		# impute_range as it was before impute_range_array, one gap at a time.
+		# the old code filled input_length values at each end of a long gap,
+		# which only fits the gap when input_length == impute_length; here
+		# impute_length values are filled, as impute_range_array does.
+		outputlist = inputlist
+
+		for gap_start, gap_end in gap_list(inputlist):
+			gap_length = gap_end - gap_start
+
+			if gap_length <= impute_length:
+				left = max(gap_start - input_length, 0)
+				right = min(gap_end + input_length, len(inputlist))
+				try:
+					regression_function = reference_linear_regression(inputlist[left:right], min_valid=2)
+				except ValueError:
+					continue
+				for i in range(gap_start, gap_end):
+					outputlist[i] = regression_function(i - left)
+
+			else:
+				left = max(gap_start - input_length, 0)
+				right = gap_start + input_length
+				try:
+					regression_function = reference_linear_regression(inputlist[left:right], min_valid=2)
+					left_list = [regression_function(i - left)
+					             for i in range(gap_start, gap_start + impute_length)]
+				except ValueError:
+					left_list = [None] * impute_length
+
+				left = gap_end - input_length
+				right = min(gap_end + input_length, len(inputlist))
+				try:
+					regression_function = reference_linear_regression(inputlist[left:right], min_valid=2)
+					right_list = [regression_function(i - left)
+					              for i in range(gap_end - impute_length, gap_end)]
+				except ValueError:
+					right_list = [None] * impute_length
+
+				outputlist[gap_start:gap_start + impute_length] = left_list
+				outputlist[gap_end - impute_length:gap_end] = right_list
+
+				if gap_start + impute_length >= gap_end - impute_length:
+					overlaps = list(set(range(gap_start, gap_start + impute_length)) & set(range(gap_end - impute_length, gap_end)))
+					for i in overlaps:
+						left_value = left_list[i - gap_start]
+						right_value = right_list[impute_length - (gap_end - i)]
+						if left_value == None:
+							outputlist[i] = right_value
+						elif right_value == None:
+							outputlist[i] = left_value
+						else:
+							outputlist[i] = (left_value + right_value) / 2
+
+		return outputlist
+
+	def random_series(rng, length=60):
+		# random speeds with runs of gaps of 1 to 10 values, sometimes at the
+		# start or end of the series
+		series = [rng.uniform(0, 70) for i in range(length)]
+		for gap in range(rng.randint(0, 6)):
+			start = rng.randint(0, length - 1)
+			series[start:start + rng.randint(1, 10)] = [None] * 10
+			del series[length:]
+		return series
+
+	def testing_regression(rng):
+		for trial in range(200):
+			y = random_series(rng, rng.randint(2, 12))
+			try:
+				expected = reference_linear_regression(list(y), min_valid=2)
+			except (ValueError, ZeroDivisionError):
+				continue
+			f = linear_regression(y, min_valid=2)
+			for x in range(len(y)):
+				assert f(x) == expected(x), (y, x)
+
+	def testing_impute_range(rng):
+		# the settings of the imputation passes
+		for impute_length, input_length in [(3, 3), (4, 1), (3, 2), (6, 6)]:
+			all_series = [random_series(rng) for trial in range(300)]
+			expected = [reference_impute_range(list(series), impute_length, input_length)
+			            for series in all_series]
+			for series, values in zip(all_series, expected):
+				assert impute_range(list(series), impute_length, input_length) == values
+			# and every series at once
+			batch = list_to_array(all_series).reshape(len(all_series), -1)
+			impute_range_array(batch, impute_length, input_length)
+			for row, values in zip(batch, expected):
+				assert array_to_list(row) == values
+
+	def testing_array_versions(rng):
+		# the array versions against the list versions they replace
+		for trial in range(300):
+			series = [None if rng.random() < 0.3 else rng.uniform(0, 70)
+			          for i in range(rng.randint(1, 40))]
+			values = list_to_array(series)
+			assert array_to_list(impute1_array(values.copy())) == impute1(list(series))
+			for block_size in [1, 3, 5]:
+				for max_invalid in [0, 1, 2]:
+					try:
+						expected = average_list(series, block_size, max_invalid)
+					except ZeroDivisionError:
+						# the list version cannot average a block without
+						# valid values, which the array version makes invalid
+						continue
+					assert (array_to_list(average_list_array(values, block_size, max_invalid))
+					        == expected)
+			n_lists = rng.randint(1, 5)
+			lists = [series] + [[None if rng.random() < 0.3 else rng.uniform(0, 70)
+			                     for value in series] for i in range(n_lists - 1)]
+			for max_invalid in [0, 1, 2]:
+				assert (array_to_list(average_multilist_array(list_to_array(lists).reshape(n_lists, -1),
+				                                              max_invalid))
+				        == average_multilist(lists, max_invalid))
 
 	testlist = [0,None, 1,None,None,None, 2,None, 3, 4,None,None,None, 5,None]
 
@@ -216,12 +497,18 @@ if __name__ == "__main__":
 	for index in gap_list(testlist):
 		print index
 
- 	print "Test impute1"
+	print "Test impute1"
 	print impute1(testlist)
 
 	print "Test linear_regression"
 	f = linear_regression((0,3,4,4,8,10))
-	print f(None)
+	print [f(x) for x in range(6)]
 
 	print "Test impute_range"
 	print impute_range(testlist,3,3)
+
+	rng = random.Random(0)
+	testing_regression(rng)
+	testing_impute_range(rng)
+	testing_array_versions(rng)
+	print "impute tests passed"
@@ -0,0 +1,329 @@
+'''
+Day-major loading of station speeds.
+
+The same detector can be listed under more than one station, as at shared
+mainline and collector-distributor sections. A DetectorSet gathers the
+detectors of every station of a list of corridors once, so that loading a day
+opens its .traffic file once and calculates the 1-minute speeds of each
+detector once, in one batch, and every station referencing a detector gets the
+shared result. Detectors are shared when they have the same ID, speed limit and
+field length, since those determine their speeds. The data of an ID listed
+with more than one speed limit or field length is still decoded only once.
+
+Corridors that carry volumes (see TMS_Config.track_volumes) get the 5-minute
+volumes of their stations from the same decoded data: a station's volume is
+the total over its detectors, with a missing detector filled in with the
+average of the others where its speed would be too.
+'''
+from __future__ import division
+from datetime import timedelta
+from numpy import empty, array, NAN
+from trafficreader import open_traffic_days, onemin_speeds
+import impute
+import cubestore
+
+def reduce_minute_speeds(minute_speeds):
+    '''
+    Turns a (days x 1440) array of 1-minute station speeds into a (days x 288)
+    array of 5-minute station speeds, imputing short gaps along the way
+    '''
+    # "short duration temporal linear regression" = impute gaps
+    # up to 3 slots long use adjacent values
+    impute.impute_range_array(minute_speeds, impute_length=3, input_length=3)
+    # average 1min speeds to 5min speeds
+    speeds = impute.average_list_array(minute_speeds, 5)
+    # "short duration temporal linear regression" again
+    impute.impute_range_array(speeds, impute_length=3, input_length=3)
+    # remove any single missing values by averaging adjacent
+    # values
+    return impute.impute1_array(speeds)
+
+def reduce_minute_volumes(minute_volumes):
+    '''
+    Turns a (days x 1440) array of 1-minute station volumes into a (days x
+    288) array of 5-minute station volumes, imputing short gaps as
+    reduce_minute_speeds does
+    '''
+    # the imputed 5-minute averages, scaled back to 5-minute totals
+    return reduce_minute_speeds(minute_volumes) * 5
+
+class DetectorSet:
+    '''
+    The distinct detectors of the stations with rows in the speed arrays of a
+    list of corridors, and which of them each station averages
+    '''
+
+    def __init__(self, corridors, recalc_field_lengths=False):
+        self.detector_ids = []
+        self.speed_limits = []
+        self.field_lengths = []
+        detector_index = {}
+        # the distinct IDs, decoded once each, and the row of each detector's
+        # ID in them
+        self.decoded_ids = []
+        decoded_index = {}
+        decoded_rows = []
+
+        # one target for each (corridor, row) of a station with detectors
+        self.targets = []
+        target_detectors = []
+        for corridor_index, corridor in enumerate(corridors):
+            for row, station_index in enumerate(corridor.station_rows):
+                station = corridor.stations()[station_index]
+                if len(station.detectors()) == 0:
+                    continue
+                detectors = []
+                for detector in station.detectors():
+                    key = (detector.id, detector.speed_limit(),
+                           detector.field_length(recalc_field_lengths))
+                    if key not in detector_index:
+                        detector_index[key] = len(self.detector_ids)
+                        self.detector_ids.append(key[0])
+                        self.speed_limits.append(key[1])
+                        self.field_lengths.append(key[2])
+                        if key[0] not in decoded_index:
+                            decoded_index[key[0]] = len(self.decoded_ids)
+                            self.decoded_ids.append(key[0])
+                        decoded_rows.append(decoded_index[key[0]])
+                    detectors.append(detector_index[key])
+                self.targets.append((corridor_index, row))
+                target_detectors.append(detectors)
+
+        # the detectors of each target as a padded (targets x detectors) array
+        # of rows into the detector speeds, where the padding points at a row
+        # of NAN past the last detector
+        self._decoded_rows = array(decoded_rows, dtype=int)
+        n_detectors = len(self.detector_ids)
+        width = max([1] + [len(detectors) for detectors in target_detectors])
+        self._target_rows = empty((len(self.targets), width), dtype=int)
+        self._target_rows[:] = n_detectors
+        for target, detectors in enumerate(target_detectors):
+            self._target_rows[target, :len(detectors)] = detectors
+        self._n_target_detectors = array([len(detectors) for detectors in target_detectors],
+                                         dtype=int).reshape(-1, 1)
+        # stations with 2 or fewer detectors need every detector, as in
+        # impute.average_multilist_array
+        self._max_invalid = (self._n_target_detectors > 2).astype(int)
+
+    def station_speeds(self, traffic_reader):
+        '''
+        Returns a (targets x 288) array of the 5-minute speeds of each target
+        station for the day of traffic_reader
+        '''
+        return self.station_data(traffic_reader, volumes=False)[0]
+
+    def station_data(self, traffic_reader, volumes=True):
+        '''
+        Returns a tuple (speeds, volumes) of (targets x 288) arrays of the
+        5-minute speeds and volumes of each target station for the day of
+        traffic_reader. volumes is None unless asked for.
+        '''
+        vols, occs = traffic_reader.onemin_data_for_detectors(self.decoded_ids)
+        vols = vols[self._decoded_rows]
+        occs = occs[self._decoded_rows]
+        detector_speeds = empty((len(self.detector_ids) + 1, 1440))
+        detector_speeds[:-1] = onemin_speeds(vols, occs, self.speed_limits,
+                                             self.field_lengths)
+        detector_speeds[-1] = NAN
+        # average the 1-minute speeds of the detectors of each station
+        minute_speeds = impute._average_valid(detector_speeds[self._target_rows], -2,
+                                              self._n_target_detectors,
+                                              self._max_invalid)
+        station_speeds = reduce_minute_speeds(minute_speeds)
+        if not volumes:
+            return station_speeds, None
+
+        # the volumes of the detectors of each station, totalled as their
+        # average times the number of detectors
+        detector_volumes = empty((len(self.detector_ids) + 1, 1440))
+        detector_volumes[:-1] = vols
+        detector_volumes[-1] = NAN
+        minute_volumes = impute._average_valid(detector_volumes[self._target_rows], -2,
+                                               self._n_target_detectors,
+                                               self._max_invalid)
+        minute_volumes *= self._n_target_detectors
+        return station_speeds, reduce_minute_volumes(minute_volumes)
+
+def load_speeds_for_days(corridors, directory, first_day, last_day,
+                         max_block_bytes=None):
+    '''
+    Loads speeds for days first_day (inclusive) to last_day (exclusive) into
+    the speed arrays of corridors, which must all start on the same date,
+    reading every .traffic file once. Corridors that track volumes get their
+    volume arrays filled in the same pass. Days are loaded in blocks whose
+    speeds and volumes take at most max_block_bytes before they are written
+    to the arrays.
+    '''
+    corridors = [corridor for corridor in corridors if len(corridor.station_rows) > 0]
+    if len(corridors) == 0:
+        return
+    first_date = corridors[0].first_date
+    load_speeds_for_dates(corridors, directory,
+                          [first_date + timedelta(days=day) for day in range(first_day, last_day)],
+                          first_day, max_block_bytes)
+
+def load_speeds_for_dates(corridors, directory, dates, first_day=0,
+                          max_block_bytes=None):
+    '''
+    Loads the speeds of each of dates, which need not be consecutive, into
+    consecutive days of the speed arrays of corridors from first_day, as
+    load_speeds_for_days does for a run of days
+    '''
+    corridors = [corridor for corridor in corridors if len(corridor.station_rows) > 0]
+    if len(corridors) == 0 or len(dates) == 0:
+        return
+    detector_set = DetectorSet(corridors)
+    volumes = any(corridor.track_volumes for corridor in corridors)
+    last_day = first_day + len(dates)
+
+    # bytes of one day of speeds (and volumes) of every corridor
+    day_bytes = sum(len(corridor.cubes()) * corridor.speeds.shape[0]
+                    * corridor.speeds.shape[2] * corridor.speeds.itemsize
+                    for corridor in corridors)
+    block_days = len(dates)
+    if max_block_bytes != None:
+        block_days = max(1, min(block_days, max_block_bytes // max(1, day_bytes)))
+    # one reader over every day, so remote files are fetched ahead across
+    # blocks
+    traffic_readers = open_traffic_days(directory, dates)
+
+    for block_first in range(first_day, last_day, block_days):
+        block_last = min(block_first + block_days, last_day)
+        # one block per cube of each corridor, speeds first
+        blocks = []
+        for corridor in corridors:
+            corridor_blocks = []
+            for name, cube in corridor.cubes():
+                block = empty((cube.shape[0], block_last - block_first, cube.shape[2]))
+                block[:] = NAN
+                corridor_blocks.append(block)
+            blocks.append(corridor_blocks)
+
+        for day in range(block_first, block_last):
+            traffic_reader = traffic_readers.next()[1]
+            if traffic_reader == None:
+                # If there is no file for the given day, leave the day's
+                # speeds invalid
+                continue
+            speeds, station_volumes = detector_set.station_data(traffic_reader, volumes)
+            for target, (corridor_index, row) in enumerate(detector_set.targets):
+                corridor_blocks = blocks[corridor_index]
+                corridor_blocks[0][row, day - block_first] = speeds[target]
+                if len(corridor_blocks) > 1:
+                    corridor_blocks[1][row, day - block_first] = station_volumes[target]
+
+        for corridor, corridor_blocks in zip(corridors, blocks):
+            for (name, cube), block in zip(corridor.cubes(), corridor_blocks):
+                cubestore.write_block(cube,
+                                      (slice(None), slice(block_first, block_last)),
+                                      block)
+
+if __name__ == '__main__':
+    from numpy import isnan, allclose, array_equal
+    from trafficreader import TrafficReader
+
+    class TestDetector:
+        def __init__(self, id, speed_limit, field_length=None):
+            self.id = id
+            self._speed_limit = speed_limit
+            self._field_length = field_length
+
+        def speed_limit(self):
+            return self._speed_limit
+
+        def field_length(self, recalc_field_length=False):
+            return self._field_length
+
+    class TestStation:
+        def __init__(self, detectors):
+            self._detectors = detectors
+
+        def detectors(self):
+            return self._detectors
+
+    class TestCorridor:
+        def __init__(self, stations):
+            self._stations = stations
+            self.station_rows = range(len(stations))
+
+        def stations(self):
+            return self._stations
+
+    class CountingReader(TrafficReader):
+        # records the IDs whose data is decoded
+        def __init__(self, trafficfile):
+            TrafficReader.__init__(self, trafficfile)
+            self.decoded = []
+
+        def volumes_for_detector(self, detectorID):
+            self.decoded.append(detectorID)
+            return TrafficReader.volumes_for_detector(self, detectorID)
+
+    def same_values(a, b):
+        return (array_equal(isnan(a), isnan(b))
+                and allclose(a[~isnan(a)], b[~isnan(b)], rtol=1e-12, atol=0))
+
+    # detectors of test/20100104.traffic shared between stations, one of
+    # them with two speed limits, a station without detectors and a
+    # detector without data
+    corridors = [
+        TestCorridor([TestStation([TestDetector('7000', 60), TestDetector('7001', 60)]),
+                      TestStation([]),
+                      TestStation([TestDetector('7001', 60), TestDetector('7002', 55),
+                                   TestDetector('9999', 60)])]),
+        TestCorridor([TestStation([TestDetector('7000', 60), TestDetector('7001', 60)]),
+                      TestStation([TestDetector('7001', 70, 22.0), TestDetector('7003', 60),
+                                   TestDetector('7004', 60), TestDetector('7005', 60)])]),
+    ]
+
+    def reference_station_data(tr, station):
+        # the speeds and volumes of one station from its own detectors
+        speeds = array([tr.onemin_speeds_for_detector(d.id, d.speed_limit(), d.field_length())
+                        for d in station.detectors()])
+        volumes = array([tr.onemin_data_for_detector(d.id)[0] for d in station.detectors()])
+        return (reduce_minute_speeds(impute.average_multilist_array(speeds)),
+                reduce_minute_volumes(impute.average_multilist_array(volumes)
+                                      * len(station.detectors())))
+
+    def testing_detector_set():
+        detector_set = DetectorSet(corridors)
+        assert detector_set.targets == [(0, 0), (0, 2), (1, 0), (1, 1)]
+        assert detector_set.detector_ids == ['7000', '7001', '7002', '9999', '7001', '7003',
+                                             '7004', '7005']
+        assert detector_set.decoded_ids == ['7000', '7001', '7002', '9999', '7003', '7004',
+                                            '7005']
+        tr = CountingReader('test/20100104.traffic')
+        speeds, volumes = detector_set.station_data(tr)
+        # every ID is decoded once, whichever stations share it
+        assert tr.decoded == detector_set.decoded_ids
+        for target, (corridor_index, row) in enumerate(detector_set.targets):
+            station = corridors[corridor_index].stations()[row]
+            expected_speeds, expected_volumes = reference_station_data(tr, station)
+            assert same_values(speeds[target], expected_speeds), target
+            assert same_values(volumes[target], expected_volumes), target
+        assert same_values(detector_set.station_speeds(tr), speeds)
+
+    def testing_volume_totals():
+        # where every detector of a station reports for all 5 minutes, the
+        # station volume is the total of their 1-minute volumes, and a
+        # station with a detector without data counts it at the average of
+        # the others
+        detector_set = DetectorSet(corridors)
+        tr = TrafficReader('test/20100104.traffic')
+        volumes = detector_set.station_data(tr)[1]
+        n_complete = 0
+        for target, (corridor_index, row) in enumerate(detector_set.targets):
+            station = corridors[corridor_index].stations()[row]
+            ids = [d.id for d in station.detectors() if d.id != '9999']
+            minute_volumes = array([tr.onemin_data_for_detector(id)[0] for id in ids])
+            slot_volumes = minute_volumes.reshape(len(ids), 288, 5)
+            complete = ~isnan(slot_volumes).any(axis=(0, 2))
+            totals = slot_volumes.sum(axis=2)[:, complete]
+            scale = len(station.detectors()) / len(ids)
+            assert allclose(volumes[target, complete], scale * totals.sum(axis=0)), target
+            n_complete += complete.sum()
+        assert n_complete > 0
+
+    testing_detector_set()
+    testing_volume_totals()
+    print "loader tests passed"
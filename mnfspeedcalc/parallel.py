@@ -0,0 +1,125 @@
+from multiprocessing import Pool
+from collections import deque
+import cubestore
+
+# number of blocks handed to each worker process. more blocks than workers
+# keeps every process busy when blocks take different amounts of time.
+BLOCKS_PER_WORKER = 4
+
+# number of blocks handed out to each worker process before waiting for
+# results
+PENDING_PER_WORKER = 2
+
+def split_range(n, n_blocks):
+    '''
+    Splits range(n) into at most n_blocks contiguous (start, end) ranges of
+    nearly equal length
+    '''
+    n_blocks = max(1, min(n, n_blocks))
+    bounds = [(n * i) // n_blocks for i in range(n_blocks + 1)]
+    return [(bounds[i], bounds[i+1]) for i in range(n_blocks)
+            if bounds[i] < bounds[i+1]]
+
+def _block_slice(axis, start, end):
+    return (slice(None),) * axis + (slice(start, end),)
+
+def _run_task(task):
+    function, block, kwargs = task
+    return function(block, **kwargs)
+
+def run_blocks(jobs, workers=1, max_block_bytes=None):
+    '''
+    Runs a list of jobs, where each job is a tuple (function, array, axis,
+    kwargs). function(block, **kwargs) must return the processed block and
+    must treat every index along axis independently, so that the array can be
+    split into blocks along that axis and the blocks processed in any order by
+    separate processes. Results are written back into each array.
+
+    If max_block_bytes is given, no block is larger than that, which bounds
+    the memory used for arrays mapped from disk (see cubestore).
+    '''
+    if workers <= 1:
+        for function, array, axis, kwargs in jobs:
+            for start, end in cubestore.blocks(array, axis, max_block_bytes):
+                index = _block_slice(axis, start, end)
+                block = cubestore.read_block(array, index)
+                cubestore.write_block(array, index, function(block, **kwargs))
+        return
+
+    # split every array into blocks along its independent axis
+    targets = []
+    for function, array, axis, kwargs in jobs:
+        ranges = split_range(array.shape[axis], workers * BLOCKS_PER_WORKER)
+        if max_block_bytes != None:
+            small_ranges = cubestore.blocks(array, axis, max_block_bytes)
+            if len(small_ranges) > len(ranges):
+                ranges = small_ranges
+        for start, end in ranges:
+            targets.append((function, array, _block_slice(axis, start, end), kwargs))
+
+    pool = Pool(workers)
+    try:
+        # results are written back in task order, so the output does not
+        # depend on which process handled which block. only a few blocks are
+        # handed out ahead of the one being written back, so that only a few
+        # are held in memory at a time.
+        pending = deque()
+        for function, array, index, kwargs in targets:
+            task = (function, cubestore.read_block(array, index), kwargs)
+            pending.append((array, index, pool.apply_async(_run_task, (task,))))
+            if len(pending) >= PENDING_PER_WORKER * workers:
+                _write_result(pending.popleft())
+        while len(pending) > 0:
+            _write_result(pending.popleft())
+    finally:
+        pool.close()
+        pool.join()
+
+def _write_result(pending_task):
+    array, index, result = pending_task
+    cubestore.write_block(array, index, result.get())
+
+if __name__ == '__main__':
+    from numpy import arange, cumsum, float64
+    import random
+    import shutil
+    import tempfile
+    import time
+
+    def scrambled_cumsum(block, axis):
+        # a cumulative sum along the axis the block was not split on, taking
+        # a random time so that blocks finish out of order
+        time.sleep(random.random() * 0.01)
+        return cumsum(block, axis=axis)
+
+    def testing_run_blocks(directory):
+        store = cubestore.CubeStore(directory, memory_budget=12 * 4000)
+        for workers in [1, 3]:
+            for axis in [0, 1]:
+                expected = cumsum(arange(40 * 30 * 6, dtype=float64).reshape(40, 30, 6),
+                                  axis=1 - axis)
+                in_memory = arange(40 * 30 * 6, dtype=float64).reshape(40, 30, 6)
+                mapped = store.allocate(in_memory.shape)
+                mapped[:] = in_memory
+                for values, max_block_bytes in [(in_memory, None), (mapped, store.block_bytes())]:
+                    run_blocks([(scrambled_cumsum, values, axis, {'axis': 1 - axis})],
+                               workers, max_block_bytes)
+                    assert (values == expected).all(), (workers, axis, max_block_bytes)
+        store.remove()
+
+    def testing_split_range():
+        for n in range(12):
+            for n_blocks in range(1, 6):
+                ranges = split_range(n, n_blocks)
+                assert [i for start, end in ranges for i in range(start, end)] == range(n)
+                assert len(ranges) <= n_blocks
+                lengths = [end - start for start, end in ranges]
+                assert len(lengths) == 0 or max(lengths) - min(lengths) <= 1
+
+    testing_split_range()
+    work_dir = tempfile.mkdtemp()
+    try:
+        testing_run_blocks(work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+    print "parallel tests passed"
@@ -0,0 +1,448 @@
+from os import path, makedirs
+from numpy import load
+import cubestore
+import json
+
+# imputation stages in the order they are run. each stage reads the speeds
+# left by the stage before it.
+IMPUTE_STAGES = ('spatial', 'weekly', 'temporal')
+STAGES = ('load',) + IMPUTE_STAGES
+
+# imputation parameters used when none are given, matching the defaults of the
+# corresponding Corridor methods
+DEFAULT_SETTINGS = {
+    'spatial': {'impute_length': 4, 'input_length': 1},
+    'weekly': {'impute_length': 3, 'input_length': 2},
+    'temporal': {'impute_length': 6, 'input_length': 6},
+}
+
+MANIFEST = 'manifest.json'
+
+def spatial_reach(settings):
+    '''
+    Returns how many stations away spatial imputation with the given
+    settings reaches, for Corridor.drop_dead_stations
+    '''
+    spatial = settings.get('spatial', DEFAULT_SETTINGS['spatial'])
+    return spatial['impute_length'] + spatial['input_length']
+
+def _cube_suffix(cube):
+    # the speeds files have no suffix
+    if cube == 'speeds':
+        return ''
+    return '_' + cube
+
+def _data_location(directory):
+    # the .traffic data a checkpoint is loaded from, as recorded in its
+    # manifest. local paths are made absolute so that the same directory
+    # given another way still matches.
+    if isinstance(directory, basestring) and '://' not in directory:
+        return path.abspath(directory)
+    return getattr(directory, 'location', directory)
+
+class Pipeline:
+    '''
+    Runs load > spatial_impute > weekly_impute > long_temporal_impute for a
+    TMS_Config, optionally writing a checkpoint after every batch of loaded
+    days and after every imputation pass. A pipeline pointed at an existing
+    checkpoint directory resumes from the last completed stage.
+
+    The speeds cover year to end_year (default year). If cube_store (a
+    cubestore.CubeStore) is given, they are kept in memory-mapped files and
+    every stage works within the store's memory budget.
+
+    If volumes is True, the station volumes are loaded, imputed and
+    checkpointed alongside the speeds (see TMS_Config.track_volumes).
+
+    Which stations get rows in the speed arrays depends on the reach of the
+    spatial settings (see Corridor.drop_dead_stations). A checkpoint resumed
+    with a different reach keeps its loaded days: the stations left out of
+    either set of rows have no detectors, so they load as all invalid and
+    the batches are rearranged to the new rows rather than loaded again.
+    '''
+
+    def __init__(self, tms_config, year, directory, checkpoint_dir=None,
+                 batch_days=30, settings=None, workers=1, verbose=False,
+                 end_year=None, cube_store=None, volumes=False):
+        self._verbose = verbose
+        self.tms_config = tms_config
+        self.year = year
+        self.end_year = year if end_year == None else end_year
+        self.cube_store = cube_store
+        self.directory = directory
+        self.checkpoint_dir = checkpoint_dir
+        self.batch_days = batch_days
+        self.workers = workers
+        self.volumes = volumes
+
+        self.settings = {}
+        for stage in IMPUTE_STAGES:
+            self.settings[stage] = dict(DEFAULT_SETTINGS[stage])
+            if settings != None and stage in settings:
+                self.settings[stage].update(settings[stage])
+
+        self._manifest = None
+
+    def run(self, restart_from=None):
+        '''
+        Runs every stage that has not already been completed and returns the
+        TMS_Config holding the imputed speeds. If restart_from names a stage,
+        that stage and all stages after it are run again from the checkpoint
+        of the stage before it.
+        '''
+        if restart_from != None and restart_from not in STAGES:
+            raise ValueError("Unknown stage: " + str(restart_from))
+
+        self.tms_config.drop_dead_stations(spatial_reach(self.settings))
+        self.tms_config.track_volumes(self.volumes)
+        self.tms_config.allocate_speeds_for_years(self.year, self.end_year,
+                                                  self.cube_store)
+        self._open_manifest()
+
+        # forget stages that must be run again, either because they were
+        # requested or because their settings changed
+        completed = self._manifest['completed']
+        for stage in STAGES:
+            if stage not in completed:
+                continue
+            if (stage == restart_from
+                or (stage in IMPUTE_STAGES
+                    and self._manifest['settings'].get(stage) != self.settings[stage])):
+                self._invalidate_from(stage)
+                break
+
+        if restart_from == 'load':
+            self._manifest['loaded_days'] = 0
+
+        # restore the most recent artifact
+        completed = self._manifest['completed']
+        if self._manifest['rows'] != self._rows():
+            # restores the loaded days as it rearranges them
+            self._rearrange_batches()
+            completed = self._manifest['completed']
+        elif len(completed) > 0:
+            self._restore(completed[-1])
+        elif self._manifest['loaded_days'] > 0:
+            self._restore_batches()
+
+        for stage in STAGES:
+            if stage in completed:
+                continue
+            if self._verbose:
+                print str(self) + " running stage " + stage
+            if stage == 'load':
+                self._load()
+            else:
+                self._impute(stage)
+            self._complete(stage)
+
+        return self.tms_config
+
+    def _load(self):
+        n_days = self._n_days()
+        first_day = self._manifest['loaded_days']
+        while first_day < n_days:
+            last_day = min(first_day + self.batch_days, n_days)
+            if self._verbose:
+                print str(self) + " loading days " + str(first_day) + " to " + str(last_day)
+            self.tms_config.load_speeds_for_days(self.directory, first_day, last_day)
+
+            if self.checkpoint_dir != None:
+                for i, corridor in enumerate(self.tms_config.corridors()):
+                    for name, cube in corridor.cubes():
+                        cubestore.save(self._batch_file(first_day, i, name),
+                                       cube[:, first_day:last_day, :],
+                                       corridor.max_block_bytes)
+            self._manifest['loaded_days'] = last_day
+            self._write_manifest()
+            first_day = last_day
+
+    def _impute(self, stage):
+        settings = self.settings[stage]
+        if stage == 'spatial':
+            self.tms_config.spatial_impute(workers=self.workers, **settings)
+        elif stage == 'weekly':
+            self.tms_config.weekly_impute(workers=self.workers, **settings)
+        elif stage == 'temporal':
+            self.tms_config.long_temporal_impute(workers=self.workers, **settings)
+
+    def _complete(self, stage):
+        # the loaded days are already saved in batches by _load
+        if self.checkpoint_dir != None and stage != 'load':
+            for i, corridor in enumerate(self.tms_config.corridors()):
+                for name, cube in corridor.cubes():
+                    cubestore.save(self._stage_file(stage, i, name), cube,
+                                   corridor.max_block_bytes)
+        self._manifest['completed'].append(stage)
+        if stage in IMPUTE_STAGES:
+            self._manifest['settings'][stage] = self.settings[stage]
+        self._write_manifest()
+
+    def _invalidate_from(self, stage):
+        if self._verbose:
+            print str(self) + " invalidating stages from " + stage
+        completed = self._manifest['completed']
+        del completed[STAGES.index(stage):]
+        for later_stage in STAGES[STAGES.index(stage):]:
+            self._manifest['settings'].pop(later_stage, None)
+        self._write_manifest()
+
+    def _restore(self, stage):
+        if stage == 'load':
+            self._restore_batches()
+            return
+        if self._verbose:
+            print str(self) + " restoring checkpoint from stage " + stage
+        for i, corridor in enumerate(self.tms_config.corridors()):
+            for name, cube in corridor.cubes():
+                stage_file = self._stage_file(stage, i, name)
+                # copy in blocks so that a memory-mapped cube is never in
+                # memory whole
+                saved = load(stage_file, mmap_mode='r')
+                for first, last in cubestore.blocks(saved, 0, corridor.max_block_bytes):
+                    cube[first:last] = saved[first:last]
+                    cubestore.release(cube)
+                    cubestore.release(saved)
+                del saved
+
+    def _restore_batches(self, saved_rows=None):
+        # saved_rows are the station rows the batches were written with, if
+        # they differ from the current ones
+        loaded_days = self._manifest['loaded_days']
+        if self._verbose:
+            print str(self) + " restoring " + str(loaded_days) + " loaded days"
+        first_day = 0
+        while first_day < loaded_days:
+            last_day = min(first_day + self.batch_days, loaded_days)
+            for i, corridor in enumerate(self.tms_config.corridors()):
+                if saved_rows != None:
+                    saved_index = dict((station_index, row)
+                                       for row, station_index in enumerate(saved_rows[i]))
+                    rows = [row for row, station_index in enumerate(corridor.station_rows)
+                            if station_index in saved_index]
+                    from_rows = [saved_index[corridor.station_rows[row]] for row in rows]
+                for name, cube in corridor.cubes():
+                    saved = load(self._batch_file(first_day, i, name), mmap_mode='r')
+                    if saved_rows == None:
+                        cube[:, first_day:last_day, :] = saved
+                    else:
+                        cube[rows, first_day:last_day, :] = saved[from_rows]
+                    cubestore.release(cube)
+                    del saved
+            first_day = last_day
+
+    def _rearrange_batches(self):
+        # the loaded days were saved with other station rows; the imputation
+        # stages are run again with the new rows, and the batches are
+        # rewritten with them. the manifest records no loaded days while the
+        # batches are rewritten, so that an interrupted rewrite loads again.
+        saved_rows = self._manifest['rows']
+        loaded_days = self._manifest['loaded_days']
+        if self._verbose:
+            print str(self) + " rearranging the loaded days to new station rows"
+        completed = self._manifest['completed']
+        for stage in IMPUTE_STAGES:
+            if stage in completed:
+                self._invalidate_from(stage)
+                break
+        load_completed = 'load' in completed
+        self._manifest['rows'] = self._rows()
+        self._manifest['loaded_days'] = 0
+        self._manifest['completed'] = []
+        self._write_manifest()
+        if loaded_days == 0:
+            return
+
+        self._manifest['loaded_days'] = loaded_days
+        self._restore_batches(saved_rows)
+        if self.checkpoint_dir != None:
+            for first_day in range(0, loaded_days, self.batch_days):
+                last_day = min(first_day + self.batch_days, loaded_days)
+                for i, corridor in enumerate(self.tms_config.corridors()):
+                    for name, cube in corridor.cubes():
+                        cubestore.save(self._batch_file(first_day, i, name),
+                                       cube[:, first_day:last_day, :],
+                                       corridor.max_block_bytes)
+        if load_completed:
+            self._manifest['completed'] = ['load']
+        self._write_manifest()
+
+    def _n_days(self):
+        corridors = self.tms_config.corridors()
+        if len(corridors) == 0:
+            return 0
+        return corridors[0].speeds.shape[1]
+
+    def _layout(self):
+        # identifies the corridors and stations a checkpoint was written for:
+        # the IDs of the stations of each corridor, in order
+        return [[corridor._route, corridor._dir,
+                 [station.id for station in corridor.stations()]]
+                for corridor in self.tms_config.corridors()]
+
+    def _rows(self):
+        # the stations with rows in each speed array, which change with the
+        # spatial reach
+        return [[int(i) for i in corridor.station_rows]
+                for corridor in self.tms_config.corridors()]
+
+    def _open_manifest(self):
+        self._manifest = {
+            'year': self.year,
+            'end_year': self.end_year,
+            'directory': _data_location(self.directory),
+            'batch_days': self.batch_days,
+            'layout': self._layout(),
+            'rows': self._rows(),
+            'n_days': self._n_days(),
+            'volumes': self.volumes,
+            'loaded_days': 0,
+            'completed': [],
+            'settings': {},
+        }
+
+        if self.checkpoint_dir == None:
+            return
+
+        manifest_file = path.join(self.checkpoint_dir, MANIFEST)
+        if not path.exists(manifest_file):
+            if not path.isdir(self.checkpoint_dir):
+                makedirs(self.checkpoint_dir)
+            self._write_manifest()
+            return
+
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+        for key in ('year', 'end_year', 'directory', 'batch_days', 'layout', 'n_days',
+                    'volumes'):
+            if manifest.get(key) != self._manifest[key]:
+                raise ValueError("Checkpoint in " + self.checkpoint_dir
+                                 + " was written with a different " + key)
+        if 'rows' not in manifest:
+            raise ValueError("Checkpoint in " + self.checkpoint_dir + " has no station rows")
+        self._manifest = manifest
+
+    def _write_manifest(self):
+        if self.checkpoint_dir == None:
+            return
+        with cubestore.replacing(path.join(self.checkpoint_dir, MANIFEST)) as tmp_file:
+            with open(tmp_file, 'w') as f:
+                json.dump(self._manifest, f, indent=1, sort_keys=True)
+
+    def _batch_file(self, first_day, corridor_index, cube='speeds'):
+        return path.join(self.checkpoint_dir,
+                         'load_%03d_%03d%s.npy' % (first_day, corridor_index,
+                                                   _cube_suffix(cube)))
+
+    def _stage_file(self, stage, corridor_index, cube='speeds'):
+        return path.join(self.checkpoint_dir,
+                         '%s_%03d%s.npy' % (stage, corridor_index, _cube_suffix(cube)))
+
+if __name__ == '__main__':
+    from numpy import isnan, array_equal
+    import shutil
+    import sys
+    import tempfile
+
+    sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+    from mnfspeedcalc import TMS_Config
+
+    class Interrupted(Exception):
+        pass
+
+    class InterruptedPipeline(Pipeline):
+        # stops the run once the manifest written satisfies stop
+        def __init__(self, stop, *args, **kwargs):
+            Pipeline.__init__(self, *args, **kwargs)
+            self._stop = stop
+
+        def _write_manifest(self):
+            Pipeline._write_manifest(self)
+            if self._stop(self._manifest):
+                raise Interrupted()
+
+    def run(checkpoint_dir=None, settings=None, restart_from=None, pipeline_class=Pipeline,
+            *args):
+        # the speeds and volumes of every station with a row, by station ID
+        config = TMS_Config("test/metro_config_gaps.xml", verbose=False)
+        pipeline = pipeline_class(*(args + (config, 2010, "test", checkpoint_dir, 100,
+                                            settings)), volumes=True)
+        pipeline.run(restart_from)
+        values = {}
+        for corridor in config.corridors():
+            for row, station_index in enumerate(corridor.station_rows):
+                values[corridor.stations()[station_index].id] = [cube[row] for name, cube
+                                                                 in corridor.cubes()]
+        return values
+
+    def same_values(a, b):
+        if sorted(a) != sorted(b):
+            return False
+        for station_id in a:
+            for x, y in zip(a[station_id], b[station_id]):
+                if not (array_equal(isnan(x), isnan(y))
+                        and array_equal(x[~isnan(x)], y[~isnan(y)])):
+                    return False
+        return True
+
+    def testing_checkpoints():
+        default = run()
+        # a reach of 2 stations rather than 5 leaves more stations out
+        narrow = {'spatial': {'impute_length': 1, 'input_length': 1}}
+        narrow_values = run(None, narrow)
+        assert len(narrow_values) < len(default)
+        references = {}
+        work_dir = tempfile.mkdtemp()
+        try:
+            checkpoint_dir = path.join(work_dir, 'fresh')
+            assert same_values(run(checkpoint_dir), default)
+            # resumed from every stage completed
+            assert same_values(run(checkpoint_dir), default)
+
+            # resumed after runs interrupted part way through loading and
+            # between stages
+            for name, stop in [('load', lambda manifest: manifest['loaded_days'] == 200),
+                               ('weekly', lambda manifest: 'spatial' in manifest['completed'])]:
+                checkpoint_dir = path.join(work_dir, 'interrupted_' + name)
+                try:
+                    run(checkpoint_dir, None, None, InterruptedPipeline, stop)
+                    assert False, 'not interrupted'
+                except Interrupted:
+                    pass
+                assert same_values(run(checkpoint_dir), default), name
+
+            # restarted from each stage with other settings, and resumed with
+            # a spatial reach that leaves out other stations
+            checkpoint_dir = path.join(work_dir, 'restarted')
+            run(checkpoint_dir)
+            for stage, settings in [('load', None),
+                                    ('spatial', {'spatial': {'impute_length': 3,
+                                                             'input_length': 2}}),
+                                    ('weekly', {'weekly': {'impute_length': 2,
+                                                           'input_length': 1}}),
+                                    ('temporal', {'temporal': {'impute_length': 4,
+                                                               'input_length': 3}}),
+                                    ('spatial', narrow),
+                                    (None, None),
+                                    (None, narrow),
+                                    ('weekly', None)]:
+                key = str(settings)
+                if key not in references:
+                    references[key] = run(None, settings)
+                assert same_values(run(checkpoint_dir, settings, stage), references[key]), \
+                    (stage, settings)
+
+            # a checkpoint interrupted while loading resumes with another reach
+            checkpoint_dir = path.join(work_dir, 'interrupted_reach')
+            try:
+                run(checkpoint_dir, None, None, InterruptedPipeline,
+                    lambda manifest: manifest['loaded_days'] == 200)
+            except Interrupted:
+                pass
+            assert same_values(run(checkpoint_dir, narrow), narrow_values)
+        finally:
+            shutil.rmtree(work_dir)
+
+    testing_checkpoints()
+    print "pipeline tests passed"
@@ -0,0 +1,387 @@
+'''
+Approximate average speeds from a sample of days.
+
+The days of a day group are split into strata by day of the week and season,
+and a DaySampler loads, imputes and averages only the days it samples from
+each stratum. The average speed of a station over the group is estimated
+with the stratified ratio estimator of the sums and counts of its valid
+speeds, the same ratio average_speeds_for_day_groups takes over every day,
+and its confidence interval from the linearized variance of that estimator.
+Strata sampled only once are paired with their neighbour for a pooled
+variance (collapsed strata), so one day from every stratum already gives an
+interval, if a wider one. More days can be added until the intervals are
+narrow enough; once every day of the group is sampled the interval closes.
+
+Each sampled day is imputed on its own: spatial and long temporal imputation
+work within a day, but weekly imputation needs the same day of the week in
+neighbouring weeks, which are rarely sampled, so it is not run.
+'''
+from __future__ import division
+from datetime import timedelta
+from math import erf, sqrt
+from numpy import empty, zeros, array, isnan, errstate, nanmax, NAN
+from pipeline import DEFAULT_SETTINGS, IMPUTE_STAGES, spatial_reach
+import random
+
+def z_value(confidence):
+    '''
+    Returns the z such that a normal variable lies within z standard
+    deviations of its mean with probability confidence
+    '''
+    low, high = 0.0, 10.0
+    for i in range(60):
+        middle = (low + high) / 2
+        if erf(middle / sqrt(2)) < confidence:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+def season(day):
+    '''
+    Returns the season of a date: 0 for December to February, 1 for March to
+    May, 2 for June to August and 3 for September to November
+    '''
+    return (day.month % 12) // 3
+
+def strata_of_days(dates, day_mask):
+    '''
+    Returns a dictionary mapping (weekday, season) to the list of the indices
+    of the dates in day_mask falling on that day of the week and season
+    '''
+    strata = {}
+    for i, day in enumerate(dates):
+        if day_mask[i]:
+            strata.setdefault((day.weekday(), season(day)), []).append(i)
+    return strata
+
+def neighbour_pairs(keys):
+    '''
+    Pairs (weekday, season) stratum keys with the key of the same day of the
+    week in the next or previous season, seasons running round the year.
+    Returns a tuple (pairs, unpaired) of the list of pairs of keys and the
+    list of the keys left without a neighbour.
+    '''
+    keys = set(keys)
+    pairs = []
+    for weekday in sorted(set(key[0] for key in keys)):
+        seasons = [s for s in range(4) if (weekday, s) in keys]
+        # pair along the seasons from one without a previous neighbour, so
+        # that a run of 2n seasons makes n pairs
+        first = 0
+        for i, s in enumerate(seasons):
+            if (weekday, (s - 1) % 4) not in keys:
+                first = i
+                break
+        seasons = seasons[first:] + seasons[:first]
+        i = 0
+        while i + 1 < len(seasons):
+            if seasons[i + 1] == (seasons[i] + 1) % 4:
+                pairs.append(((weekday, seasons[i]), (weekday, seasons[i + 1])))
+                keys.discard((weekday, seasons[i]))
+                keys.discard((weekday, seasons[i + 1]))
+                i += 2
+            else:
+                i += 1
+    return pairs, sorted(keys)
+
+class DaySampler:
+    '''
+    Estimates the average speed of every station of a TMS_Config over the
+    days of day_mask (a boolean array over the n_days days from first_date)
+    during the specified time interval, from a stratified sample of those
+    days. settings are the imputation settings, as for Pipeline. The speed
+    arrays of tms_config are reallocated to hold the days sampled in each
+    round side by side, from cube_store if it is given.
+
+    A station with detectors that gets no valid speed on any day sampled from
+    every stratum, such as one whose detectors never report, is taken to have
+    no data at all: it no longer holds up the sampling and is reported as
+    NAN.
+    '''
+
+    def __init__(self, tms_config, directory, first_date, n_days, day_mask,
+                 start_time=None, end_time=None, settings=None, seed=None,
+                 workers=1, verbose=False, cube_store=None):
+        self._verbose = verbose
+        self.tms_config = tms_config
+        self.cube_store = cube_store
+        self.directory = directory
+        self.first_date = first_date
+        self.start_time = start_time
+        self.end_time = end_time
+        self.workers = workers
+
+        self.settings = {}
+        for stage in IMPUTE_STAGES:
+            self.settings[stage] = dict(DEFAULT_SETTINGS[stage])
+            if settings != None and stage in settings:
+                self.settings[stage].update(settings[stage])
+
+        dates = [first_date + timedelta(days=i) for i in range(n_days)]
+        self.strata = strata_of_days(dates, day_mask)
+        self._keys = sorted(self.strata.keys())
+        self._random = random.Random(seed)
+        # the days of each stratum not sampled yet, in the order they will be
+        # drawn
+        self._unsampled = {}
+        for key in self._keys:
+            self._unsampled[key] = list(self.strata[key])
+            self._random.shuffle(self._unsampled[key])
+        self._sampled = dict((key, []) for key in self._keys)
+
+        # (station x day) sums and counts of the valid speeds of each
+        # corridor in the time interval, filled in for the sampled days
+        tms_config.drop_dead_stations(spatial_reach(self.settings))
+        self._corridors = [corridor for corridor in tms_config.corridors()
+                           if len(corridor.stations()) > 0]
+        # stations with detectors have to get an estimate before the sample
+        # is large enough, until they turn out to be silent (see
+        # _drop_silent_stations)
+        self._live_ids = set(station.id for corridor in self._corridors
+                             for station in corridor.stations()
+                             if len(station.detectors()) > 0)
+        self._day_sums = []
+        self._day_counts = []
+        for corridor in self._corridors:
+            self._day_sums.append(zeros((len(corridor.station_rows), n_days)))
+            self._day_counts.append(zeros((len(corridor.station_rows), n_days)))
+
+    def n_sampled(self):
+        return sum(len(days) for days in self._sampled.values())
+
+    def n_days(self):
+        return sum(len(days) for days in self.strata.values())
+
+    def sample(self, days_per_stratum=1):
+        '''
+        Samples up to days_per_stratum more days from every stratum
+        '''
+        new_days = []
+        for key in self._keys:
+            new_days.extend(self._draw(key, days_per_stratum))
+        self._load(new_days)
+
+    def refine(self, n_days):
+        '''
+        Samples up to n_days more days, giving more days to the strata that
+        contribute most to the width of the confidence intervals
+        '''
+        weights = self._stratum_weights()
+        added = dict((key, 0) for key in self._keys)
+        for i in range(n_days):
+            best = None
+            best_gain = -1
+            for key in self._keys:
+                if len(self._unsampled[key]) <= added[key]:
+                    continue
+                # the variance a stratum contributes falls as 1 / n
+                n = len(self._sampled[key]) + added[key]
+                gain = weights[key] / (n * (n + 1)) if n > 0 else float('inf')
+                if gain > best_gain:
+                    best, best_gain = key, gain
+            if best == None:
+                break
+            added[best] += 1
+
+        new_days = []
+        for key in self._keys:
+            new_days.extend(self._draw(key, added[key]))
+        self._load(new_days)
+
+    def _draw(self, key, n):
+        days = self._unsampled[key][:n]
+        del self._unsampled[key][:n]
+        self._sampled[key].extend(days)
+        return days
+
+    def _load(self, days):
+        days = sorted(days)
+        if len(days) == 0:
+            return
+        if self._verbose:
+            print str(self) + " loading " + str(len(days)) + " days"
+        # every corridor at once, so each .traffic file is read once. day i
+        # of the speed arrays holds sampled day days[i].
+        tms_config = self.tms_config
+        tms_config.allocate_speeds_for_dates(self.first_date + timedelta(days=days[0]),
+                                             len(days), self.cube_store)
+        tms_config.load_speeds_for_dates(self.directory, [self.first_date + timedelta(days=day)
+                                                          for day in days])
+        tms_config.spatial_impute(workers=self.workers, **self.settings['spatial'])
+        tms_config.long_temporal_impute(workers=self.workers, **self.settings['temporal'])
+        for corridor, day_sums, day_counts in zip(self._corridors, self._day_sums,
+                                                  self._day_counts):
+            sums, counts = corridor.window_sums(self.start_time, self.end_time)
+            day_sums[:, days] = sums
+            day_counts[:, days] = counts
+        self._drop_silent_stations()
+
+    def _drop_silent_stations(self):
+        # once every stratum is sampled, stations with detectors but no valid
+        # speed on any sampled day stop counting as live
+        if any(len(self._sampled[key]) == 0 for key in self._keys):
+            return
+        sampled = sorted(day for days in self._sampled.values() for day in days)
+        for corridor, day_counts in zip(self._corridors, self._day_counts):
+            silent = (day_counts[:, sampled] == 0).all(axis=1)
+            for row in silent.nonzero()[0]:
+                self._live_ids.discard(corridor.stations()[corridor.station_rows[row]].id)
+
+    def _stratum_weights(self):
+        # N_h times the residual standard deviation of each stratum, averaged
+        # over the stations. strata without a variance estimate use the
+        # pooled one, and every stratum gets N_h if there is none at all.
+        deviations = dict((key, []) for key in self._keys)
+        for day_sums, day_counts in zip(self._day_sums, self._day_counts):
+            ratio, variances, pooled = self._residual_variances(day_sums, day_counts)
+            for key in self._keys:
+                v = variances.get(key, pooled)
+                with errstate(invalid='ignore'):
+                    deviations[key].extend(list(v[~isnan(v)] ** 0.5))
+        weights = {}
+        for key in self._keys:
+            size = len(self.strata[key])
+            if len(deviations[key]) > 0:
+                weights[key] = size * sum(deviations[key]) / len(deviations[key])
+            else:
+                weights[key] = size
+        return weights
+
+    def _totals(self, day_sums, day_counts):
+        # stratified estimates of the total sum and count of each station
+        total_sums = zeros(day_sums.shape[0])
+        total_counts = zeros(day_sums.shape[0])
+        for key in self._keys:
+            days = self._sampled[key]
+            if len(days) == 0:
+                continue
+            size = len(self.strata[key])
+            total_sums += size * day_sums[:, days].mean(axis=1)
+            total_counts += size * day_counts[:, days].mean(axis=1)
+        return total_sums, total_counts
+
+    def _residual_variances(self, day_sums, day_counts):
+        # the ratio estimate of each station, the variance of the residuals
+        # sum - ratio * count within each stratum with at least two sampled
+        # days and their pooled variance. strata with one sampled day add to
+        # the pooled variance in pairs of neighbours (the same day of the
+        # week in successive seasons, see neighbour_pairs): half the squared
+        # difference of their residuals, which overstates the variance by any
+        # difference between the two strata. a stratum with one sampled day
+        # and no neighbour with one adds nothing, and uses the pooled variance
+        # of the others.
+        total_sums, total_counts = self._totals(day_sums, day_counts)
+        with errstate(invalid='ignore', divide='ignore'):
+            ratio = total_sums / total_counts
+        variances = {}
+        pooled_sum = zeros(day_sums.shape[0])
+        pooled_degrees = 0
+        single = {}
+        for key in self._keys:
+            days = self._sampled[key]
+            residuals = day_sums[:, days] - ratio[:, None] * day_counts[:, days]
+            if len(days) == 1:
+                single[key] = residuals[:, 0]
+            if len(days) < 2:
+                continue
+            variances[key] = residuals.var(axis=1, ddof=1)
+            pooled_sum += (len(days) - 1) * variances[key]
+            pooled_degrees += len(days) - 1
+        for first, second in neighbour_pairs(single.keys())[0]:
+            pooled_sum += (single[first] - single[second]) ** 2 / 2
+            pooled_degrees += 1
+        if pooled_degrees > 0:
+            pooled = pooled_sum / pooled_degrees
+        else:
+            pooled = empty(day_sums.shape[0])
+            pooled[:] = NAN
+        return ratio, variances, pooled
+
+    def _corridor_estimates(self, day_sums, day_counts, z):
+        # (station x 2) array of the ratio estimate and the half width of its
+        # confidence interval
+        ratio, variances, pooled = self._residual_variances(day_sums, day_counts)
+        total_counts = self._totals(day_sums, day_counts)[1]
+        variance = zeros(day_sums.shape[0])
+        for key in self._keys:
+            n = len(self._sampled[key])
+            size = len(self.strata[key])
+            if n == 0:
+                # an unsampled stratum leaves the estimate open
+                variance[:] = NAN
+                continue
+            if n == size:
+                continue
+            v = variances.get(key, pooled)
+            variance += size ** 2 * (1 - n / size) * v / n
+        estimates = empty((day_sums.shape[0], 2))
+        with errstate(invalid='ignore', divide='ignore'):
+            estimates[:, 0] = ratio
+            estimates[:, 1] = z * variance ** 0.5 / total_counts
+        # stations without any valid speed have no estimate at all
+        estimates[isnan(ratio), 1] = NAN
+        return estimates
+
+    def estimates(self, confidence=0.95):
+        '''
+        Returns a dictionary mapping station ids to an array holding the
+        estimated average speed of that station and the half width of its
+        confidence interval at the given level. The half width is NAN while
+        the sample is too small to estimate it.
+        '''
+        z = z_value(confidence)
+        average_speeds = {}
+        for corridor, day_sums, day_counts in zip(self._corridors, self._day_sums,
+                                                  self._day_counts):
+            average_speeds.update(corridor._selected_station_dict(
+                self._corridor_estimates(day_sums, day_counts, z)))
+        return average_speeds
+
+    def run(self, target=1.0, confidence=0.95, initial_days=1, round_days=None,
+            max_days=None):
+        '''
+        Samples initial_days days from every stratum, then round_days more
+        days at a time (default one per stratum) until the confidence interval
+        of every station with valid speeds is within target of its estimate
+        and every station with detectors has an estimate, unless it had no
+        valid speed on any day sampled so far from every stratum, every day is
+        sampled or max_days days are sampled. Returns the estimates (see estimates).
+        '''
+        if round_days == None:
+            round_days = len(self._keys)
+        if max_days == None:
+            max_days = self.n_days()
+
+        self.sample(initial_days)
+        while True:
+            estimates = self.estimates(confidence)
+            # the width of a station with detectors but no estimate yet is NAN
+            widths = array([values[1] for id, values in estimates.items()
+                            if not isnan(values[0]) or id in self._live_ids])
+            if len(widths) == 0 or not isnan(widths).any():
+                widest = nanmax(widths) if len(widths) > 0 else 0
+            else:
+                widest = NAN
+            if self._verbose:
+                print (str(self) + " sampled " + str(self.n_sampled()) + " of "
+                       + str(self.n_days()) + " days, widest interval +/- " + str(widest))
+            if widest <= target or self.n_sampled() >= min(max_days, self.n_days()):
+                return estimates
+            self.refine(min(round_days, max_days - self.n_sampled()))
+
+if __name__ == '__main__':
+    def testing_neighbour_pairs():
+        # every season of a weekday pairs up, a run round the end of the year
+        # pairs across it, and an odd one out or a lone season is left
+        assert neighbour_pairs([(0, 0), (0, 1), (0, 2), (0, 3)]) == \
+            ([((0, 0), (0, 1)), ((0, 2), (0, 3))], [])
+        assert neighbour_pairs([(2, 3), (2, 0)]) == ([((2, 3), (2, 0))], [])
+        assert neighbour_pairs([(0, 3), (0, 0), (0, 1)]) == ([((0, 3), (0, 0))], [(0, 1)])
+        # never across weekdays, whatever lies between in key order
+        assert neighbour_pairs([(0, 0), (0, 2), (1, 1), (1, 2), (1, 3)]) == \
+            ([((1, 1), (1, 2))], [(0, 0), (0, 2), (1, 3)])
+        assert neighbour_pairs([(0, 2), (1, 0)]) == ([], [(0, 2), (1, 0)])
+
+    testing_neighbour_pairs()
+    print "sampling tests passed"
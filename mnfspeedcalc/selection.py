@@ -0,0 +1,90 @@
+from numpy import array, argsort, searchsorted, radians, sin, cos, arcsin, sqrt
+
+# mean radius of the earth
+EARTH_RADIUS_MILES = 3958.8
+
+def distance_miles(lat1, lon1, lat2, lon2):
+    '''
+    Returns the great-circle distance in miles between points given in
+    degrees. Arguments may be numpy arrays.
+    '''
+    lat1, lon1, lat2, lon2 = radians(lat1), radians(lon1), radians(lat2), radians(lon2)
+    a = (sin((lat2 - lat1) / 2) ** 2
+         + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_MILES * arcsin(sqrt(a))
+
+class StationIndex:
+    '''
+    Index over the stations of a list of corridors, used to select stations by
+    location, corridor or ID. Stations are kept sorted by latitude so that
+    location queries only look at the stations in the matching latitude band.
+    '''
+
+    def __init__(self, corridors):
+        self.ids = []
+        self.routes = []
+        lats = []
+        lons = []
+        for corridor in corridors:
+            for station in corridor.stations():
+                self.ids.append(station.id)
+                self.routes.append((corridor._route, corridor._dir))
+                lats.append(station._latlon[0])
+                lons.append(station._latlon[1])
+
+        self.lats = array(lats, dtype=float)
+        self.lons = array(lons, dtype=float)
+        self._lat_order = argsort(self.lats, kind='mergesort')
+        self._sorted_lats = self.lats[self._lat_order]
+
+    def _in_lat_band(self, min_lat, max_lat):
+        # indices of the stations with min_lat <= lat <= max_lat
+        first = searchsorted(self._sorted_lats, min_lat, side='left')
+        last = searchsorted(self._sorted_lats, max_lat, side='right')
+        return self._lat_order[first:last]
+
+    def in_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        '''
+        Returns the set of IDs of the stations inside the given bounding box
+        '''
+        candidates = self._in_lat_band(min_lat, max_lat)
+        lons = self.lons[candidates]
+        inside = candidates[(min_lon <= lons) & (lons <= max_lon)]
+        return set(self.ids[i] for i in inside)
+
+    def near(self, lat, lon, radius_miles):
+        '''
+        Returns the set of IDs of the stations within radius_miles of the given
+        point
+        '''
+        # one degree of latitude is about 69 miles everywhere
+        lat_radius = radius_miles / 69.0
+        candidates = self._in_lat_band(lat - lat_radius, lat + lat_radius)
+        distances = distance_miles(lat, lon, self.lats[candidates], self.lons[candidates])
+        inside = candidates[distances <= radius_miles]
+        return set(self.ids[i] for i in inside)
+
+    def on_routes(self, routes):
+        '''
+        Returns the set of IDs of the stations on the given corridors. Each
+        entry of routes is either a route name ("I-94") or a route name and a
+        direction separated by a slash ("I-94/EB").
+        '''
+        wanted = set()
+        for route in routes:
+            if '/' in route:
+                wanted.add(tuple(route.rsplit('/', 1)))
+            else:
+                wanted.add((route, None))
+
+        selected = set()
+        for station_id, (route, direction) in zip(self.ids, self.routes):
+            if (route, direction) in wanted or (route, None) in wanted:
+                selected.add(station_id)
+        return selected
+
+    def with_ids(self, station_ids):
+        '''
+        Returns the set of the given station IDs that are present in the index
+        '''
+        return set(self.ids) & set(station_ids)
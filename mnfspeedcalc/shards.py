@@ -0,0 +1,414 @@
+'''
+Splits a run into shards that can be executed on separate machines and merges
+their partial results.
+
+plan_shards writes a plan directory holding plan.json and one self-contained
+shard file per (corridor, date block). Each shard carries the corridor
+definition, the stations to use and the settings, so run_shard needs only the
+shard file and a path to the .traffic data. run_shard writes a partial result
+next to the shard file, and merge_shards combines the partials of a plan into
+the same averages a single run would give.
+
+Loading and spatial imputation treat every day on its own, so they can run on
+any block of days. Weekly imputation runs along the days of the week through
+the whole date span, so it cannot; it and long temporal imputation treat every
+station on its own instead. A corridor split into several date blocks gets
+"cube" shards, which write their loaded and spatially imputed block of the
+speed array, and "stations" shards, which assemble the whole span of a block
+of stations from those partial results, run weekly and long temporal
+imputation on it and write the per-day speed sums and counts of the averaging
+interval. The stations shards (stations_*.json) can only run once every cube
+shard of their corridor has finished, and need its partial result in the plan
+directory. A corridor whose date span is a single block gets one "sums" shard,
+which runs every stage itself and writes only the sums and counts.
+merge_shards then only adds up sums.
+'''
+from __future__ import division
+from datetime import datetime, timedelta
+from os import path, makedirs
+from numpy import savez, load, concatenate
+from pipeline import DEFAULT_SETTINGS, IMPUTE_STAGES, spatial_reach
+import cubestore
+import daymask
+import json
+import xml.etree.cElementTree as ET
+
+PLAN = 'plan.json'
+STATIONS_PREFIX = 'stations_'
+
+def _format_date(day):
+    return day.strftime('%Y-%m-%d')
+
+def _parse_date(text):
+    return datetime.strptime(text, '%Y-%m-%d').date()
+
+def _parse_time(text):
+    if text == None:
+        return None
+    return datetime.strptime(text, '%H:%M:%S').time()
+
+def _write_json(filename, data):
+    with cubestore.replacing(filename) as tmp_file:
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+
+def _corridor_spec(corridor):
+    return {
+        'route': corridor._route,
+        'dir': corridor._dir,
+        'node': ET.tostring(corridor._node),
+        'station_ids': [station.id for station in corridor.stations()],
+        'selected_ids': None if corridor.selected_ids == None else sorted(corridor.selected_ids),
+    }
+
+def _corridor_from_spec(spec, verbose=False):
+    # imported here, as the package imports this module
+    from mnfspeedcalc import Corridor
+    corridor = Corridor(ET.fromstring(spec['node']), verbose=verbose)
+    stations = dict((station.id, station) for station in corridor.stations())
+    corridor.station_list = [stations[station_id] for station_id in spec['station_ids']]
+    corridor.index_stations()
+    if spec['selected_ids'] != None:
+        corridor.selected_ids = set(spec['selected_ids'])
+    return corridor
+
+def _station_blocks(n_rows, n_blocks):
+    # splits n_rows rows of the speed array into up to n_blocks (first, last)
+    # blocks of about the same size, and one empty block if there are none
+    n_blocks = max(1, min(n_blocks, n_rows))
+    bounds = [n_rows * block // n_blocks for block in range(n_blocks + 1)]
+    return zip(bounds[:-1], bounds[1:])
+
+def plan_shards(tms_config, year, directory, plan_dir, end_year=None,
+                shard_days=None, settings=None, start_time=None,
+                end_time=None, day_groups=None, holidays=None,
+                station_shards=None):
+    '''
+    Writes a plan for averaging the speeds of the corridors of tms_config over
+    year to end_year (default year) into plan_dir, split into shards of at
+    most shard_days days (default the whole span). Weekly and long temporal
+    imputation of a corridor split by days are split into up to
+    station_shards stations shards (default as many as it has date blocks).
+    settings, start_time, end_time, day_groups and holidays are as for
+    Pipeline and TMS_Config.average_speeds_for_day_groups; day_groups None
+    averages over weekdays, as average_weekday_speeds does. Returns the list
+    of shard files, with the stations shards after all the others.
+    '''
+    if end_year == None:
+        end_year = year
+    first_date = datetime(year, 1, 1).date()
+    n_days = (datetime(end_year, 12, 31).date() - first_date).days + 1
+    if shard_days == None or shard_days <= 0:
+        shard_days = n_days
+
+    full_settings = {}
+    for stage in IMPUTE_STAGES:
+        full_settings[stage] = dict(DEFAULT_SETTINGS[stage])
+        if settings != None and stage in settings:
+            full_settings[stage].update(settings[stage])
+
+    if not path.isdir(plan_dir):
+        makedirs(plan_dir)
+
+    plan = {
+        'year': year,
+        'end_year': end_year,
+        'first_date': _format_date(first_date),
+        'n_days': n_days,
+        'settings': full_settings,
+        'start_time': None if start_time == None else start_time.strftime('%H:%M:%S'),
+        'end_time': None if end_time == None else end_time.strftime('%H:%M:%S'),
+        'day_groups': None if day_groups == None else list(day_groups),
+        'holidays': None if holidays == None else sorted(_format_date(day) for day in holidays),
+        'corridors': [],
+    }
+
+    shard_files = []
+    station_shard_files = []
+    for corridor in tms_config.corridors():
+        if len(corridor.stations()) == 0:
+            continue
+        corridor_spec = _corridor_spec(corridor)
+        blocks = [(first_day, min(first_day + shard_days, n_days))
+                  for first_day in range(0, n_days, shard_days)]
+        kind = 'sums' if len(blocks) == 1 else 'cube'
+        corridor_spec['kind'] = kind
+        corridor_spec['shards'] = []
+
+        for first_day, last_day in blocks:
+            name = 'shard_%04d' % len(shard_files)
+            shard = {
+                'corridor': corridor_spec,
+                'kind': kind,
+                'directory': directory,
+                'first_date': plan['first_date'],
+                'n_days': n_days,
+                'first_day': first_day,
+                'last_day': last_day,
+                'settings': full_settings,
+                'start_time': plan['start_time'],
+                'end_time': plan['end_time'],
+                'partial': name + ('.npz' if kind == 'sums' else '.npy'),
+            }
+            shard_file = path.join(plan_dir, name + '.json')
+            _write_json(shard_file, shard)
+            shard_files.append(shard_file)
+            corridor_spec['shards'].append({'first_day': first_day,
+                                            'last_day': last_day,
+                                            'partial': shard['partial']})
+
+        if kind == 'cube':
+            # the rows run_shard keeps, split into blocks of stations
+            rows_corridor = _corridor_from_spec(corridor_spec)
+            rows_corridor.drop_dead_stations(spatial_reach(full_settings))
+            corridor_spec['station_shards'] = []
+            for first_row, last_row in _station_blocks(len(rows_corridor.station_rows),
+                                                       station_shards or len(blocks)):
+                name = STATIONS_PREFIX + '%04d' % len(station_shard_files)
+                shard = {
+                    'corridor': corridor_spec,
+                    'kind': 'stations',
+                    'first_date': plan['first_date'],
+                    'n_days': n_days,
+                    'first_row': first_row,
+                    'last_row': last_row,
+                    'settings': full_settings,
+                    'start_time': plan['start_time'],
+                    'end_time': plan['end_time'],
+                    'partial': name + '.npz',
+                }
+                shard_file = path.join(plan_dir, name + '.json')
+                _write_json(shard_file, shard)
+                station_shard_files.append(shard_file)
+                corridor_spec['station_shards'].append({'first_row': first_row,
+                                                        'last_row': last_row,
+                                                        'partial': shard['partial']})
+
+        plan['corridors'].append(corridor_spec)
+
+    _write_json(path.join(plan_dir, PLAN), plan)
+    return shard_files + station_shard_files
+
+def run_shard(shard_file, directory=None, workers=1, cube_store=None,
+              verbose=False):
+    '''
+    Runs the shard described by shard_file and writes its partial result next
+    to it. directory overrides the location of the .traffic data recorded in
+    the shard. Returns the name of the partial result file. Raises IOError if
+    a stations shard is run before the cube shards it reads have finished.
+    '''
+    with open(shard_file) as f:
+        shard = json.load(f)
+    plan_dir = path.dirname(shard_file)
+    partial_file = path.join(plan_dir, shard['partial'])
+
+    corridor = _corridor_from_spec(shard['corridor'], verbose)
+    settings = shard['settings']
+    first_date = _parse_date(shard['first_date'])
+    corridor.drop_dead_stations(spatial_reach(settings))
+
+    if shard['kind'] == 'stations':
+        missing = [path.join(plan_dir, cube_shard['partial'])
+                   for cube_shard in shard['corridor']['shards']
+                   if not path.exists(path.join(plan_dir, cube_shard['partial']))]
+        if len(missing) > 0:
+            raise IOError("Missing partial results: " + ", ".join(missing))
+        first_row, last_row = shard['first_row'], shard['last_row']
+        if verbose:
+            print "Imputing stations " + str(first_row) + " to " + str(last_row)
+        corridor.station_rows = corridor.station_rows[first_row:last_row]
+        corridor.allocate_speeds_for_dates(first_date, shard['n_days'], cube_store)
+        _assemble_speeds(corridor, plan_dir, shard['corridor']['shards'],
+                         slice(first_row, last_row))
+        _impute_and_save_sums(partial_file, corridor, shard, workers)
+        return partial_file
+
+    if directory == None:
+        directory = shard['directory']
+    first_day = shard['first_day']
+    last_day = shard['last_day']
+
+    if shard['kind'] == 'cube':
+        corridor.allocate_speeds_for_dates(first_date + timedelta(days=first_day),
+                                           last_day - first_day, cube_store)
+    else:
+        corridor.allocate_speeds_for_dates(first_date, shard['n_days'], cube_store)
+
+    if verbose:
+        print "Loading days " + str(first_day) + " to " + str(last_day)
+    corridor.load_speeds_for_days(directory, 0, last_day - first_day)
+    corridor.spatial_impute(workers=workers, **settings['spatial'])
+
+    if shard['kind'] == 'cube':
+        cubestore.save(partial_file, corridor.speeds, corridor.max_block_bytes)
+        return partial_file
+
+    _impute_and_save_sums(partial_file, corridor, shard, workers)
+    return partial_file
+
+def _impute_and_save_sums(filename, corridor, shard, workers=1):
+    # runs the stages after spatial imputation and writes the sums and counts
+    # of the averaging interval
+    settings = shard['settings']
+    corridor.weekly_impute(workers=workers, **settings['weekly'])
+    corridor.long_temporal_impute(workers=workers, **settings['temporal'])
+    day_sums, day_counts = corridor.window_sums(_parse_time(shard['start_time']),
+                                                _parse_time(shard['end_time']))
+    with cubestore.replacing(filename) as tmp_file:
+        with open(tmp_file, 'wb') as f:
+            savez(f, day_sums=day_sums, day_counts=day_counts)
+
+def _assemble_speeds(corridor, plan_dir, cube_shards, rows=slice(None)):
+    # copies the given rows of the partial results of the cube shards into
+    # the speed array of corridor
+    for cube_shard in cube_shards:
+        block = load(path.join(plan_dir, cube_shard['partial']), mmap_mode='r')
+        cubestore.write_block(corridor.speeds,
+                              (slice(None), slice(cube_shard['first_day'], cube_shard['last_day'])),
+                              block[rows])
+        del block
+
+def missing_partials(plan_dir):
+    '''
+    Returns the list of partial result files of the plan in plan_dir that have
+    not been written yet
+    '''
+    with open(path.join(plan_dir, PLAN)) as f:
+        plan = json.load(f)
+    missing = []
+    for corridor_spec in plan['corridors']:
+        for shard in corridor_spec['shards'] + corridor_spec.get('station_shards', []):
+            partial_file = path.join(plan_dir, shard['partial'])
+            if not path.exists(partial_file):
+                missing.append(partial_file)
+    return missing
+
+def merge_shards(plan_dir, verbose=False):
+    '''
+    Combines the partial results of the plan in plan_dir. Returns a tuple
+    (day_groups, speeds) where day_groups is as given to plan_shards and
+    speeds maps station ids to an array of the average speed for each day
+    group, as TMS_Config.average_speeds_for_day_groups does for a single run.
+    Raises IOError if any partial result is missing, and ValueError if a
+    corridor split by days has no stations shards.
+    '''
+    missing = missing_partials(plan_dir)
+    if len(missing) > 0:
+        raise IOError("Missing partial results: " + ", ".join(missing))
+
+    with open(path.join(plan_dir, PLAN)) as f:
+        plan = json.load(f)
+    first_date = _parse_date(plan['first_date'])
+    n_days = plan['n_days']
+    settings = plan['settings']
+    holidays = None
+    if plan['holidays'] != None:
+        holidays = set(_parse_date(day) for day in plan['holidays'])
+    day_groups = plan['day_groups']
+    if day_groups == None:
+        day_groups = ['weekday']
+    day_masks = daymask.day_group_masks(day_groups,
+                                        daymask.dates_from_start(first_date, n_days),
+                                        holidays)
+
+    average_speeds = {}
+    for corridor_spec in plan['corridors']:
+        if verbose:
+            print "Merging " + corridor_spec['route'] + " " + corridor_spec['dir']
+        corridor = _corridor_from_spec(corridor_spec, verbose)
+        # the partial results hold the rows run_shard kept
+        corridor.drop_dead_stations(spatial_reach(settings))
+        if corridor_spec['kind'] == 'sums':
+            sums = load(path.join(plan_dir, corridor_spec['shards'][0]['partial']))
+            day_sums, day_counts = sums['day_sums'], sums['day_counts']
+        else:
+            if len(corridor_spec.get('station_shards', [])) == 0:
+                raise ValueError("Plan in " + plan_dir + " has no stations shards for corridor "
+                                 + corridor_spec['route'] + " " + corridor_spec['dir'])
+            # the sums of the blocks of stations, in row order
+            all_sums = [load(path.join(plan_dir, shard['partial']))
+                        for shard in corridor_spec['station_shards']]
+            day_sums = concatenate([sums['day_sums'] for sums in all_sums])
+            day_counts = concatenate([sums['day_counts'] for sums in all_sums])
+
+        group_speeds = daymask.group_averages(day_sums, day_counts, day_masks)
+        average_speeds.update(corridor._selected_station_dict(group_speeds))
+
+    return plan['day_groups'], average_speeds
+
+if __name__ == '__main__':
+    from datetime import time
+    from numpy import isnan, array_equal
+    import shutil
+    import sys
+    import tempfile
+
+    sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+    from mnfspeedcalc import TMS_Config, Pipeline
+
+    metro_config = "test/metro_config_gaps.xml"
+    start_time = time(hour=7)
+    end_time = time(hour=9)
+    day_groups = ['weekday', 'weekend', 'mon']
+    holidays = set([datetime(2010, 1, 1).date(), datetime(2010, 7, 5).date()])
+
+    def single_run():
+        config = TMS_Config(metro_config, verbose=False)
+        Pipeline(config, 2010, "test").run()
+        day_masks = daymask.day_group_masks(day_groups, config.dates(), holidays)
+        return config.average_speeds_for_day_groups(day_masks, start_time, end_time)
+
+    def sharded_run(plan_dir, shard_days=None, station_shards=None):
+        shard_files = plan_shards(TMS_Config(metro_config, verbose=False), 2010, "test",
+                                  plan_dir, shard_days=shard_days, start_time=start_time,
+                                  end_time=end_time, day_groups=day_groups,
+                                  holidays=holidays, station_shards=station_shards)
+        for shard_file in shard_files:
+            run_shard(shard_file)
+        merged_groups, speeds = merge_shards(plan_dir)
+        assert merged_groups == day_groups
+        return shard_files, speeds
+
+    def same_speeds(a, b):
+        if sorted(a) != sorted(b):
+            return False
+        for station_id in a:
+            x, y = a[station_id], b[station_id]
+            if not (array_equal(isnan(x), isnan(y)) and array_equal(x[~isnan(x)], y[~isnan(y)])):
+                return False
+        return True
+
+    def testing_shards():
+        expected = single_run()
+        assert not all(isnan(speeds).all() for speeds in expected.values())
+        work_dir = tempfile.mkdtemp()
+        try:
+            # one sums shard
+            plan_dir = path.join(work_dir, 'sums')
+            shard_files, speeds = sharded_run(plan_dir)
+            assert len(shard_files) == 1
+            assert same_speeds(speeds, expected)
+
+            # four cube shards by days and three stations shards
+            plan_dir = path.join(work_dir, 'cubes')
+            shard_files, speeds = sharded_run(plan_dir, 100, 3)
+            assert [path.basename(f).startswith(STATIONS_PREFIX)
+                    for f in shard_files] == [False] * 4 + [True] * 3
+            assert same_speeds(speeds, expected)
+
+            # a stations shard cannot run before the cube shards, nor a plan
+            # merge before every shard
+            plan_dir = path.join(work_dir, 'early')
+            shard_files = plan_shards(TMS_Config(metro_config, verbose=False), 2010, "test",
+                                      plan_dir, shard_days=100)
+            for call in [lambda: run_shard(shard_files[-1]), lambda: merge_shards(plan_dir)]:
+                try:
+                    call()
+                    assert False, 'no IOError'
+                except IOError:
+                    pass
+        finally:
+            shutil.rmtree(work_dir)
+
+    testing_shards()
+    print "shards tests passed"
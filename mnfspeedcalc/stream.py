@@ -0,0 +1,502 @@
+from __future__ import division
+from trafficreader import speeds_from_occupancies, MAX_OCCUPANCY
+from datetime import datetime, timedelta
+from numpy import (NAN, array, asarray, empty, zeros, errstate, isnan, where,
+                   maximum, savez, load)
+from impute import _average_valid
+import cubestore
+import json
+
+SAMPLES_PER_DAY = 2880
+INTERVALS_PER_DAY = 288
+
+# rolling windows kept by default, in minutes
+DEFAULT_WINDOWS = (15, 60)
+
+# the arrays of the state of a day saved by StreamEngine.save
+STATE_ARRAYS = ('_n_lengths', '_sum_lengths', '_n_flow', '_sum_flow_volumes',
+                '_sum_flow_occupancies', '_sum_flow_occupancies2', '_half_volumes',
+                '_half_occupancies', '_interval_minutes', 'minute_speeds',
+                'fivemin_speeds', 'day_fivemin_speeds')
+
+class StreamEngine:
+    '''
+    Calculates station speeds from 30-second detector samples as they arrive,
+    for same-day use. Speeds follow the model of
+    TrafficReader.onemin_speeds_for_detectors and station speeds the averaging
+    rules of the batch calculation: 1-minute station speeds average the
+    detectors as impute.average_multilist does and 5-minute speeds average the
+    1-minute speeds as impute.average_list does.
+
+    Two things differ from the batch calculation, because they would need
+    samples that have not arrived yet:
+
+    - field lengths and free-flow speeds are estimated from the samples
+      received so far that day, so early speeds use rougher estimates than
+      the batch calculation, which estimates from the whole day
+    - missing 1-minute speeds are not imputed before averaging
+
+    Samples are fed in ticks holding one 30-second sample of every detector
+    (ingest_tick) or one detector at a time (ingest). The work per tick is
+    constant in the length of the stream, including the rolling window
+    averages. The whole state can be saved with save and restored with
+    load_stream_engine for the same TMS_Config.
+    '''
+
+    def __init__(self, tms_config, windows=DEFAULT_WINDOWS,
+                 recalc_field_lengths=False, verbose=False):
+        self._verbose = verbose
+
+        self.station_ids = []
+        self.detector_ids = []
+        detector_stations = []
+        speed_limits = []
+        field_lengths = []
+        for corridor in tms_config.corridors():
+            for station in corridor.stations():
+                for detector in station.detectors():
+                    self.detector_ids.append(detector.id)
+                    detector_stations.append(len(self.station_ids))
+                    speed_limits.append(detector.speed_limit())
+                    field_lengths.append(detector.field_length(recalc_field_lengths))
+                self.station_ids.append(station.id)
+
+        n_stations = len(self.station_ids)
+        n_detectors = len(self.detector_ids)
+        # a detector shared by several stations has a row for each of them
+        self._detector_rows = {}
+        for row, detector_id in enumerate(self.detector_ids):
+            self._detector_rows.setdefault(detector_id, []).append(row)
+        self._speed_limits = array(speed_limits, dtype=float)
+        self._given_lengths = array(field_lengths, dtype=float)
+        self._given = ~isnan(self._given_lengths)
+
+        # the detectors of each station as a padded (stations x detectors)
+        # table of rows. padding points at an extra row that is always NAN.
+        detector_stations = array(detector_stations, dtype=int)
+        self._n_station_detectors = zeros(n_stations, dtype=int)
+        for station in detector_stations:
+            self._n_station_detectors[station] += 1
+        width = max([1] + list(self._n_station_detectors))
+        self._station_rows = empty((n_stations, width), dtype=int)
+        self._station_rows[:] = n_detectors
+        for station in range(n_stations):
+            rows = (detector_stations == station).nonzero()[0]
+            self._station_rows[station, :len(rows)] = rows
+        # stations with 2 or fewer detectors need every detector, as in
+        # impute.average_multilist
+        self._max_invalid = where(self._n_station_detectors <= 2, 0, 1)
+
+        # rolling windows hold 5-minute speeds
+        self.windows = tuple(windows)
+        self._rings = [_RingAverage(max(1, window // 5), n_stations)
+                       for window in self.windows]
+
+        self.day = None
+        self.next_sample = 0
+        self.late_samples = 0
+        self._pending_tick = None
+        self._reset_outputs()
+
+    def _reset_outputs(self):
+        n_stations = len(self.station_ids)
+        n_detectors = len(self.detector_ids)
+
+        # running sums over the valid 1-minute data of the day
+        self._n_lengths = zeros(n_detectors)
+        self._sum_lengths = zeros(n_detectors)
+        self._n_flow = zeros(n_detectors)
+        self._sum_flow_volumes = zeros(n_detectors)
+        self._sum_flow_occupancies = zeros(n_detectors)
+        self._sum_flow_occupancies2 = zeros(n_detectors)
+
+        # first half of the current minute
+        self._half_volumes = _nans(n_detectors)
+        self._half_occupancies = _nans(n_detectors)
+        # 1-minute station speeds of the current 5-minute interval
+        self._interval_minutes = _nans((n_stations, 5))
+
+        self.minute_speeds = _nans(n_stations)
+        self.fivemin_speeds = _nans(n_stations)
+        self.day_fivemin_speeds = _nans((n_stations, INTERVALS_PER_DAY))
+
+    def station_row(self, station_id):
+        return self.station_ids.index(station_id)
+
+    def ingest_tick(self, day, sample_index, volumes, occupancies):
+        '''
+        Adds one 30-second sample of every detector. volumes and occupancies
+        are decoded values (as returned by TrafficReader.volumes_for_detector
+        and occupancies_for_detector, with None or NAN for invalid samples)
+        in the order of detector_ids. Samples must arrive in time order;
+        missing ticks are treated as invalid samples, and a tick older than
+        the last one is counted in late_samples and ignored.
+        '''
+        self._flush_pending()
+        if not self._advance_to(day, sample_index):
+            self.late_samples += len(self.detector_ids)
+            return
+        self._process_tick(_as_samples(volumes), _as_samples(occupancies))
+
+    def ingest(self, detector_id, day, sample_index, volume, occupancy):
+        '''
+        Adds a single 30-second sample of one detector. Samples are collected
+        into ticks, and a tick is processed once a sample of a later tick
+        arrives or flush is called. A detector shared by several stations
+        counts for each of them, as in ingest_tick. Samples of unknown
+        detectors are ignored.
+        '''
+        rows = self._detector_rows.get(detector_id)
+        if rows == None:
+            return
+        if self._pending_tick != None and self._pending_tick[0:2] != (day, sample_index):
+            if self._is_before(day, sample_index, *self._pending_tick[0:2]):
+                self.late_samples += 1
+                return
+            self._flush_pending()
+        if self._pending_tick == None:
+            if self._is_before(day, sample_index, self.day, self.next_sample):
+                self.late_samples += 1
+                return
+            n_detectors = len(self.detector_ids)
+            self._pending_tick = (day, sample_index, _nans(n_detectors), _nans(n_detectors))
+        pending_volumes, pending_occupancies = self._pending_tick[2:]
+        pending_volumes[rows] = NAN if volume == None else volume
+        pending_occupancies[rows] = NAN if occupancy == None else occupancy
+
+    def flush(self):
+        '''
+        Processes the samples collected by ingest for the current tick
+        '''
+        self._flush_pending()
+
+    def _flush_pending(self):
+        if self._pending_tick == None:
+            return
+        day, sample_index, volumes, occupancies = self._pending_tick
+        self._pending_tick = None
+        if self._advance_to(day, sample_index):
+            self._process_tick(volumes, occupancies)
+
+    def _is_before(self, day, sample_index, other_day, other_sample):
+        if other_day == None:
+            return False
+        return (day, sample_index) < (other_day, other_sample)
+
+    def _advance_to(self, day, sample_index):
+        '''
+        Fills the ticks missing before the given one with invalid samples.
+        Returns False if the tick is in the past.
+        '''
+        if sample_index < 0 or sample_index >= SAMPLES_PER_DAY:
+            raise ValueError("Sample index out of range: " + str(sample_index))
+        if self.day == None:
+            self._start_day(day)
+        if day < self.day or (day == self.day and sample_index < self.next_sample):
+            return False
+
+        n_detectors = len(self.detector_ids)
+        if day > self.day:
+            while self.next_sample < SAMPLES_PER_DAY:
+                self._process_tick(_nans(n_detectors), _nans(n_detectors))
+            if day - self.day > timedelta(days=1):
+                # whole days are missing; the windows would only hold
+                # invalid speeds
+                for ring in self._rings:
+                    ring.clear()
+            self._start_day(day)
+        while self.next_sample < sample_index:
+            self._process_tick(_nans(n_detectors), _nans(n_detectors))
+        return True
+
+    def _start_day(self, day):
+        if self._verbose and self.day != None:
+            print "Finished " + str(self.day)
+        self.day = day
+        self.next_sample = 0
+        self._reset_outputs()
+
+    def _process_tick(self, volumes, occupancies):
+        sample_index = self.next_sample
+        self.next_sample += 1
+        if sample_index % 2 == 0:
+            self._half_volumes = volumes
+            self._half_occupancies = occupancies
+            return
+
+        # combine the two samples into 1-minute data, as onemin_data does
+        minute = sample_index // 2
+        vols = self._half_volumes + volumes
+        occs = (self._half_occupancies + occupancies) / 2
+        detector_speeds = self._detector_speeds(vols, occs)
+
+        # 1-minute station speeds, averaging the detectors of each station
+        padded = empty(len(detector_speeds) + 1)
+        padded[:-1] = detector_speeds
+        padded[-1] = NAN
+        self.minute_speeds = _average_valid(padded[self._station_rows], -1,
+                                            self._n_station_detectors,
+                                            self._max_invalid)
+        self._interval_minutes[:, minute % 5] = self.minute_speeds
+
+        if minute % 5 == 4:
+            interval = minute // 5
+            self.fivemin_speeds = _average_valid(self._interval_minutes, -1, 5, 1)
+            self.day_fivemin_speeds[:, interval] = self.fivemin_speeds
+            self._interval_minutes[:] = NAN
+            for ring in self._rings:
+                ring.push(self.fivemin_speeds)
+
+    def _detector_speeds(self, vols, occs):
+        '''
+        Updates the running field length and free-flow speed estimates with
+        one minute of data and returns the 1-minute detector speeds. The
+        estimates use the formulas of trafficreader.onemin_speeds on the sums
+        of the day so far.
+        '''
+        speed_limits = self._speed_limits
+        with errstate(invalid='ignore', divide='ignore'):
+            positive = 0 < occs
+            valid_lengths = positive & (occs <= 0.1) & (vols != 0) & ~isnan(vols)
+            lengths = where(valid_lengths,
+                            (speed_limits * occs * 5280) / (vols * 60), NAN)
+            self._n_lengths += valid_lengths
+            self._sum_lengths += where(valid_lengths, lengths, 0)
+
+            valid_flow = positive & (occs < 0.1) & (vols > 0)
+            self._n_flow += valid_flow
+            self._sum_flow_volumes += where(valid_flow, vols, 0)
+            self._sum_flow_occupancies += where(valid_flow, occs, 0)
+            self._sum_flow_occupancies2 += where(valid_flow, occs ** 2, 0)
+
+            avg_field_length = where(self._given, self._given_lengths,
+                                     self._sum_lengths / self._n_lengths)
+            lengths = where(self._given, self._given_lengths, lengths)
+            no_length = ~self._given & (self._n_lengths == 0)
+            avg_field_length[no_length] = 25
+
+            # the densities of onemin_speeds summed over the valid minutes:
+            # sum(k * occ - (k * occ) ** 2 / (k * MAX_OCCUPANCY)) with
+            # k = 5280 / avg_field_length
+            densities = ((5280 / avg_field_length)
+                         * (self._sum_flow_occupancies
+                            - self._sum_flow_occupancies2 / MAX_OCCUPANCY))
+            free_flow_speed = (60 * self._sum_flow_volumes) / densities
+            no_flow = no_length | (self._n_flow == 0)
+            free_flow_speed = where(no_flow, speed_limits, free_flow_speed)
+
+        return speeds_from_occupancies(occs, free_flow_speed, avg_field_length,
+                                       lengths)
+
+    def rolling_averages(self):
+        '''
+        Returns a dict mapping each window length (minutes) to an array of the
+        average 5-minute speed of every station over the most recent window.
+        Stations with no valid speed in a window are NAN.
+        '''
+        return dict((window, ring.average())
+                    for window, ring in zip(self.windows, self._rings))
+
+    def save(self, filename):
+        '''
+        Writes the state of the engine to the .npz file filename: the running
+        sums, the speeds of the day and the rolling windows as arrays, and a
+        JSON header holding the stations, detectors and position in the
+        stream
+        '''
+        self._flush_pending()
+        header = {
+            'station_ids': self.station_ids,
+            'detector_ids': self.detector_ids,
+            'windows': list(self.windows),
+            'day': None if self.day == None else self.day.strftime('%Y-%m-%d'),
+            'next_sample': self.next_sample,
+            'late_samples': self.late_samples,
+            'ring_positions': [ring.position for ring in self._rings],
+        }
+        arrays = dict((name, getattr(self, name)) for name in STATE_ARRAYS)
+        for i, ring in enumerate(self._rings):
+            arrays['ring_%d_values' % i] = ring.values
+            arrays['ring_%d_sums' % i] = ring.sums
+            arrays['ring_%d_counts' % i] = ring.counts
+        with cubestore.replacing(filename) as tmp_file:
+            with open(tmp_file, 'wb') as f:
+                savez(f, header=array(json.dumps(header)), **arrays)
+
+    def _restore(self, saved, header):
+        self.day = None
+        if header['day'] != None:
+            self.day = datetime.strptime(header['day'], '%Y-%m-%d').date()
+        self.next_sample = header['next_sample']
+        self.late_samples = header['late_samples']
+        for name in STATE_ARRAYS:
+            setattr(self, name, saved[name])
+        for i, ring in enumerate(self._rings):
+            ring.position = header['ring_positions'][i]
+            ring.values = saved['ring_%d_values' % i]
+            ring.sums = saved['ring_%d_sums' % i]
+            ring.counts = saved['ring_%d_counts' % i]
+
+class _RingAverage:
+    '''
+    Running average of the last length rows pushed, per column, ignoring NAN
+    values. Each push subtracts the row leaving the window from the running
+    sums and adds the new one.
+    '''
+
+    def __init__(self, length, width):
+        self.length = length
+        self.values = _nans((length, width))
+        self.position = 0
+        self.sums = zeros(width)
+        self.counts = zeros(width)
+
+    def clear(self):
+        self.values[:] = NAN
+        self.sums[:] = 0
+        self.counts[:] = 0
+
+    def push(self, row):
+        valid = ~isnan(row)
+        old = self.values[self.position]
+        old_valid = ~isnan(old)
+        self.sums += where(valid, row, 0) - where(old_valid, old, 0)
+        self.counts += valid.astype(float) - old_valid
+        self.values[self.position] = row
+        self.position = (self.position + 1) % self.length
+        if self.position == 0:
+            # add up again once per cycle so that rounding errors do not
+            # build up in the running sums
+            stored = ~isnan(self.values)
+            self.sums = where(stored, self.values, 0).sum(axis=0)
+            self.counts = stored.sum(axis=0).astype(float)
+
+    def average(self):
+        with errstate(invalid='ignore', divide='ignore'):
+            return where(self.counts > 0, self.sums / maximum(self.counts, 1), NAN)
+
+def load_stream_engine(filename, tms_config, recalc_field_lengths=False,
+                       verbose=False):
+    '''
+    Returns the StreamEngine for tms_config saved to filename by
+    StreamEngine.save. Raises ValueError if it was saved for other stations
+    or detectors.
+    '''
+    with open(filename, 'rb') as f:
+        saved = load(f, allow_pickle=False)
+        header = json.loads(str(saved['header']))
+        engine = StreamEngine(tms_config, header['windows'], recalc_field_lengths, verbose)
+        for key in ('station_ids', 'detector_ids'):
+            if header[key] != getattr(engine, key):
+                raise ValueError("Stream state in " + filename + " was saved with different "
+                                 + key)
+        engine._restore(saved, header)
+    return engine
+
+def _nans(shape):
+    values = empty(shape)
+    values[...] = NAN
+    return values
+
+def _as_samples(values):
+    # None becomes NAN
+    return asarray(values, dtype=float)
+
+if __name__ == '__main__':
+    from datetime import date
+    from numpy import array_equal, allclose
+    from trafficreader import TrafficReader, onemin_speeds
+    from os import path
+    import shutil
+    import sys
+    import tempfile
+
+    sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+    from mnfspeedcalc import TMS_Config
+
+    # stations with three detectors, two detectors and a detector without
+    # data in test/20100104.traffic
+    METRO_CONFIG = """<tms_config>
+<corridor route="T-1" dir="NB">
+  <r_node name="rnd_0" station_id="A" n_type="Station" s_limit="60" lat="45.00" lon="-93.00">
+    <detector name="7000" lane="1" field="22.0" />
+    <detector name="7001" lane="2" field="24.0" />
+    <detector name="7002" lane="3" field="20.0" />
+  </r_node>
+  <r_node name="rnd_1" station_id="B" n_type="Station" s_limit="55" lat="45.01" lon="-93.00">
+    <detector name="7003" lane="1" field="22.0" />
+    <detector name="7004" lane="2" field="22.0" />
+  </r_node>
+  <r_node name="rnd_2" station_id="C" n_type="Station" s_limit="70" lat="45.02" lon="-93.00">
+    <detector name="7005" lane="1" field="22.0" />
+    <detector name="9999" lane="2" field="22.0" />
+  </r_node>
+</corridor>
+</tms_config>
+"""
+
+    def same_values(a, b):
+        return (array_equal(isnan(a), isnan(b))
+                and allclose(a[~isnan(a)], b[~isnan(b)], rtol=1e-12, atol=0))
+
+    def batch_minute_speeds(engine, tr):
+        # the 1-minute station speeds of the whole day as the batch
+        # calculation gives them, before any imputation
+        vols, occs = tr.onemin_data_for_detectors(engine.detector_ids)
+        lengths = [None if isnan(length) else length for length in engine._given_lengths]
+        detector_speeds = empty((len(engine.detector_ids) + 1, 1440))
+        detector_speeds[:-1] = onemin_speeds(vols, occs, engine._speed_limits, lengths)
+        detector_speeds[-1] = NAN
+        return _average_valid(detector_speeds[engine._station_rows], -2,
+                              engine._n_station_detectors.reshape(-1, 1),
+                              engine._max_invalid.reshape(-1, 1))
+
+    def feed(engine, volumes, occupancies, first_sample, last_sample, day=date(2010, 1, 4)):
+        for sample_index in range(first_sample, last_sample):
+            engine.ingest_tick(day, sample_index, volumes[:, sample_index],
+                               occupancies[:, sample_index])
+
+    def testing_stream(work_dir, recalc_field_lengths):
+        config_file = path.join(work_dir, 'metro_config.xml')
+        with open(config_file, 'w') as f:
+            f.write(METRO_CONFIG)
+        config = TMS_Config(config_file, verbose=False)
+        tr = TrafficReader('test/20100104.traffic')
+        engine = StreamEngine(config, recalc_field_lengths=recalc_field_lengths)
+        volumes = array([tr.volumes_for_detector(d) for d in engine.detector_ids])
+        occupancies = array([tr.occupancies_for_detector(d) for d in engine.detector_ids])
+
+        # the state saved at noon carries on as the engine itself does
+        feed(engine, volumes, occupancies, 0, SAMPLES_PER_DAY // 2)
+        state_file = path.join(work_dir, 'engine.npz')
+        engine.save(state_file)
+        resumed = load_stream_engine(state_file, config, recalc_field_lengths)
+        assert resumed.day == engine.day and resumed.next_sample == engine.next_sample
+        feed(engine, volumes, occupancies, SAMPLES_PER_DAY // 2, SAMPLES_PER_DAY)
+        feed(resumed, volumes, occupancies, SAMPLES_PER_DAY // 2, SAMPLES_PER_DAY)
+        assert same_values(engine.day_fivemin_speeds, resumed.day_fivemin_speeds)
+        for window, averages in engine.rolling_averages().items():
+            assert same_values(resumed.rolling_averages()[window], averages), window
+
+        # by the last minute the estimates use the whole day, as the batch
+        # calculation does
+        expected = batch_minute_speeds(engine, tr)
+        assert same_values(engine.minute_speeds, expected[:, -1])
+        assert not isnan(engine.minute_speeds[:2]).any()
+        assert isnan(engine.minute_speeds[2])
+
+        # a state saved for other detectors is refused
+        other = TMS_Config("test/metro_config_gaps.xml", verbose=False)
+        try:
+            load_stream_engine(state_file, other)
+            assert False, 'loaded for other detectors'
+        except ValueError:
+            pass
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        testing_stream(work_dir, False)
+        testing_stream(work_dir, True)
+    finally:
+        shutil.rmtree(work_dir)
+    print "stream tests passed"
@@ -1,11 +1,312 @@
 from __future__ import division
-from readers import list_occupancies, list_volumes
+from readers import (list_occupancies, list_volumes, decode_volumes,
+                     decode_occupancies)
+from archive import (YearArchive, build_year_archive, find_year_archive,
+                     archive_filename_for_year, ARCHIVE_EXTENSION,
+                     VOLUME_TYPE, OCCUPANCY_TYPE, SAMPLES_PER_DAY)
+from storage import (Storage, LocalStorage, HTTPStorage, TarStorage,
+                     CachedStorage, open_storage, fetch_many, is_missing,
+                     or_none_if_missing)
 from zipfile import ZipFile
+from cStringIO import StringIO
 from os import path
 from math import exp
-from collections import deque
 from numpy import *
 
+# given in published report
+THETA = 0.15
+MAX_OCCUPANCY = 0.98
+
+def onemin_data(volume30s, occupancy30s):
+    '''
+    Combines 30-second volumes and occupancies (arrays of 2880 samples, or
+    (detectors x 2880) arrays) into 1-minute volumes and occupancies. A minute
+    is invalid if any of its four samples is invalid. See
+    TrafficReader.onemin_data_for_detector.
+    '''
+
+    volume30s = asarray(volume30s, dtype=float)
+    occupancy30s = asarray(occupancy30s, dtype=float)
+    pairs = volume30s.shape[:-1] + (volume30s.shape[-1] // 2, 2)
+    volume_pairs = volume30s.reshape(pairs)
+    occupancy_pairs = occupancy30s.reshape(pairs)
+
+    invalid = (isnan(volume_pairs).any(axis=-1)
+               | isnan(occupancy_pairs).any(axis=-1))
+
+    volume1m = volume_pairs[..., 0] + volume_pairs[..., 1]
+    occupancy1m = (occupancy_pairs[..., 0] + occupancy_pairs[..., 1]) / 2
+    volume1m[invalid] = NAN
+    occupancy1m[invalid] = NAN
+
+    return volume1m, occupancy1m
+
+def onemin_speeds(vols, occs, speed_limits, field_lengths=None):
+    '''
+    Calculates 1-minute speeds for many detectors at once. vols and occs are
+    (detectors x 1440) arrays of 1-minute volumes and occupancies, and
+    speed_limits and field_lengths hold one value per detector. Detectors
+    whose field length is None (or NAN), or all detectors if field_lengths is
+    None, get field lengths calculated from their volume and occupancy, as in
+    TrafficReader.field_lengths. Returns a (detectors x 1440) array of speeds.
+    '''
+
+    vols = asarray(vols, dtype=float).reshape(-1, 1440)
+    occs = asarray(occs, dtype=float).reshape(-1, 1440)
+    n_detectors = vols.shape[0]
+    speed_limits = asarray(speed_limits, dtype=float).reshape(-1, 1)
+    if field_lengths is None:
+        field_lengths = [None] * n_detectors
+    given_lengths = array(field_lengths, dtype=float).reshape(-1, 1)
+    given = ~isnan(given_lengths)
+
+    # comparisons against NAN are False, which is what the masks want
+    with errstate(invalid='ignore', divide='ignore'):
+        positive = 0 < occs
+        low = positive & (occs <= 0.1)
+
+        # if we were not given a field length, try to calculate from volume
+        # and occupancy
+        valid_lengths = low & (vols != 0) & ~isnan(vols)
+        lengths = empty(vols.shape)
+        lengths[:] = NAN
+        lengths[valid_lengths] = ( (speed_limits * occs * 5280)
+                                   / (vols * 60) )[valid_lengths]
+        n_lengths = count_nonzero(valid_lengths, axis=1).reshape(-1, 1)
+        calculated_lengths = (where(valid_lengths, lengths, 0).sum(axis=1).reshape(-1, 1)
+                              / n_lengths)
+
+        # if we were given a field length, use it
+        avg_field_length = where(given, given_lengths, calculated_lengths)
+        lengths = where(given, given_lengths, lengths)
+
+        # if we were not given a field length and we are unable to calculate
+        # it, use the speed limit as the free-flow speed and assume an average
+        # field length of 25 ft.
+        no_length = ~given & (n_lengths == 0)
+        avg_field_length[no_length] = 25
+
+        # otherwise, calculate the free-flow speed from the volume, occupancy,
+        # and field length (see TrafficReader.free_flow_speed)
+        max_density = (MAX_OCCUPANCY * 5280) / avg_field_length
+        valid_flow = positive & (occs < 0.1) & (vols > 0)
+        densities = ( (occs * 5280 / avg_field_length)
+                      - ( ((occs * 5280 / avg_field_length) ** 2)
+                          / max_density) )
+        free_flow_speed = ( (60 * where(valid_flow, vols, 0).sum(axis=1))
+                            / where(valid_flow, densities, 0).sum(axis=1) ).reshape(-1, 1)
+
+        # if the free-flow speed is still None, use the speed limit anyway
+        no_flow = no_length | (count_nonzero(valid_flow, axis=1).reshape(-1, 1) == 0)
+        free_flow_speed = where(no_flow, speed_limits, free_flow_speed)
+
+    return speeds_from_occupancies(occs, free_flow_speed, avg_field_length,
+                                   lengths)
+
+def speeds_from_occupancies(occs, free_flow_speed, avg_field_length, lengths):
+    '''
+    Applies the speed model to an array of 1-minute occupancies, given the
+    free-flow speed and average field length (arrays that broadcast against
+    occs) and the field length of each sample. Occupancies of 0 or NAN give
+    NAN speeds.
+    '''
+
+    with errstate(invalid='ignore', divide='ignore'):
+        # Three cases for speed calculation:
+        # Case 1: 0 < occupancy < 0.1
+        case1 = free_flow_speed * (1 - ( (occs * avg_field_length) / lengths ))
+        # Case 2: 0.1 <= occupancy <= 0.15
+        case2 = free_flow_speed * (1 - occs)
+        # Case 3: 0.15 < occupancy
+        case3 = ( free_flow_speed
+                  * (1 - THETA)
+                  * exp(-1 * (1 / THETA) * ( (100 * occs) / (100 - THETA) )) )
+
+        speeds = empty(case1.shape)
+        speeds[:] = NAN
+        low = (0 < occs) & (occs <= 0.1)
+        speeds[low] = case1[low]
+        medium = (0.1 < occs) & (occs <= 0.15)
+        speeds[medium] = case2[medium]
+        high = 0.15 < occs
+        speeds[high] = case3[high]
+
+    return speeds
+
+def fivemin_values(values, total=False):
+    '''
+    Combines 1-minute values (an array of 1440 values, or a (detectors x 1440)
+    array) into 5-minute values, averaging each 5 minutes or, if total is
+    True, adding them up. A 5-minute value is invalid (NAN) if any of its
+    minutes is invalid.
+    '''
+
+    values = asarray(values, dtype=float)
+    blocks = values.reshape(values.shape[:-1] + (values.shape[-1] // 5, 5))
+    # NAN propagates through the sum, invalidating the whole block
+    values5m = blocks.sum(axis=-1)
+    if not total:
+        values5m = values5m / 5
+    return values5m
+
+class TrafficScan:
+    '''
+    The data of every detector in one .traffic file (or one day of a year
+    archive), decoded in one pass. Rows of the arrays follow detectors; use
+    row to find the row of a detector ID.
+
+    volume30s, occupancy30s             (detectors x 2880) 30-second data
+    onemin_volumes, onemin_occupancies  (detectors x 1440) 1-minute data
+    onemin_speeds                       (detectors x 1440) 1-minute speeds
+    fivemin_volumes                     (detectors x 288) 5-minute totals
+    fivemin_occupancies, fivemin_speeds (detectors x 288) 5-minute averages
+
+    Invalid values are NAN.
+    '''
+
+    def __init__(self, detectors, volume30s, occupancy30s, speed_limits=None,
+                 field_lengths=None):
+        '''
+        speed_limits and field_lengths are dictionaries mapping detector IDs
+        to values. Detectors missing from speed_limits get a speed limit of
+        70, and detectors missing from field_lengths get field lengths
+        calculated from their data, as in onemin_speeds_for_detectors.
+        '''
+
+        self.detectors = list(detectors)
+        self._rows = dict((detectorID, row) for row, detectorID in enumerate(self.detectors))
+        if speed_limits == None:
+            speed_limits = {}
+        if field_lengths == None:
+            field_lengths = {}
+
+        self.volume30s = volume30s
+        self.occupancy30s = occupancy30s
+        self.onemin_volumes, self.onemin_occupancies = onemin_data(volume30s, occupancy30s)
+        self.onemin_speeds = onemin_speeds(self.onemin_volumes,
+                                           self.onemin_occupancies,
+                                           [speed_limits.get(d, 70) for d in self.detectors],
+                                           [field_lengths.get(d) for d in self.detectors])
+        self.fivemin_volumes = fivemin_values(self.onemin_volumes, total=True)
+        self.fivemin_occupancies = fivemin_values(self.onemin_occupancies)
+        self.fivemin_speeds = fivemin_values(self.onemin_speeds)
+
+    def __contains__(self, detectorID):
+        return str(detectorID) in self._rows
+
+    def row(self, detectorID):
+        '''
+        Returns the row of the detector with the specified ID. Raises KeyError
+        if the detector has no data in this scan.
+        '''
+        return self._rows[str(detectorID)]
+
+    def summary(self):
+        '''
+        Returns a dictionary of per-detector arrays, in the order of
+        detectors:
+
+        valid_samples   fraction of valid 30-second samples
+        valid_minutes   fraction of valid 1-minute speeds
+        volume          total volume of the valid 1-minute data
+        occupancy       average occupancy of the valid 1-minute data
+        speed           average of the valid 5-minute speeds
+        '''
+
+        valid_samples = ~isnan(self.volume30s) & ~isnan(self.occupancy30s)
+        return {
+            'valid_samples': valid_samples.mean(axis=1),
+            'valid_minutes': (~isnan(self.onemin_speeds)).mean(axis=1),
+            'volume': nansum(self.onemin_volumes, axis=1),
+            'occupancy': _valid_row_means(self.onemin_occupancies),
+            'speed': _valid_row_means(self.fivemin_speeds),
+        }
+
+    def print_summary(self):
+        '''
+        Prints the summary of every detector and of the whole file
+        '''
+
+        summary = self.summary()
+        print "%-10s %8s %8s %8s %8s %8s" % ('detector', 'samples', 'minutes',
+                                             'volume', 'occ', 'speed')
+        for row, detectorID in enumerate(self.detectors):
+            print "%-10s %7.1f%% %7.1f%% %8d %7.1f%% %8.1f" % (
+                detectorID,
+                100 * summary['valid_samples'][row],
+                100 * summary['valid_minutes'][row],
+                summary['volume'][row],
+                100 * nan_to_num(summary['occupancy'][row]),
+                nan_to_num(summary['speed'][row]))
+        reporting = count_nonzero(summary['valid_samples'] > 0)
+        print (str(len(self.detectors)) + " detectors, " + str(reporting)
+               + " reporting, " + str(len(self.detectors) - reporting) + " without valid data")
+
+def _valid_row_means(values):
+    # the average of the valid values of each row; NAN for rows without any
+    valid = ~isnan(values)
+    with errstate(invalid='ignore', divide='ignore'):
+        return where(valid, values, 0).sum(axis=-1) / count_nonzero(valid, axis=-1)
+
+def traffic_filename_from_date(day):
+    return day.strftime("%Y%m%d") + ".traffic"
+
+def open_traffic_day(directory, day, traffic_file=None):
+    '''
+    Returns a TrafficReader for the given date. directory is either a
+    directory of .traffic files, which may also hold year archives, the path
+    of a year archive, or any other location or backend open_storage accepts.
+    traffic_file overrides the name of the .traffic file to open. Raises
+    IOError if there is no data for the date (see storage.is_missing) or it
+    cannot be read.
+    '''
+    storage = open_storage(directory)
+    archive = storage.year_archive(day.year)
+    if archive != None:
+        tr = TrafficReader()
+        tr.loadarchiveday(archive, day)
+        return tr
+    if traffic_file == None:
+        traffic_file = traffic_filename_from_date(day)
+    if isinstance(storage, LocalStorage):
+        return TrafficReader(path.join(storage.location, traffic_file))
+    tr = TrafficReader()
+    tr.loadstorage(storage, traffic_file)
+    return tr
+
+def open_traffic_days(directory, days):
+    '''
+    Yields a tuple (day, traffic_reader) for each of days in order, where
+    traffic_reader is None if there is no data for the day. Data that exists
+    but cannot be read is retried and then raises IOError (see
+    storage.or_none_if_missing). Other than from a
+    local directory read one file at a time, the .traffic files are fetched
+    whole, and those of the days ahead are fetched while the current one is
+    used when the backend takes more than one read in flight (see
+    storage.fetch_many).
+    '''
+    storage = open_storage(directory)
+    if isinstance(storage, LocalStorage) and storage.max_in_flight <= 1:
+        for day in days:
+            yield day, or_none_if_missing(open_traffic_day, storage, day)
+        return
+
+    # days in year archives are mapped rather than fetched
+    days = list(days)
+    fetched = fetch_many(storage, [traffic_filename_from_date(day) for day in days
+                                   if storage.year_archive(day.year) == None])
+    for day in days:
+        if storage.year_archive(day.year) != None:
+            yield day, or_none_if_missing(open_traffic_day, storage, day)
+            continue
+        name, data = fetched.next()
+        if data == None:
+            yield day, None
+            continue
+        tr = TrafficReader()
+        tr.loadstorage(storage, name, data)
+        yield day, tr
+
 class TrafficReader:
     '''
     Provides an interface to a single .traffic file
@@ -19,6 +320,8 @@ class TrafficReader:
 
         self._zipfile = None
         self._trafficfile = None
+        self._archive = None
+        self._day_index = None
         self.directory = None
         if trafficfile != None:
             self.loadfile(trafficfile)
@@ -33,22 +336,62 @@ class TrafficReader:
         if self._zipfile != None:
             self._zipfile.close()
 
+        self._archive = None
+        self._day_index = None
         self._trafficfile = trafficfile
         self._zipfile = ZipFile(self._trafficfile)
         self.directory = path.dirname(trafficfile)
 
+    def loadstorage(self, storage, name, data=None):
+        '''
+        Instructs a TrafficReader instance to load values from the named
+        .traffic file of a storage backend (see storage), or from data, the
+        contents of that file when they have already been fetched
+        '''
+
+        if self._zipfile != None:
+            self._zipfile.close()
+
+        self._archive = None
+        self._day_index = None
+        self._trafficfile = name
+        if data == None:
+            self._zipfile = ZipFile(storage.open(name))
+        else:
+            self._zipfile = ZipFile(StringIO(data))
+        self.directory = storage.location
+
+    def loadarchiveday(self, archive, day):
+        '''
+        Instructs a TrafficReader instance to load values for the specified
+        date from a YearArchive instead of a .traffic file. Raises IOError if
+        the archive has no data for that date.
+        '''
+
+        day_index = archive.day_index(day)
+
+        if self._zipfile != None:
+            self._zipfile.close()
+            self._zipfile = None
+
+        self._trafficfile = None
+        self._archive = archive
+        self._day_index = day_index
+        self.directory = path.dirname(archive.archive_file)
+
     def list_detectors(self):
         '''
         Returns a list of the IDs of all detectors which have records in the
         current .traffic file
         '''
 
-        zipfile = ZipFile(self._trafficfile)
+        if self._archive != None:
+            return list(self._archive.detectors)
 
         detlist = []
 
-        for zippedfile in zipfile.namelist():
-            ext = path.splitext(zippedfile)[1]
+        for zippedfile in self._zipfile.namelist():
+            id, ext = path.splitext(zippedfile)
             if ext == '.v30':
                 detlist.append(id)
 
@@ -60,6 +403,9 @@ class TrafficReader:
         .traffic file for the detector with the specified ID.
         '''
 
+        if self._archive != None:
+            return self._archive.occupancies_for_detector(detectorID, self._day_index)
+
         name = str(detectorID) + '.c30'
         try:
             occ_file = self._zipfile.open(name)
@@ -73,6 +419,9 @@ class TrafficReader:
         .traffic file for the detector with the specified ID.
         '''
 
+        if self._archive != None:
+            return self._archive.volumes_for_detector(detectorID, self._day_index)
+
         name = str(detectorID) + '.v30'
         try:
             vol_file = self._zipfile.open(name)
@@ -95,25 +444,23 @@ class TrafficReader:
         reported as invalid.
         '''
 
-        volume30s = self.volumes_for_detector(detectorID)
-        occupancy30s = self.occupancies_for_detector(detectorID)
+        return onemin_data(self.volumes_for_detector(detectorID),
+                           self.occupancies_for_detector(detectorID))
 
-        volume1m = empty([1440])
-        occupancy1m = empty([1440])
+    def onemin_data_for_detectors(self, detectorIDs):
+        '''
+        Returns a tuple (vol_array, occ_array) of (detectors x 1440) arrays
+        holding the 1-minute data of the detectors with the specified IDs, in
+        order. See onemin_data_for_detector.
+        '''
 
-        for i in range(1440):
-            j = i * 2
-            if (isnan(volume30s[j])
-                or isnan(volume30s[j+1])
-                or isnan(occupancy30s[j])
-                or isnan(occupancy30s[j+1])):
-                volume1m[i] = NAN
-                occupancy1m[i] = NAN
-            else:
-                volume1m[i] = volume30s[j] + volume30s[j+1]
-                occupancy1m[i] = (occupancy30s[j] + occupancy30s[j+1]) / 2
+        volume30s = empty([len(detectorIDs), 2880])
+        occupancy30s = empty([len(detectorIDs), 2880])
+        for i, detectorID in enumerate(detectorIDs):
+            volume30s[i] = self.volumes_for_detector(detectorID)
+            occupancy30s[i] = self.occupancies_for_detector(detectorID)
 
-        return volume1m, occupancy1m
+        return onemin_data(volume30s, occupancy30s)
 
     def onemin_speeds_for_detector(self, detectorID, speed_limit=70,
                                    field_length=None):
@@ -122,100 +469,75 @@ class TrafficReader:
         starting at 00:00.
         '''
 
-        #print "            Calculating speeds for detector ", detectorID
-
-        vols, occs = self.onemin_data_for_detector(detectorID)
-
-        if field_length == None:
-        # if we were not given a field length, try to calculate from volume and
-        # occupancy
-            avg_field_length, field_lengths = self.field_lengths(vols, occs,
-                                                                 speed_limit)
-        else:
-        # if we were given a field length, use it
-            avg_field_length = field_length
-            field_lengths = array([field_length] * 1440, dtype=float)
-
-        if avg_field_length == None:
-        # if we were not given a field length and we are unable to calculate it,
-        # use the speed limit as the free-flow speed and assume an average field
-        # length of 25 ft.
-            free_flow_speed = speed_limit
-            avg_field_length = 25
-        else:
-        # otherwise, calculate the free-flow speed from the volume, occupancy,
-        # and field length
-            free_flow_speed = self.free_flow_speed(vols, occs, avg_field_length)
-
-        # if the free-flow speed is still None, use the speed limit anyway
-        if free_flow_speed == None:
-            free_flow_speed = speed_limit
-
-        speeds = empty([1440], dtype=float)
-        speeds[:] = NAN
-
-        # given in published report
-        theta = 0.15
-
-        # Three cases for speed calculation:
-        # Case 1: 0 < occupancy < 0.1
-        valid = (0 < occs) & (occs <= 0.1)
-        if count_nonzero(valid) > 0:
-            speeds[valid] = (free_flow_speed
-                             * (1 -
-                                ( (occs[valid] * avg_field_length)
-                                    / field_lengths[valid]) ) )
-
-        # Case 2: 0.1 <= occupancy <= 0.15
-        valid = (0.1 < occs) & (occs <= 0.15)
-        if count_nonzero(valid) > 0:
-            speeds[valid] = free_flow_speed * (1 - occs[valid])
+        return self.onemin_speeds_for_detectors([detectorID], [speed_limit],
+                                                [field_length])[0]
 
-        # Case 3: 0.15 < occupancy
-        valid = (0.15 < occs)
-        if count_nonzero(valid) > 0:
-            speeds[valid] = (free_flow_speed
-                             * (1 - theta)
-                             * exp(-1 * (1 / theta)
-                                   * ( (100 * occs[valid]) / (100 - theta) )
-                                   )
-                            )
-
-        #for i in range(len(occs)):
-        #	if (occs[i] == None
-        #		or free_flow_speed == None
-        #		or avg_field_length == None
-        #		or field_lengths[i] == None):
-        #		speeds.append(None)
-        #	elif 0 < occs[i] < 0.1:
-        #		speeds.append(free_flow_speed * (1 - ( (occs[i] * avg_field_length) / field_lengths[i]) ) )
-        #	elif 0.1 <= occs[i] <= 0.15:
-        #		speeds.append(free_flow_speed * (1 - occs[i]) )
-        #	else:
-        #		exponent = -1 * (1 / theta) * ((100 * occs[i]) / (100 - theta))
-        #		speeds.append(free_flow_speed * (1 - theta) * exp(exponent) )
+    def onemin_speeds_for_detectors(self, detectorIDs, speed_limits=None,
+                                    field_lengths=None):
+        '''
+        Returns a (detectors x 1440) numpy.array of 1-minute speeds for the
+        detectors with the specified IDs, in order. speed_limits and
+        field_lengths give one value per detector; a field length of None means
+        the field length is calculated from the detector's volume and
+        occupancy. speed_limits defaults to 70 for every detector.
+        '''
 
-        return speeds
+        vols, occs = self.onemin_data_for_detectors(detectorIDs)
+        if speed_limits is None:
+            speed_limits = [70] * len(detectorIDs)
+        return onemin_speeds(vols, occs, speed_limits, field_lengths)
 
     def fivemin_speeds_for_detector(self, detectorID, speed_limit=70):
         '''
-        Returns a list of 5-minute speeds
+        Returns a numpy.array of 5-minute speeds, one for each 5 minutes of the
+        day, starting at 00:00. A 5-minute speed is the average of its five
+        1-minute speeds, and is NAN if any of them is invalid.
         '''
 
-        speeds1m = self.onemin_speeds_for_detector(detectorID)
+        return fivemin_values(self.onemin_speeds_for_detector(detectorID, speed_limit))
 
-        speeds5m = deque()
+    def scan(self, speed_limits=None, field_lengths=None):
+        '''
+        Decodes the data of every detector in the current .traffic file (or
+        archive day) in one pass and returns it as a TrafficScan. speed_limits
+        and field_lengths are dictionaries mapping detector IDs to values, as
+        for TrafficScan.
+        '''
 
-        for i in range(0, len(speeds1m), 5):
-            interval_speeds = speeds1m[i:i+4]
-            # if any of the speeds in this interval are None, the whole interval
-            # gets None
-            if interval_speeds.count(None) > 0:
-                speeds5m.append(None)
-            else:
-                speeds5m.append(sum(interval_speeds) / len(interval_speeds))
+        if self._archive != None:
+            volume30s, occupancy30s = self._archive.day_samples(self._day_index)
+            return TrafficScan(self._archive.detectors, volume30s, occupancy30s,
+                               speed_limits, field_lengths)
 
-        return list(speeds5m)
+        volume_names = {}
+        occupancy_names = {}
+        for zippedfile in self._zipfile.namelist():
+            id, ext = path.splitext(zippedfile)
+            if ext == '.v30':
+                volume_names[id] = zippedfile
+            elif ext == '.c30':
+                occupancy_names[id] = zippedfile
+        detectors = sorted(set(volume_names) | set(occupancy_names))
+
+        # members missing or with invalid lengths stay invalid, as in
+        # list_volumes and list_occupancies
+        raw_volumes = empty([len(detectors), SAMPLES_PER_DAY])
+        raw_occupancies = empty([len(detectors), SAMPLES_PER_DAY])
+        raw_volumes[:] = NAN
+        raw_occupancies[:] = NAN
+        for row, detectorID in enumerate(detectors):
+            if detectorID in volume_names:
+                data = self._zipfile.read(volume_names[detectorID])
+                if len(data) == SAMPLES_PER_DAY * VOLUME_TYPE.itemsize:
+                    raw_volumes[row] = frombuffer(data, dtype=VOLUME_TYPE)
+            if detectorID in occupancy_names:
+                data = self._zipfile.read(occupancy_names[detectorID])
+                if len(data) == SAMPLES_PER_DAY * OCCUPANCY_TYPE.itemsize:
+                    raw_occupancies[row] = frombuffer(data, dtype=OCCUPANCY_TYPE)
+
+        return TrafficScan(detectors, decode_volumes(raw_volumes),
+                           decode_occupancies(raw_occupancies),
+                           speed_limits, field_lengths)
 
     def field_lengths(self, volumes, occupancies, speed_limit=70):
         '''
@@ -249,7 +571,7 @@ class TrafficReader:
         '''
 
         # given in published report
-        max_occupancy = 0.98
+        max_occupancy = MAX_OCCUPANCY
         max_density = (max_occupancy * 5280) / field_length
 
         densities = empty([len(volumes)])
@@ -283,15 +605,20 @@ class TrafficReader:
         #return (60 * sum(valid_volumes)) / sum(valid_densities)
 
     def print_average_speeds_for_detectors(self, start=0, end=7000):
-        avgspeedlist = []
-        for detid in range(start, end):
-            try:
-                speedlist = self.fivemin_speeds_for_detector(detid)
-            except KeyError:
-                print "No data for detector " + str(detid)
-                continue
+        '''
+        Prints the average 5-minute speed of each detector with a numeric ID
+        from start up to (but not including) end that has data in this file
+        '''
 
-            speedlist = [speed for speed in speedlist if speed != None]
+        scan = self.scan()
+        detectors = [detectorID for detectorID in scan.detectors
+                     if detectorID.isdigit() and start <= int(detectorID) < end]
+        detectors.sort(key=int)
+
+        avgspeedlist = []
+        for detid in detectors:
+            speedlist = scan.fivemin_speeds[scan.row(detid)]
+            speedlist = speedlist[~isnan(speedlist)]
 
             speedsum = sum(speedlist)
             speedcount = len(speedlist)
@@ -303,9 +630,152 @@ class TrafficReader:
                 print "Average speed for detector " + str(detid) + ": " + str(avgspeed)
                 avgspeedlist.append(avgspeed)
 
-        print "Overall average: " + str(sum(avgspeedlist) / len(avgspeedlist))
+        if len(avgspeedlist) > 0:
+            print "Overall average: " + str(sum(avgspeedlist) / len(avgspeedlist))
+        else:
+            print "Overall average: 0"
 
 if __name__ == '__main__':
-    set_printoptions(precision=3, threshold='nan', edgeitems=10)
-    tr = TrafficReader('test/20100113.traffic')
-    print tr.onemin_speeds_for_detector(1585, speed_limit=60)
+    import random
+    import shutil
+    import tempfile
+
+    # the reference calculation compares against NAN
+    seterr(invalid='ignore')
+
+    def reference_onemin_speeds(tr, vols, occs, speed_limit=70, field_length=None):
+        # the speeds of one detector as onemin_speeds_for_detector calculated
+        # them before onemin_speeds, from its 1-minute data
+        if field_length == None:
+            avg_field_length, field_lengths = tr.field_lengths(vols, occs, speed_limit)
+        else:
+            avg_field_length = field_length
+            field_lengths = array([field_length] * 1440, dtype=float)
+
+        if avg_field_length == None:
+            free_flow_speed = speed_limit
+            avg_field_length = 25
+        else:
+            free_flow_speed = tr.free_flow_speed(vols, occs, avg_field_length)
+        if free_flow_speed == None:
+            free_flow_speed = speed_limit
+
+        speeds = empty([1440], dtype=float)
+        speeds[:] = NAN
+        valid = (0 < occs) & (occs <= 0.1)
+        speeds[valid] = free_flow_speed * (1 - ((occs[valid] * avg_field_length)
+                                                / field_lengths[valid]))
+        valid = (0.1 < occs) & (occs <= 0.15)
+        speeds[valid] = free_flow_speed * (1 - occs[valid])
+        valid = 0.15 < occs
+        speeds[valid] = (free_flow_speed * (1 - THETA)
+                         * exp(-1 * (1 / THETA) * ((100 * occs[valid]) / (100 - THETA))))
+        return speeds
+
+    def random_data(rng, n_detectors):
+        # (detectors x 1440) 1-minute volumes and occupancies with missing
+        # minutes, in every occupancy regime
+        vols = empty([n_detectors, 1440])
+        occs = empty([n_detectors, 1440])
+        for row in range(n_detectors):
+            for minute in range(1440):
+                vols[row, minute] = rng.randint(0, 40)
+                occs[row, minute] = rng.choice([0, rng.uniform(0, 0.1),
+                                                rng.uniform(0.1, 0.15), rng.uniform(0.15, 1)])
+                if rng.random() < 0.1:
+                    vols[row, minute] = occs[row, minute] = NAN
+        # no minute to calculate a field length from, and no valid minute
+        occs[1, occs[1] <= 0.1] = 0.5
+        vols[2] = occs[2] = NAN
+        return vols, occs
+
+    def same_speeds(a, b):
+        return (array_equal(isnan(a), isnan(b))
+                and allclose(a[~isnan(a)], b[~isnan(b)], rtol=1e-12, atol=0))
+
+    def testing_onemin_speeds():
+        rng = random.Random(0)
+        tr = TrafficReader()
+        vols, occs = random_data(rng, 6)
+        speed_limits = [rng.choice([55, 60, 70]) for row in range(len(vols))]
+        field_lengths = [None, 22.0, None, 18.5, None, 25.0]
+        speeds = onemin_speeds(vols, occs, speed_limits, field_lengths)
+        for row in range(len(vols)):
+            expected = reference_onemin_speeds(tr, vols[row], occs[row], speed_limits[row],
+                                               field_lengths[row])
+            assert same_speeds(speeds[row], expected), row
+            # and one detector at a time
+            assert same_speeds(onemin_speeds(vols[row], occs[row], [speed_limits[row]],
+                                             [field_lengths[row]])[0], expected), row
+
+    def testing_traffic_file():
+        # the batched reader methods against the same calculation per detector
+        tr = TrafficReader('../test/20100104.traffic')
+        detectors = tr.list_detectors()
+        speed_limits = [55 + 5 * (row % 3) for row in range(len(detectors))]
+        speeds = tr.onemin_speeds_for_detectors(detectors + ['missing'], speed_limits + [70])
+        for row, detectorID in enumerate(detectors):
+            vols, occs = tr.onemin_data_for_detector(detectorID)
+            expected = reference_onemin_speeds(tr, vols, occs, speed_limits[row])
+            assert same_speeds(speeds[row], expected), detectorID
+            assert same_speeds(tr.onemin_speeds_for_detector(detectorID, speed_limits[row]),
+                               expected), detectorID
+        assert isnan(speeds[-1]).all()
+
+    def testing_scan():
+        # the scan of a .traffic file against the reader methods per detector,
+        # with a truncated member and a detector with volumes only
+        with ZipFile('../test/20100104.traffic') as traffic:
+            members = dict((name, traffic.read(name)) for name in traffic.namelist())
+        detectors = sorted(set(path.splitext(name)[0] for name in members))
+        members[detectors[0] + '.c30'] = members[detectors[0] + '.c30'][:100]
+        members['1234.v30'] = open('test/1234.v30', 'rb').read()
+        directory = tempfile.mkdtemp()
+        try:
+            trafficfile = path.join(directory, 'scan.traffic')
+            with ZipFile(trafficfile, 'w') as zipfile:
+                for name, contents in members.items():
+                    zipfile.writestr(name, contents)
+            check_scan(TrafficReader(trafficfile), detectors)
+        finally:
+            shutil.rmtree(directory)
+
+    def check_scan(tr, detectors):
+        speed_limits = {detectors[1]: 55, '1234': 60}
+        field_lengths = {detectors[2]: 22.0}
+        scan = tr.scan(speed_limits, field_lengths)
+        assert scan.detectors == sorted(detectors + ['1234'])
+        assert '1234' in scan and 1234 in scan and 'missing' not in scan
+        summary = scan.summary()
+        for detectorID in scan.detectors:
+            row = scan.row(detectorID)
+            volume30s = tr.volumes_for_detector(detectorID)
+            occupancy30s = tr.occupancies_for_detector(detectorID)
+            assert same_speeds(scan.volume30s[row], volume30s), detectorID
+            assert same_speeds(scan.occupancy30s[row], occupancy30s), detectorID
+            vols, occs = tr.onemin_data_for_detector(detectorID)
+            assert same_speeds(scan.onemin_volumes[row], vols), detectorID
+            assert same_speeds(scan.onemin_occupancies[row], occs), detectorID
+            speeds = tr.onemin_speeds_for_detector(detectorID, speed_limits.get(detectorID, 70),
+                                                   field_lengths.get(detectorID))
+            assert same_speeds(scan.onemin_speeds[row], speeds), detectorID
+            assert same_speeds(scan.fivemin_speeds[row], fivemin_values(speeds)), detectorID
+            assert same_speeds(scan.fivemin_volumes[row], fivemin_values(vols, total=True))
+
+            valid = ~isnan(volume30s) & ~isnan(occupancy30s)
+            assert summary['valid_samples'][row] == valid.sum() / 2880
+            assert summary['valid_minutes'][row] == (~isnan(speeds)).sum() / 1440
+            assert summary['volume'][row] == vols[~isnan(vols)].sum()
+            if (~isnan(occs)).any():
+                assert allclose(summary['occupancy'][row], occs[~isnan(occs)].mean())
+            else:
+                assert isnan(summary['occupancy'][row])
+        # the truncated occupancies and the missing ones leave no valid minute
+        for detectorID in [detectors[0], '1234']:
+            assert isnan(scan.onemin_speeds[scan.row(detectorID)]).all()
+            assert summary['valid_samples'][scan.row(detectorID)] == 0
+
+    testing_onemin_speeds()
+    testing_traffic_file()
+    testing_scan()
+    print "trafficreader tests passed"
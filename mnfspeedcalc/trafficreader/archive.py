@@ -0,0 +1,338 @@
+'''
+A year archive packs the 30-second samples of every detector for one year into
+a single file:
+
+    magic (8 bytes) | header length (4 bytes, big endian) | JSON header |
+    volume block | occupancy block
+
+The volume block holds raw signed byte counts and the occupancy block raw
+big-endian 16-bit scans, exactly as they appear in the .v30 and .c30 members
+of a .traffic file, laid out as (detector, day, 2880 samples). Each detector's
+data for the whole year is therefore one contiguous slice. Samples that were
+missing from the .traffic files are stored as -1, which decodes as invalid.
+'''
+from __future__ import division
+from readers import decode_volumes, decode_occupancies
+from zipfile import ZipFile, BadZipfile
+from datetime import date, timedelta
+from os import path, rename
+from numpy import memmap, frombuffer, empty, int8, int16, dtype
+import errno
+import struct
+import json
+
+MAGIC = 'MNFSYA01'
+ARCHIVE_EXTENSION = '.trafficyear'
+SAMPLES_PER_DAY = 2880
+
+# blocks start on page boundaries so they can be memory-mapped
+ALIGNMENT = 4096
+
+VOLUME_TYPE = dtype(int8)
+OCCUPANCY_TYPE = dtype(int16).newbyteorder('>')
+
+def archive_filename_for_year(year):
+    return str(year) + ARCHIVE_EXTENSION
+
+def _traffic_filename_from_date(day):
+    return day.strftime("%Y%m%d") + ".traffic"
+
+def _days_in_year(year):
+    return (date(year + 1, 1, 1) - date(year, 1, 1)).days
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def build_year_archive(directory, year, output_file, verbose=False):
+    '''
+    Packs the .traffic files for year found in directory into a single year
+    archive at output_file.
+    '''
+    n_days = _days_in_year(year)
+    days = [date(year, 1, 1) + timedelta(days=i) for i in range(n_days)]
+
+    # first pass: find the days present and every detector that has data
+    days_present = []
+    detectors = set()
+    for day in days:
+        traffic_file = path.join(directory, _traffic_filename_from_date(day))
+        try:
+            zipfile = ZipFile(traffic_file)
+        except (IOError, BadZipfile):
+            days_present.append(False)
+            continue
+        days_present.append(True)
+        for name in zipfile.namelist():
+            detector, ext = path.splitext(name)
+            if ext in ('.v30', '.c30'):
+                detectors.add(detector)
+        zipfile.close()
+
+    detectors = sorted(detectors)
+    detector_rows = dict((detector, row) for row, detector in enumerate(detectors))
+
+    header = {
+        'year': year,
+        'n_days': n_days,
+        'days_present': days_present,
+        'detectors': detectors,
+    }
+    header_length = len(json.dumps(header)) + 64
+    volume_offset = _aligned(len(MAGIC) + 4 + header_length)
+    volume_size = len(detectors) * n_days * SAMPLES_PER_DAY * VOLUME_TYPE.itemsize
+    occupancy_offset = _aligned(volume_offset + volume_size)
+    occupancy_size = len(detectors) * n_days * SAMPLES_PER_DAY * OCCUPANCY_TYPE.itemsize
+    header['volume_offset'] = volume_offset
+    header['occupancy_offset'] = occupancy_offset
+
+    # write the header and size the file, then fill the blocks in place
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        header_json = json.dumps(header)
+        f.write(MAGIC)
+        f.write(struct.pack('>I', len(header_json)))
+        f.write(header_json)
+        f.seek(occupancy_offset + occupancy_size - 1)
+        f.write('\0')
+
+    shape = (len(detectors), n_days, SAMPLES_PER_DAY)
+    if len(detectors) > 0:
+        volumes = memmap(tmp_file, dtype=VOLUME_TYPE, mode='r+',
+                         offset=volume_offset, shape=shape)
+        occupancies = memmap(tmp_file, dtype=OCCUPANCY_TYPE, mode='r+',
+                             offset=occupancy_offset, shape=shape)
+        volumes[:] = -1
+        occupancies[:] = -1
+
+        # second pass: copy the samples
+        for day_index, day in enumerate(days):
+            if not days_present[day_index]:
+                continue
+            if verbose:
+                print "Packing " + str(day)
+            zipfile = ZipFile(path.join(directory, _traffic_filename_from_date(day)))
+            for name in zipfile.namelist():
+                detector, ext = path.splitext(name)
+                if ext == '.v30':
+                    block, sample_type = volumes, VOLUME_TYPE
+                elif ext == '.c30':
+                    block, sample_type = occupancies, OCCUPANCY_TYPE
+                else:
+                    continue
+                data = zipfile.read(name)
+                # files with invalid lengths are left invalid, as the .traffic
+                # readers do
+                if len(data) == SAMPLES_PER_DAY * sample_type.itemsize:
+                    block[detector_rows[detector], day_index, :] = frombuffer(data, dtype=sample_type)
+            zipfile.close()
+
+        volumes.flush()
+        occupancies.flush()
+        del volumes, occupancies
+
+    rename(tmp_file, output_file)
+
+class YearArchive:
+    '''
+    Provides memory-mapped access to a year archive
+    '''
+
+    def __init__(self, archive_file):
+        self.archive_file = archive_file
+        with open(archive_file, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise IOError("Not a year archive: " + archive_file)
+            header_length = struct.unpack('>I', f.read(4))[0]
+            header = json.loads(f.read(header_length))
+
+        self.year = header['year']
+        self.n_days = header['n_days']
+        self.days_present = header['days_present']
+        self.detectors = [str(detector) for detector in header['detectors']]
+        self._detector_rows = dict((detector, row) for row, detector in enumerate(self.detectors))
+
+        shape = (len(self.detectors), self.n_days, SAMPLES_PER_DAY)
+        if len(self.detectors) > 0:
+            self._volumes = memmap(archive_file, dtype=VOLUME_TYPE, mode='r',
+                                   offset=header['volume_offset'], shape=shape)
+            self._occupancies = memmap(archive_file, dtype=OCCUPANCY_TYPE, mode='r',
+                                       offset=header['occupancy_offset'], shape=shape)
+
+    def day_index(self, day):
+        '''
+        Returns the index of the given date in this archive. Raises IOError if
+        the archive has no data for that date, as opening a missing .traffic
+        file would.
+        '''
+        index = (day - date(self.year, 1, 1)).days
+        if index < 0 or index >= self.n_days or not self.days_present[index]:
+            raise IOError(errno.ENOENT, "No data for " + str(day) + " in " + self.archive_file)
+        return index
+
+    def has_detector(self, detectorID):
+        return str(detectorID) in self._detector_rows
+
+    def volumes_for_detector(self, detectorID, day_index=None):
+        '''
+        Returns the decoded 30-second volumes of the given detector for one
+        day, or for every day of the year as a (day, 2880) array when day_index
+        is None.
+        '''
+        return decode_volumes(self._samples(self._volumes, detectorID, day_index))
+
+    def occupancies_for_detector(self, detectorID, day_index=None):
+        '''
+        Returns the decoded 30-second occupancies of the given detector for one
+        day, or for every day of the year as a (day, 2880) array when day_index
+        is None.
+        '''
+        return decode_occupancies(self._samples(self._occupancies, detectorID, day_index))
+
+    def day_samples(self, day_index):
+        '''
+        Returns a tuple (volumes, occupancies) of (detector x 2880) arrays
+        holding the decoded 30-second data of every detector in the archive,
+        in the order of detectors, for one day
+        '''
+        if len(self.detectors) == 0:
+            return (decode_volumes(empty((0, SAMPLES_PER_DAY))),
+                    decode_occupancies(empty((0, SAMPLES_PER_DAY))))
+        return (decode_volumes(self._volumes[:, day_index]),
+                decode_occupancies(self._occupancies[:, day_index]))
+
+    def _samples(self, block, detectorID, day_index):
+        row = self._detector_rows.get(str(detectorID))
+        if row == None:
+            # detectors with no data decode as all invalid
+            if day_index == None:
+                return [[-1] * SAMPLES_PER_DAY] * self.n_days
+            return [-1] * SAMPLES_PER_DAY
+        if day_index == None:
+            return block[row]
+        return block[row, day_index]
+
+# year archives opened so far, by file name
+_open_archives = {}
+
+def open_year_archive(archive_file):
+    '''
+    Returns a YearArchive for archive_file, reusing an already open one
+    '''
+    if archive_file not in _open_archives:
+        _open_archives[archive_file] = YearArchive(archive_file)
+    return _open_archives[archive_file]
+
+# the year archive (or None) found for each (directory, year) so far
+_found_archives = {}
+
+def find_year_archive(directory, year):
+    '''
+    Returns the year archive for year if directory is one, or if directory
+    holds one named for that year. Returns None otherwise. Raises ValueError
+    if directory is a year archive of another year. The filesystem is only
+    looked at the first time for each directory and year.
+    '''
+    key = (directory, year)
+    if key not in _found_archives:
+        archive = None
+        if path.isfile(directory):
+            archive = open_year_archive(directory)
+            if archive.year != year:
+                raise ValueError("Year archive " + directory + " holds " + str(archive.year)
+                                 + ", not " + str(year))
+        else:
+            archive_file = path.join(directory, archive_filename_for_year(year))
+            if path.isfile(archive_file):
+                archive = open_year_archive(archive_file)
+        _found_archives[key] = archive
+    return _found_archives[key]
+
+if __name__ == '__main__':
+    from readers import list_volumes, list_occupancies
+    from zipfile import ZipFile
+    from cStringIO import StringIO
+    from numpy import isnan, array_equal
+    import random
+    import shutil
+    import tempfile
+
+    def random_members(rng):
+        # the .v30 and .c30 contents of a detector with some invalid samples
+        volumes = struct.pack('b' * SAMPLES_PER_DAY,
+                              *[rng.randint(-1, 40) for i in range(SAMPLES_PER_DAY)])
+        occupancies = struct.pack('>' + 'h' * SAMPLES_PER_DAY,
+                                  *[rng.randint(-1, 1800) for i in range(SAMPLES_PER_DAY)])
+        return volumes, occupancies
+
+    def same_samples(a, b):
+        return array_equal(isnan(a), isnan(b)) and array_equal(a[~isnan(a)], b[~isnan(b)])
+
+    def testing_archive(directory):
+        rng = random.Random(0)
+        with open('test/1234.v30', 'rb') as f:
+            volumes_1234 = f.read()
+        with open('test/1234.c30', 'rb') as f:
+            occupancies_1234 = f.read()
+        # January 1 and 3 have files, January 2 and the rest of the year do
+        # not. detector 99 reports on January 1 only, with a truncated .v30
+        # file on January 3; detector 7 reports on January 3 only.
+        members = {
+            date(2010, 1, 1): {'1234': (volumes_1234, occupancies_1234),
+                               '99': random_members(rng)},
+            date(2010, 1, 3): {'1234': random_members(rng),
+                               '99': ('\0' * 100, random_members(rng)[1]),
+                               '7': random_members(rng)},
+        }
+        for day, detectors in members.items():
+            with ZipFile(path.join(directory, _traffic_filename_from_date(day)), 'w') as zipfile:
+                for detector, (volumes, occupancies) in detectors.items():
+                    zipfile.writestr(detector + '.v30', volumes)
+                    zipfile.writestr(detector + '.c30', occupancies)
+
+        archive_file = path.join(directory, archive_filename_for_year(2010))
+        build_year_archive(directory, 2010, archive_file)
+        archive = YearArchive(archive_file)
+        assert archive.year == 2010 and archive.n_days == 365
+        assert archive.detectors == ['1234', '7', '99']
+        assert [i for i, present in enumerate(archive.days_present) if present] == [0, 2]
+        for day in [date(2010, 1, 2), date(2010, 12, 31), date(2011, 1, 1)]:
+            try:
+                archive.day_index(day)
+                assert False, 'found data for ' + str(day)
+            except IOError, e:
+                assert e.errno == errno.ENOENT
+
+        # every day and detector decodes as the .traffic files do, and a
+        # detector without a file for a day is all invalid
+        day_volumes, day_occupancies = archive.day_samples(2)
+        for day, detectors in members.items():
+            day_index = archive.day_index(day)
+            for detector in archive.detectors + ['1']:
+                volumes, occupancies = detectors.get(detector, ('', ''))
+                expected_volumes = list_volumes(StringIO(volumes))
+                expected_occupancies = list_occupancies(StringIO(occupancies))
+                assert same_samples(archive.volumes_for_detector(detector, day_index),
+                                    expected_volumes), (day, detector)
+                assert same_samples(archive.occupancies_for_detector(detector, day_index),
+                                    expected_occupancies), (day, detector)
+                if day_index == 2 and detector in archive.detectors:
+                    row = archive.detectors.index(detector)
+                    assert same_samples(day_volumes[row], expected_volumes)
+                    assert same_samples(day_occupancies[row], expected_occupancies)
+        assert archive.volumes_for_detector('1234').shape == (365, SAMPLES_PER_DAY)
+
+        # an archive is found for its own year only
+        assert find_year_archive(directory, 2010).archive_file == archive_file
+        assert find_year_archive(directory, 2011) == None
+        try:
+            find_year_archive(archive_file, 2011)
+            assert False, 'used a 2010 archive for 2011'
+        except ValueError:
+            pass
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        testing_archive(work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+    print "archive tests passed"
@@ -18,6 +18,16 @@ def list_volumes(volumefile):
 		vol_array = array([NAN] * 2880)
 		return vol_array
 
+	return decode_volumes(vol_array)
+
+def decode_volumes(raw_volumes):
+	'''
+	Converts raw volume counts (any array shape) to a float numpy.array with
+	invalid samples set to NAN.
+	'''
+
+	vol_array = array(raw_volumes, dtype=float)
+
 	# Valid sample ranges for volumes are 0 - 40. If outside this range, set to
 	# NAN to indicate bad data.
 	bad_mask = (vol_array < 0) | (vol_array > 40)
@@ -40,6 +50,16 @@ def list_occupancies(occupancyfile):
 		occ_array = array([NAN] * 2880)
 		return occ_array
 
+	return decode_occupancies(occ_array)
+
+def decode_occupancies(raw_occupancies):
+	'''
+	Converts raw occupancy scans (any array shape) to a float numpy.array of
+	occupancy ratios with invalid samples set to NAN.
+	'''
+
+	occ_array = array(raw_occupancies, dtype=float)
+
 	# Valid sample ranges for occupancies are 0 - 1800. If outside this range,
 	# set to None to indicate bad data. Return valid data as a ratio of 1800.
 	bad_mask = (occ_array < 0) | (occ_array > 1800)
@@ -0,0 +1,654 @@
+'''
+Storage backends that .traffic files are read from by name:
+
+    LocalStorage    a directory of .traffic files, which may also hold year
+                    archives, or the path of a year archive
+    HTTPStorage     files under a base URL, read over a pool of persistent
+                    connections, whole or with range requests
+    TarStorage      the members of an uncompressed (or, more slowly,
+                    compressed) tar bundle of .traffic files
+    CachedStorage   a read-through cache in a local directory in front of
+                    another backend
+
+open_storage turns a location given where a directory of .traffic files is
+expected into a backend: URLs give an HTTPStorage, tar files a TarStorage and
+anything else a LocalStorage. Backends are kept by location, so a location
+configured once (with a cache or a number of requests in flight) keeps that
+configuration wherever it is passed as a string afterwards.
+
+Reading one file at a time from remote storage is bound by the latency of
+each request, so fetch_many reads a sequence of files with up to
+max_in_flight requests outstanding and yields them in order.
+
+Backends raise IOError with errno ENOENT for files that do not exist, as
+opening a missing local file does, and tell is_missing apart from reads that
+failed: a missing .traffic file is a day without data, but a failed request
+or a truncated read is retried and then raised, never taken for one.
+'''
+from archive import find_year_archive
+from os import path, makedirs, rename, fdopen
+from cStringIO import StringIO
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from urllib import quote
+import urlparse
+import httplib
+import errno
+import socket
+import tarfile
+import tempfile
+import threading
+import time
+
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2')
+
+# attempts at a read that fails other than for a missing file, and the delay
+# in seconds before the first retry, doubled for each one after it
+READ_ATTEMPTS = 3
+RETRY_DELAY = 0.5
+
+def missing_file_error(message, filename):
+    '''
+    Returns the IOError backends raise for a file that does not exist
+    '''
+    return IOError(errno.ENOENT, message, filename)
+
+def is_missing(error):
+    '''
+    Returns whether the IOError error means that a file does not exist, rather
+    than that it could not be read
+    '''
+    return error.errno == errno.ENOENT
+
+def or_none_if_missing(function, *args):
+    '''
+    Returns function(*args), or None if it raises an IOError for a missing
+    file. Other IOErrors are retried up to READ_ATTEMPTS attempts in all and
+    then raised.
+    '''
+    for attempt in range(READ_ATTEMPTS):
+        try:
+            return function(*args)
+        except IOError, e:
+            if is_missing(e):
+                return None
+            if attempt == READ_ATTEMPTS - 1:
+                raise
+        time.sleep(RETRY_DELAY * 2 ** attempt)
+
+class Storage:
+    '''
+    The interface of a place .traffic files are read from by name. Subclasses
+    define read(name), which returns the contents of the named file, and may
+    override the defaults below. read and open raise IOError for files that
+    do not exist (see missing_file_error) and for files that could not be
+    read.
+    '''
+
+    # requests worth having outstanding at once (see fetch_many)
+    max_in_flight = 1
+
+    def open(self, name):
+        '''
+        Returns a seekable file object over the named file
+        '''
+        return StringIO(self.read(name))
+
+    def year_archive(self, year):
+        '''
+        Returns the YearArchive holding year, or None
+        '''
+        return None
+
+class LocalStorage(Storage):
+    '''
+    A directory of .traffic files, or the path of a year archive. Shared
+    network filesystems benefit from more than one read in flight.
+    '''
+
+    def __init__(self, directory, max_in_flight=1):
+        self.location = directory
+        self.max_in_flight = max_in_flight
+
+    def read(self, name):
+        with open(path.join(self.location, name), 'rb') as f:
+            return f.read()
+
+    def open(self, name):
+        return open(path.join(self.location, name), 'rb')
+
+    def year_archive(self, year):
+        return find_year_archive(self.location, year)
+
+class HTTPStorage(Storage):
+    '''
+    Files under base_url, read with at most max_connections requests at once
+    over persistent connections that are kept for reuse
+    '''
+
+    def __init__(self, base_url, max_connections=8, timeout=60):
+        self.location = base_url
+        self.max_in_flight = max_connections
+        self.timeout = timeout
+        parts = urlparse.urlsplit(base_url)
+        if parts.scheme == 'https':
+            self._connection_class = httplib.HTTPSConnection
+        else:
+            self._connection_class = httplib.HTTPConnection
+        self._host = parts.netloc
+        self._prefix = parts.path.rstrip('/') + '/'
+
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _acquire(self):
+        # returns a connection and whether it was used before
+        self._slots.acquire()
+        with self._lock:
+            if len(self._idle) > 0:
+                return self._idle.pop(), True
+        return self._connection_class(self._host, timeout=self.timeout), False
+
+    def _release(self, connection, reuse):
+        if reuse:
+            with self._lock:
+                self._idle.append(connection)
+        else:
+            connection.close()
+        self._slots.release()
+
+    def _url(self, name):
+        return self.location.rstrip('/') + '/' + name
+
+    def _request(self, method, name, headers=None):
+        # returns (status, headers, body). a connection the server closed
+        # while it sat idle fails on first use, so that is retried once on a
+        # new connection.
+        for attempt in range(2):
+            connection, reused = self._acquire()
+            try:
+                connection.request(method, self._prefix + quote(name), headers=headers or {})
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                self._release(connection, False)
+                if reused and attempt == 0:
+                    continue
+                raise IOError("Could not read " + self._url(name) + ": " + str(e))
+            self._release(connection, not response.will_close)
+            break
+
+        if response.status == 404:
+            raise missing_file_error("No such file", self._url(name))
+        if response.status not in (200, 206):
+            raise IOError("HTTP " + str(response.status) + " reading " + self._url(name))
+        return response.status, dict(response.getheaders()), body
+
+    def read(self, name):
+        return self._request('GET', name)[2]
+
+    def read_range(self, name, offset, length):
+        '''
+        Returns length bytes of the named file from offset, fewer at its end
+        '''
+        if length <= 0:
+            return ''
+        status, headers, body = self._request(
+            'GET', name, {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)})
+        if status == 200:
+            # the server ignored the range and sent the whole file
+            return body[offset:offset + length]
+        return body
+
+    def size(self, name):
+        '''
+        Returns the size in bytes of the named file
+        '''
+        return int(self._request('HEAD', name)[1]['content-length'])
+
+    def open(self, name):
+        # zip files are read from their end, where the member directory is,
+        # so opening one only fetches the parts actually read
+        return RangeFile(self, name, self.size(name))
+
+class RangeFile:
+    '''
+    A read-only file object over a file of a backend with read_range, which
+    fetches whole blocks of block_size bytes and keeps the last cached_blocks
+    of them
+    '''
+
+    def __init__(self, storage, name, size, block_size=256 * 1024, cached_blocks=8):
+        self._storage = storage
+        self.name = name
+        self._size = size
+        self._position = 0
+        self._block_size = block_size
+        self._cached_blocks = cached_blocks
+        self._blocks = {}
+        self._block_order = deque()
+
+    def _block(self, index):
+        if index not in self._blocks:
+            if len(self._block_order) >= self._cached_blocks:
+                del self._blocks[self._block_order.popleft()]
+            self._blocks[index] = self._storage.read_range(
+                self.name, index * self._block_size, self._block_size)
+            self._block_order.append(index)
+        return self._blocks[index]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += self._size
+        self._position = max(0, offset)
+
+    def tell(self):
+        return self._position
+
+    def read(self, n=-1):
+        end = self._size if n < 0 else min(self._size, self._position + n)
+        chunks = []
+        while self._position < end:
+            index, start = divmod(self._position, self._block_size)
+            chunk = self._block(index)[start:start + end - self._position]
+            if len(chunk) == 0:
+                break
+            chunks.append(chunk)
+            self._position += len(chunk)
+        return ''.join(chunks)
+
+    def close(self):
+        self._blocks = {}
+        self._block_order.clear()
+
+class TarStorage(Storage):
+    '''
+    The members of a tar bundle, found by their base names. Members of an
+    uncompressed bundle are read straight from their offsets, so concurrent
+    reads do not wait on each other; a compressed bundle is read through one
+    decompressing stream at a time.
+    '''
+
+    def __init__(self, tar_file, max_in_flight=1):
+        self.location = tar_file
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        try:
+            self._tar = tarfile.open(tar_file, 'r:')
+            self._compressed = False
+        except tarfile.ReadError:
+            self._tar = tarfile.open(tar_file, 'r:*')
+            self._compressed = True
+        self._members = {}
+        for member in self._tar.getmembers():
+            if member.isfile():
+                self._members[path.basename(member.name)] = member
+
+    def _member(self, name):
+        member = self._members.get(name)
+        if member == None:
+            raise missing_file_error("No such file in " + self.location, name)
+        return member
+
+    def read(self, name):
+        member = self._member(name)
+        if self._compressed:
+            with self._lock:
+                return self._tar.extractfile(member).read()
+        with open(self.location, 'rb') as f:
+            f.seek(member.offset_data)
+            data = f.read(member.size)
+        if len(data) < member.size:
+            raise IOError("Truncated " + name + " in " + self.location)
+        return data
+
+class CachedStorage(Storage):
+    '''
+    Keeps a copy of every file read from storage in cache_dir and reads it
+    from there afterwards. Files are written to a temporary name and renamed,
+    so concurrent and interrupted reads never leave a partial copy.
+    '''
+
+    def __init__(self, storage, cache_dir):
+        self.storage = storage
+        self.location = storage.location
+        self.max_in_flight = storage.max_in_flight
+        self.cache_dir = cache_dir
+        if not path.isdir(cache_dir):
+            makedirs(cache_dir)
+
+    def _fill(self, name):
+        # returns the cached file and, if it was just fetched, its contents
+        cached_file = path.join(self.cache_dir, name)
+        if not path.exists(cached_file):
+            data = self.storage.read(name)
+            handle, tmp_file = tempfile.mkstemp(dir=self.cache_dir, prefix=name + '.')
+            with fdopen(handle, 'wb') as f:
+                f.write(data)
+            rename(tmp_file, cached_file)
+            return cached_file, data
+        return cached_file, None
+
+    def read(self, name):
+        cached_file, data = self._fill(name)
+        if data != None:
+            return data
+        with open(cached_file, 'rb') as f:
+            return f.read()
+
+    def open(self, name):
+        return open(self._fill(name)[0], 'rb')
+
+    def year_archive(self, year):
+        return self.storage.year_archive(year)
+
+# backends opened so far, by location
+_open_storages = {}
+
+def open_storage(location, cache_dir=None, max_in_flight=None):
+    '''
+    Returns the storage backend for location, which is passed through if it
+    already is one. Locations starting with http:// or https:// are read with
+    HTTPStorage, tar files with TarStorage and anything else is a
+    LocalStorage directory. If cache_dir is given, reads go through a
+    CachedStorage there; max_in_flight sets the number of concurrent reads.
+    Without either, the backend already opened for location is reused.
+    '''
+    if isinstance(location, Storage):
+        return location
+    if cache_dir == None and max_in_flight == None and location in _open_storages:
+        return _open_storages[location]
+
+    if location.startswith('http://') or location.startswith('https://'):
+        if max_in_flight == None:
+            storage = HTTPStorage(location)
+        else:
+            storage = HTTPStorage(location, max_in_flight)
+    elif path.isfile(location) and location.endswith(TAR_EXTENSIONS):
+        storage = TarStorage(location, max_in_flight or 1)
+    else:
+        storage = LocalStorage(location, max_in_flight or 1)
+    if cache_dir != None:
+        storage = CachedStorage(storage, cache_dir)
+
+    _open_storages[location] = storage
+    return storage
+
+def _read_or_none(storage, name):
+    return or_none_if_missing(storage.read, name)
+
+def fetch_many(storage, names, max_in_flight=None):
+    '''
+    Yields a tuple (name, data) for each of names in order, where data is the
+    contents of the file or None if it does not exist. Raises IOError for a
+    file that still cannot be read after retrying. Up to max_in_flight
+    files (default the backend's max_in_flight) are read at once, and at most
+    twice that many are held ahead of the one yielded.
+    '''
+    if max_in_flight == None:
+        max_in_flight = storage.max_in_flight
+    if max_in_flight <= 1:
+        for name in names:
+            yield name, _read_or_none(storage, name)
+        return
+
+    pool = ThreadPool(max_in_flight)
+    try:
+        window = deque()
+        for name in names:
+            window.append((name, pool.apply_async(_read_or_none, (storage, name))))
+            if len(window) >= 2 * max_in_flight:
+                name, result = window.popleft()
+                yield name, result.get()
+        while len(window) > 0:
+            name, result = window.popleft()
+            yield name, result.get()
+    finally:
+        pool.terminate()
+
+if __name__ == '__main__':
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    import random
+    import shutil
+
+    RETRY_DELAY = 0.01
+    FILES = dict(('2010010%d.traffic' % day, ''.join(chr(random.randrange(256))
+                                                   for i in range(1000 + day)))
+                 for day in range(1, 8))
+
+    class TestHandler(BaseHTTPRequestHandler):
+        # serves FILES under /data/, with range requests. /data/whole/ ignores
+        # ranges, and the first server.failures[name] requests for name get a
+        # 503.
+        protocol_version = 'HTTP/1.1'
+
+        def _send(self, send_body):
+            self.server.requests.append(self.path)
+            prefix, name = self.path.rsplit('/', 1)
+            if name not in FILES or prefix not in ('/data', '/data/whole'):
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if self.server.failures.get(name, 0) > 0:
+                self.server.failures[name] -= 1
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = FILES[name]
+            byte_range = self.headers.getheader('Range')
+            if byte_range != None and prefix == '/data':
+                first, last = [int(value) for value in byte_range.split('=')[1].split('-')]
+                body = body[first:last + 1]
+                self.send_response(206)
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+
+        def do_GET(self):
+            self._send(True)
+
+        def do_HEAD(self):
+            self._send(False)
+
+        def log_message(self, format, *args):
+            pass
+
+    class TestServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    def testing_http():
+        server = TestServer(('127.0.0.1', 0), TestHandler)
+        server.requests = []
+        server.failures = {}
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        base_url = 'http://127.0.0.1:%d/data' % server.server_address[1]
+        storage = HTTPStorage(base_url, max_connections=2)
+        try:
+            # 200
+            assert storage.read('20100101.traffic') == FILES['20100101.traffic']
+            assert storage.size('20100102.traffic') == len(FILES['20100102.traffic'])
+            # 206, and a 200 from a server that ignores the range
+            assert storage.read_range('20100101.traffic', 10, 20) == FILES['20100101.traffic'][10:30]
+            assert storage.read_range('20100101.traffic', 995, 20) == FILES['20100101.traffic'][995:]
+            whole = HTTPStorage(base_url + '/whole')
+            assert whole.read_range('20100101.traffic', 10, 20) == FILES['20100101.traffic'][10:30]
+            # 404 is a missing file, not a failed read
+            try:
+                storage.read('20100131.traffic')
+                assert False, 'read a missing file'
+            except IOError, e:
+                assert is_missing(e)
+            del server.requests[:]
+            assert or_none_if_missing(storage.read, '20100131.traffic') == None
+            assert len(server.requests) == 1, 'retried a missing file'
+
+            # 5xx is retried, and raised once the attempts run out
+            server.failures['20100103.traffic'] = READ_ATTEMPTS - 1
+            assert or_none_if_missing(storage.read, '20100103.traffic') == FILES['20100103.traffic']
+            server.failures['20100104.traffic'] = READ_ATTEMPTS
+            del server.requests[:]
+            try:
+                or_none_if_missing(storage.read, '20100104.traffic')
+                assert False, 'read a failing file'
+            except IOError, e:
+                assert not is_missing(e)
+            assert len(server.requests) == READ_ATTEMPTS
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def testing_range_file():
+        class MemoryStorage(Storage):
+            # FILES, counting the ranges read
+            def __init__(self):
+                self.ranges = 0
+
+            def read(self, name):
+                return FILES[name]
+
+            def read_range(self, name, offset, length):
+                self.ranges += 1
+                return FILES[name][offset:offset + length]
+
+        storage = MemoryStorage()
+        data = FILES['20100107.traffic']
+        f = RangeFile(storage, '20100107.traffic', len(data), block_size=100, cached_blocks=2)
+        # reads within, across and up to block boundaries and past the end
+        for offset, n in [(0, 10), (95, 10), (90, 300), (200, 100), (999, 2),
+                          (1000, 100), (1007, 10), (2000, 5)]:
+            f.seek(offset)
+            assert f.read(n) == data[offset:offset + n], (offset, n)
+            assert f.tell() == min(offset + n, max(offset, len(data)))
+        f.seek(-30, 2)
+        assert f.read() == data[-30:]
+        f.seek(0)
+        f.seek(450, 1)
+        assert f.read(60) == data[450:510]
+        # a read within the cached blocks is not fetched again
+        ranges = storage.ranges
+        f.seek(420)
+        assert f.read(150) == data[420:570]
+        assert storage.ranges == ranges
+        f.seek(0)
+        assert f.read() == data
+
+    def testing_tar(directory):
+        for mode, extension in [('w', '.tar'), ('w:gz', '.tar.gz')]:
+            tar_file = path.join(directory, 'traffic' + extension)
+            tar = tarfile.open(tar_file, mode)
+            for name, data in FILES.items():
+                info = tarfile.TarInfo('2010/' + name)
+                info.size = len(data)
+                tar.addfile(info, StringIO(data))
+            info = tarfile.TarInfo('2010/20100131.traffic')
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+            tar.close()
+
+            storage = open_storage(tar_file)
+            assert isinstance(storage, TarStorage)
+            assert storage._compressed == (mode != 'w')
+            # members are found by base name, and directories are not files
+            for name, data in FILES.items():
+                assert storage.read(name) == data
+            for name in ['20100131.traffic', '2010/20100101.traffic']:
+                assert or_none_if_missing(storage.read, name) == None
+
+    def testing_cache(directory):
+        class GatedStorage(Storage):
+            # FILES, read once the gate opens, counting the reads
+            location = 'gated'
+
+            def __init__(self):
+                self.gate = threading.Event()
+                self.reads = 0
+
+            def read(self, name):
+                self.reads += 1
+                self.gate.wait()
+                return FILES[name]
+
+        cache_dir = path.join(directory, 'cache')
+        backend = GatedStorage()
+        storage = CachedStorage(backend, cache_dir)
+        name = '20100105.traffic'
+        cached_file = path.join(cache_dir, name)
+
+        # concurrent reads of a file not cached yet each get the whole file,
+        # and nothing is cached under its name until a whole copy is
+        results = []
+        readers = [threading.Thread(target=lambda: results.append(storage.read(name)))
+                   for i in range(4)]
+        for reader in readers:
+            reader.start()
+        while backend.reads < len(readers):
+            time.sleep(0.01)
+        assert not path.exists(cached_file)
+        backend.gate.set()
+        for reader in readers:
+            reader.join()
+        assert results == [FILES[name]] * len(readers)
+        with open(cached_file, 'rb') as f:
+            assert f.read() == FILES[name]
+
+        # cached files are not read again
+        reads = backend.reads
+        assert storage.read(name) == FILES[name]
+        assert storage.open(name).read() == FILES[name]
+        assert backend.reads == reads
+
+        # a copy that fails part way is not cached
+        class UnwritableStorage(Storage):
+            location = 'unwritable'
+
+            def read(self, name):
+                return u'\u2014'
+
+        storage = CachedStorage(UnwritableStorage(), cache_dir)
+        try:
+            storage.read('20100106.traffic')
+            assert False, 'cached an unwritable file'
+        except UnicodeError:
+            pass
+        assert not path.exists(path.join(cache_dir, '20100106.traffic'))
+
+    def testing_fetch_many():
+        class SlowStorage(Storage):
+            # FILES after a random delay
+            def __init__(self, max_in_flight):
+                self.max_in_flight = max_in_flight
+
+            def read(self, name):
+                time.sleep(random.random() * 0.02)
+                if name not in FILES:
+                    raise missing_file_error("No such file", name)
+                return FILES[name]
+
+        names = ['201001%02d.traffic' % day for day in range(1, 10)] * 3
+        for max_in_flight in [1, 4]:
+            fetched = list(fetch_many(SlowStorage(max_in_flight), names))
+            assert [name for name, data in fetched] == names
+            for name, data in fetched:
+                assert data == FILES.get(name)
+
+    testing_http()
+    testing_range_file()
+    work_dir = tempfile.mkdtemp()
+    try:
+        testing_tar(work_dir)
+        testing_cache(work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+    testing_fetch_many()
+    print "storage tests passed"